@@ -1,3 +1,5 @@
 
 from .compile import *
 
+# keep this the same as the version in setup.py
+__version__ = '0.1.0'
@@ -0,0 +1,83 @@
+"""Benchmarks for nativecompile.
+
+runtime compares how fast code runs when it is interpreted and when it is
+compiled. Run it with "python -m nativecompile.benchmarks.runtime --help".
+
+compile_time measures how fast the compiler is and how long importing takes
+with and without it. Run it with
+"python -m nativecompile.benchmarks.compile_time --help".
+
+"""
+
+import sys
+import math
+import json
+
+from .. import pyinternals
+from ..profiling import timer
+
+
+def summarize(times):
+    """Get the statistics of a list of timings as a dict"""
+    times = sorted(times)
+    n = len(times)
+    mean = sum(times) / n
+    half = n // 2
+    median = times[half] if n % 2 else (times[half-1] + times[half]) / 2
+    stdev = math.sqrt(sum((t - mean) ** 2 for t in times) / (n - 1)) if n > 1 else 0.0
+    return {
+        'runs' : n,
+        'min' : times[0],
+        'max' : times[-1],
+        'mean' : mean,
+        'median' : median,
+        'stdev' : stdev}
+
+
+def measure(func,repeat,warmup):
+    """Call func warmup times, then time repeat more calls of it"""
+    for i in range(warmup): func()
+
+    times = []
+    for i in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return times
+
+
+def environment():
+    """Describe what the benchmarks were run on"""
+    return {
+        'python' : sys.version,
+        'architecture' : pyinternals.ARCHITECTURE,
+        'platform' : sys.platform}
+
+
+def write_json(results,path):
+    """Write results to the file at path or to stdout if path is '-'"""
+    if path == '-':
+        json.dump(results,sys.stdout,indent=2,sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(path,'w') as f:
+            json.dump(results,f,indent=2,sort_keys=True)
+
+
+def find_regressions(results,baseline,key,tolerance):
+    """Compare results with baseline (both as written by write_json).
+
+    key selects the median being compared in each benchmark. Returns a list of
+    (name,old median,new median) for every benchmark that got slower by more
+    than the fraction tolerance.
+
+    """
+    slower = []
+    for name,new in sorted(results['benchmarks'].items()):
+        old = baseline['benchmarks'].get(name)
+        if old is None: continue
+        old_t = key(old)['median']
+        new_t = key(new)['median']
+        if new_t > old_t * (1 + tolerance):
+            slower.append((name,old_t,new_t))
+    return slower
@@ -0,0 +1,278 @@
+"""Measure how long compiling and importing take.
+
+Generated modules of increasing size are compiled with compile_raw to get the
+compile throughput (in bytes of bytecode and bytes of machine code per second)
+and the memory used by the compiler. Generated packages (and any real packages
+given with --package) are imported in fresh interpreters, with and without the
+compiling importer, to get the import time.
+
+"""
+
+import argparse
+import builtins
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from ..compile import Abi
+from ..compile_raw import compile_raw, SizeTuning
+from ..profiling import CompileProfile
+from . import summarize, measure, environment, write_json, find_regressions
+
+
+FUNCTION_TEMPLATE = '''
+def f{i}(a,b):
+    x = a + b * {i}
+    for j in range(b):
+        x = x + j
+        if x > 1000:
+            x = x // 2
+{body}    return [x,a,b]
+'''
+
+STATEMENT = '''    x = x + a * {j}
+'''
+
+
+def generate_module(functions,statements=0):
+    """Get the source of a module with the given number of functions, each
+    with statements extra statements"""
+    body = ''.join(STATEMENT.format(j=j) for j in range(statements))
+    return ''.join(FUNCTION_TEMPLATE.format(i=i,body=body) for i in range(functions))
+
+
+def bytecode_size(code):
+    size = len(code.co_code)
+    for c in code.co_consts:
+        if isinstance(c,types.CodeType): size += bytecode_size(c)
+    return size
+
+
+MEMORY_SCRIPT = '''
+import sys, resource
+sys.path.insert(0,{path!r})
+from nativecompile.compile import Abi
+from nativecompile.compile_raw import compile_raw
+from nativecompile.benchmarks.compile_time import generate_module
+code = compile(generate_module({functions},{statements}),'<generated>','exec')
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+compile_raw(code,Abi)
+sys.stdout.write(repr(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base))
+'''
+
+def peak_memory(code,functions,statements):
+    """Get the peak memory used by compiling code, the generated module with
+    the given number of functions and statements, or None if it can't be
+    measured.
+
+    tracemalloc is used if available. Otherwise (as on Python 3.2) the module
+    is compiled in a new interpreter and the growth of its maximum resident set
+    size is used, since in this process the benchmarks run before have already
+    raised it.
+
+    """
+    if tracemalloc is not None:
+        started = not tracemalloc.is_tracing()
+        if started: tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc,'reset_peak'): tracemalloc.reset_peak()
+            compile_raw(code,Abi)
+            return tracemalloc.get_traced_memory()[1] - base
+        finally:
+            if started: tracemalloc.stop()
+
+    if resource is None: return None
+
+    path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    out = subprocess.check_output([sys.executable,'-c',MEMORY_SCRIPT.format(
+        path=path,
+        functions=functions,
+        statements=statements)])
+
+    # ru_maxrss is in kilobytes on Linux
+    return int(out.decode()) * 1024
+
+
+def compile_benchmark(functions,statements=0,repeat=5,warmup=1):
+    code = builtins.compile(generate_module(functions,statements),'<generated>','exec')
+    native_size = [0]
+
+    def run():
+        parts,entry_points = compile_raw(code,Abi)
+        native_size[0] = sum(len(p) for p in parts)
+
+    times = summarize(measure(run,repeat,warmup))
+
+    # the sizes of the jumps don't depend on timing, so one profiled compile
+    # is enough
+    profile = CompileProfile()
+    compile_raw(code,Abi,profile=profile)
+
+    parts,entry_points = compile_raw(code,Abi,tuning=SizeTuning())
+    small_size = sum(len(p) for p in parts)
+
+    bsize = bytecode_size(code)
+    return {
+        'functions' : functions,
+        'statements' : statements,
+        'bytecode_size' : bsize,
+        'native_size' : native_size[0],
+        'native_size_optimized' : small_size,
+        'time' : times,
+        'bytecode_bytes_per_sec' : bsize / times['median'],
+        'native_bytes_per_sec' : native_size[0] / times['median'],
+        'jump_bytes' : profile.jumps['bytes'],
+        'jump_bytes_saved' : profile.jumps['full_size_bytes'] - profile.jumps['bytes'],
+        'peak_memory' : peak_memory(code,functions,statements)}
+
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0,{path!r})
+if {mode!r} != 'bytecode':
+    import nativecompile.importer
+    nativecompile.importer.install_importer(cache={mode!r} == 'native-cached')
+start = time.time()
+import {name}
+sys.stdout.write(repr(time.time() - start))
+'''
+
+IMPORT_MODES = ('bytecode','native','native-cached')
+
+
+def import_time(path,name,mode):
+    """Import package name from directory path in a new interpreter and return
+    how long the import took"""
+    # -B keeps .pyc files from being written so that the uncached runs stay
+    # cold (it would also keep the native code cache from being written)
+    args = [sys.executable,'-c',IMPORT_SCRIPT.format(path=path,name=name,mode=mode)]
+    if mode != 'native-cached': args.insert(1,'-B')
+    out = subprocess.check_output(args)
+    return float(out.decode())
+
+
+def import_benchmark(path,name,repeat=5):
+    r = {}
+    for mode in IMPORT_MODES:
+        if mode == 'native-cached':
+            # fill the cache
+            import_time(path,name,mode)
+        r[mode] = summarize([import_time(path,name,mode) for i in range(repeat)])
+    return r
+
+
+def generate_package(path,name,modules,functions):
+    pdir = os.path.join(path,name)
+    os.mkdir(pdir)
+    with open(os.path.join(pdir,'__init__.py'),'w') as f:
+        f.write(''.join('from . import m{}\n'.format(i) for i in range(modules)))
+    for i in range(modules):
+        with open(os.path.join(pdir,'m{}.py'.format(i)),'w') as f:
+            f.write(generate_module(functions))
+
+
+def run_all(sizes=(1,10,100,1000),statements=(0,),modules=10,repeat=5,warmup=1,packages=()):
+    """Run the compile benchmarks for every combination of sizes (number of
+    functions) and statements, and the import benchmarks for a generated
+    package of modules modules and for each directory in packages"""
+    r = environment()
+    r.update(repeat=repeat,warmup=warmup,benchmarks={})
+
+    for n in sizes:
+        for s in statements:
+            r['benchmarks']['compile-{}x{}'.format(n,s)] = compile_benchmark(n,s,repeat,warmup)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        generate_package(tmp,'ncgenerated',modules,sizes[len(sizes)//2])
+        r['benchmarks']['import-generated'] = import_benchmark(tmp,'ncgenerated',repeat)
+    finally:
+        shutil.rmtree(tmp)
+
+    for p in packages:
+        p = os.path.abspath(p)
+        r['benchmarks']['import-' + os.path.basename(p)] = import_benchmark(
+            os.path.dirname(p),
+            os.path.basename(p),
+            repeat)
+
+    return r
+
+
+def print_table(results,out=sys.stdout):
+    out.write('{:<20}{:>12}{:>12}{:>12}{:>12}{:>14}{:>14}{:>12}\n'.format(
+        'compile','bytecode','native','size opt','jmp saved','bytecode B/s','native B/s','peak mem'))
+    for name,b in sorted(results['benchmarks'].items()):
+        if name.startswith('compile-'):
+            out.write('{:<20}{:>12}{:>12}{:>12}{:>12}{:>14.0f}{:>14.0f}{:>12}\n'.format(
+                name,
+                b['bytecode_size'],
+                b['native_size'],
+                b['native_size_optimized'],
+                b['jump_bytes_saved'],
+                b['bytecode_bytes_per_sec'],
+                b['native_bytes_per_sec'],
+                b['peak_memory'] if b['peak_memory'] is not None else '?'))
+
+    out.write('\n{:<20}'.format('import') + ''.join('{:>16}'.format(m) for m in IMPORT_MODES) + '\n')
+    for name,b in sorted(results['benchmarks'].items()):
+        if name.startswith('import-'):
+            out.write('{:<20}'.format(name) + ''.join('{:>16.6f}'.format(b[m]['median']) for m in IMPORT_MODES) + '\n')
+
+
+def median_time(b):
+    return b['time'] if 'time' in b else b['native']
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    p.add_argument('--sizes',type=int,nargs='+',default=[1,10,100,1000],
+        help='the numbers of functions in the generated modules')
+    p.add_argument('--statements',type=int,nargs='+',default=[0],
+        help='the numbers of extra statements in each generated function')
+    p.add_argument('--modules',type=int,default=10,help='the number of modules in the generated package')
+    p.add_argument('--package',action='append',default=[],metavar='PATH',
+        help='also measure importing the package in directory PATH')
+    p.add_argument('-r','--repeat',type=int,default=5,help='timed runs per benchmark')
+    p.add_argument('-w','--warmup',type=int,default=1,help='untimed compiles before the timed ones')
+    p.add_argument('--json',metavar='PATH',help='write the results as JSON to PATH ("-" for stdout)')
+    p.add_argument('--compare',metavar='PATH',help='compare the results with the JSON results in PATH')
+    p.add_argument('--tolerance',type=float,default=0.1,help='how much slower (as a fraction) counts as a regression')
+    args = p.parse_args(argv)
+
+    results = run_all(args.sizes,args.statements,args.modules,args.repeat,args.warmup,args.package)
+
+    if args.json:
+        write_json(results,args.json)
+    if args.json != '-':
+        print_table(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = find_regressions(results,baseline,median_time,args.tolerance)
+        for name,old,new in slower:
+            sys.stderr.write('{} regressed: {:.6f}s -> {:.6f}s\n'.format(name,old,new))
+        if slower: return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
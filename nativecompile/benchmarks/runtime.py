@@ -0,0 +1,115 @@
+"""Compare the speed of interpreted and compiled code.
+
+Every workload in workloads.WORKLOADS is compiled to bytecode once and to
+machine code once, and then run repeatedly both ways. Compile time is not
+included in the timings (see compile_time for that).
+
+"""
+
+import argparse
+import builtins
+import json
+import sys
+
+from .. import pyinternals
+from ..compile import compile
+from . import summarize, measure, environment, write_json, find_regressions
+from .workloads import WORKLOADS
+
+
+def runners(source,n,name='<benchmark>'):
+    """Return functions that run source as bytecode and as machine code, and
+    return the module's "result"."""
+    code = builtins.compile(source,name,'exec')
+    ccode = compile(code)
+
+    def bytecode():
+        ns = {'__name__' : name,'N' : n}
+        exec(code,ns)
+        return ns['result']
+
+    def native():
+        ns = {'__name__' : name,'N' : n}
+        pyinternals.cep_exec(ccode.entry_points[0],ns)
+        return ns['result']
+
+    return bytecode,native
+
+
+def run_workload(name,repeat=10,warmup=2,scale=1.0):
+    source,n = WORKLOADS[name]
+    n = max(int(n * scale),1)
+    bytecode,native = runners(source,n,name)
+
+    expected = bytecode()
+    actual = native()
+    if actual != expected:
+        raise Exception(
+            'workload {} gave {!r} when compiled instead of {!r}'
+            .format(name,actual,expected))
+
+    r = {
+        'n' : n,
+        'bytecode' : summarize(measure(bytecode,repeat,warmup)),
+        'native' : summarize(measure(native,repeat,warmup))}
+    r['speedup'] = r['bytecode']['median'] / r['native']['median']
+    return r
+
+
+def run_all(names=None,repeat=10,warmup=2,scale=1.0):
+    """Run the workloads in names (or all of them) and return the results as a
+    dict that can be written as JSON"""
+    if names is None: names = sorted(WORKLOADS)
+
+    r = environment()
+    r.update(repeat=repeat,warmup=warmup,scale=scale,benchmarks={})
+    for name in names:
+        r['benchmarks'][name] = run_workload(name,repeat,warmup,scale)
+    return r
+
+
+def print_table(results,out=sys.stdout):
+    out.write('{:<12}{:>14}{:>14}{:>10}\n'.format('benchmark','bytecode (s)','native (s)','speedup'))
+    for name,b in sorted(results['benchmarks'].items()):
+        out.write('{:<12}{:>14.6f}{:>14.6f}{:>10.2f}\n'.format(
+            name,
+            b['bytecode']['median'],
+            b['native']['median'],
+            b['speedup']))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    p.add_argument('names',nargs='*',metavar='NAME',
+        help='the workloads to run (default: all of them): ' + ', '.join(sorted(WORKLOADS)))
+    p.add_argument('-r','--repeat',type=int,default=10,help='timed runs per workload and mode')
+    p.add_argument('-w','--warmup',type=int,default=2,help='untimed runs before the timed ones')
+    p.add_argument('-s','--scale',type=float,default=1.0,help='multiply the size of every workload by this')
+    p.add_argument('--json',metavar='PATH',help='write the results as JSON to PATH ("-" for stdout)')
+    p.add_argument('--compare',metavar='PATH',help='compare the native timings with the JSON results in PATH')
+    p.add_argument('--tolerance',type=float,default=0.1,help='how much slower (as a fraction) counts as a regression')
+    args = p.parse_args(argv)
+
+    for name in args.names:
+        if name not in WORKLOADS: p.error('unknown workload: ' + name)
+
+    results = run_all(args.names or None,args.repeat,args.warmup,args.scale)
+
+    if args.json:
+        write_json(results,args.json)
+    if args.json != '-':
+        print_table(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = find_regressions(results,baseline,lambda b: b['native'],args.tolerance)
+        for name,old,new in slower:
+            sys.stderr.write('{} regressed: {:.6f}s -> {:.6f}s\n'.format(name,old,new))
+        if slower: return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Programs that the runtime benchmarks run.
+
+Each workload is the source of a module. The module's top-level code does all
+the work (so that compiled code calls compiled functions) and stores its answer
+in "result". N, which is set before the module runs, controls how much work is
+done.
+
+Only the opcodes that the compiler supports may be used here.
+
+"""
+
+
+NUMERIC = '''
+def numeric(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+        if total > 1000000:
+            total = total // 3
+    return total
+
+result = 0
+for k in range(N):
+    result += numeric(1000)
+'''
+
+
+STRINGS = '''
+def strings(n):
+    words = []
+    for i in range(n):
+        words.append(str(i) + '-' + 'x')
+    parts = ','.join(words).split(',')
+    count = 0
+    for p in parts:
+        if p.startswith('1'):
+            count += len(p.upper())
+    return count
+
+result = 0
+for k in range(N):
+    result += strings(200)
+'''
+
+
+DICTS = '''
+def dicts(n):
+    d = {}
+    for i in range(n):
+        d[i] = i + 1
+    total = 0
+    for k in d:
+        total += d[k]
+    counts = {}
+    for i in range(n):
+        key = i & 15
+        counts[key] = counts.get(key,0) + 1
+    return total + len(counts)
+
+result = 0
+for k in range(N):
+    result += dicts(500)
+'''
+
+
+CLASSES = '''
+class Vector:
+    def __init__(self,x,y):
+        self.x = x
+        self.y = y
+
+    def add(self,other):
+        return Vector(self.x + other.x,self.y + other.y)
+
+    def dot(self,other):
+        return self.x * other.x + self.y * other.y
+
+def classes(n):
+    v = Vector(0,0)
+    step = Vector(1,2)
+    total = 0
+    for i in range(n):
+        v = v.add(step)
+        total += v.dot(step)
+    return total
+
+result = 0
+for k in range(N):
+    result += classes(200)
+'''
+
+
+RECURSION = '''
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+result = 0
+for k in range(N):
+    result += fib(15)
+'''
+
+
+# name -> (source,default N)
+WORKLOADS = {
+    'numeric' : (NUMERIC,100),
+    'strings' : (STRINGS,50),
+    'dicts' : (DICTS,50),
+    'classes' : (CLASSES,100),
+    'recursion' : (RECURSION,20)}
@@ -1,14 +1,11 @@
 
-__all__ = ['compile','compile_asm']
+__all__ = ['compile','compile_asm','use_code_arena','code_arena_stats','set_tier_threshold']
 
 
-import os
-import tempfile
-import atexit
 import sys
 
 from . import pyinternals
-from .compile_raw import compile_raw
+from .compile_raw import compile_raw, Tuning, SizeTuning
 
 if pyinternals.ARCHITECTURE == "X86":
     from .x86_abi import CdeclAbi as Abi
@@ -23,25 +20,83 @@ else:
 
 
 
-def compile(code):
-    f = tempfile.NamedTemporaryFile(mode='wb',delete=False)
-    
-    def delete_f():
-        f.close()
-        os.remove(f.name)
-    
-    atexit.register(delete_f)
-    
-    parts,entry_points = compile_raw(code,Abi)
-    for p in parts:
-        f.write(p)
+def compile(code,lazy=False,tiered=False,workers=None,profile=None,optimize_size=False):
+    """Compile code into a CompiledCode object.
+
+    If lazy is true, the functions and class bodies nested in code are only
+    compiled when they are first run.
+
+    If tiered is true, the nested functions and class bodies are run by the
+    interpreter until they become hot (see set_tier_threshold) and are
+    compiled then.
+
+    If workers is greater than 1, the functions are compiled in parallel by
+    that many processes, unless other threads are running.
 
-    f.close()
+    If profile is a profiling.CompileProfile object, the time spent compiling
+    is added to it.
+
+    If optimize_size is true, code that would otherwise be repeated throughout
+    the machine code is put in one place and called instead, which makes the
+    code smaller but a little slower.
+
+    """
+    parts,entry_points = compile_raw(code,Abi,
+        tuning=SizeTuning() if optimize_size else Tuning(),
+        lazy=lazy,
+        tiered=tiered,
+        workers=workers,
+        profile=profile)
     
-    return pyinternals.CompiledCode(f.name,entry_points)
+    # the machine code is copied straight into executable memory, which is
+    # released when the CompiledCode object is garbage-collected
+    return pyinternals.CompiledCode(b''.join(parts),entry_points)
+
+
+def _compile_lazy(code):
+    """Compile a lazy or tiered entry point. This is called by pyinternals."""
+    tiered = pyinternals.cep_get_offset(code) == pyinternals.OFFSET_TIERED
+
+    # a tiered entry point may be running counting byte code (see tier0)
+    source = pyinternals.cep_get_source(code)
+    ccode = compile(code if source is None else source,not tiered,tiered)
+    return ccode,pyinternals.cep_get_offset(ccode.entry_points[0])
+
+pyinternals.set_lazy_compiler(_compile_lazy)
 
 
 def compile_asm(code):
     """Compile code and return the assembly representation"""
     return compile_raw(code,Abi,binary=False)[0].dump()
 
+
+
+def use_code_arena(enabled=True,huge_pages=False):
+    """Choose whether the code of new CompiledCode objects is packed into shared
+    regions of executable memory (code arenas) instead of getting a separate
+    mapping each.
+
+    If huge_pages is true, the arenas are aligned and sized so that the kernel
+    can back them with transparent huge pages.
+
+    """
+    if enabled:
+        pyinternals.arena_enable(huge_pages)
+    else:
+        pyinternals.arena_disable()
+
+
+def code_arena_stats():
+    """Get the occupancy and fragmentation of the code arenas as a dict"""
+    return pyinternals.arena_stats()
+
+
+def set_tier_threshold(threshold):
+    """Set how hot code compiled with tiered=True must get before it is
+    compiled.
+
+    A function is compiled once the number of times it was called while being
+    interpreted, plus the number of loop iterations it ran, reaches threshold.
+
+    """
+    pyinternals.set_tier_threshold(threshold)
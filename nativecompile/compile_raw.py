@@ -1,14 +1,24 @@
 
+import os
 import sys
 import dis
 import weakref
 import operator
 import types
+import string
 import itertools
 import collections
-from functools import partial, reduce
+import multiprocessing
+import threading
+from functools import partial, reduce, update_wrapper
 
 from . import pyinternals
+from .x86_ops import AsmSequence
+from .profiling import timer, phase, fire_compile_hooks, CompileProfile
+from .flowgraph import FlowGraph
+from . import peephole
+from . import floatexpr
+from . import tier0
 
 
 PRINT_STACK_OFFSET = False
@@ -33,6 +43,11 @@ TPFLAGS_BASE_EXC_SUBCLASS = 1<<30
 TPFLAGS_TYPE_SUBCLASS = 1<<31
 
 
+CO_OPTIMIZED = 0x0001
+CO_NEWLOCALS = 0x0002
+CO_NOFREE = 0x0040
+
+
 class NCSystemError(SystemError):
     """A SystemError specific to this package.
 
@@ -69,8 +84,19 @@ class StackManager:
         %esp + s            func argument 1
         %esp                func argument 0
 
+    The items just below the TOS item may be kept in cache_regs instead (see
+    push_tos). They still count in offset and have their places in memory set
+    aside, which flush writes them to.
+
+    An item in a register may also be "borrowed": it doesn't own a reference
+    to its object, because something else that can't change before the item
+    is used (a local variable, a constant or an entry of the globals or
+    builtins dict) already has one. Such an item is given a reference with
+    'incref' before being written to memory, so every item in memory owns its
+    reference.
+
     """
-    def __init__(self,op,abi,local_mem_size):
+    def __init__(self,op,abi,local_mem_size,cache_regs=(),incref=None):
         assert local_mem_size % abi.ptr_size == 0
 
         self.op = op
@@ -89,6 +115,23 @@ class StackManager:
          # onto the stack
         self.tos_in_eax = False
 
+        # the registers in cache_regs that hold stack items, from the deepest
+        # item up
+        self.cache_regs = cache_regs
+        self.cached = []
+
+        # whether push_tos may put the TOS item in one of cache_regs (see
+        # uses_stack_cache)
+        self.caching = False
+
+        # The registers (%eax and cache_regs) with borrowed items, mapped to
+        # where the reference is borrowed from: ('fast',n) for local variable
+        # n, ('const',) for a constant or ('global',) for the globals or
+        # builtins dict. incref is a function that gives the code to increase
+        # the reference count of the object in a register.
+        self.borrowed = {}
+        self.incref = incref
+
         self.resets = []
 
     def check_stack_space(self):
@@ -111,14 +154,85 @@ class StackManager:
     offset = property(get_offset,set_offset)
     
     def push_stack(self,x):
+        assert not self.cached
         self.offset += 1
         return self.op.mov(x,self[0])
 
     def pop_stack(self,x):
+        assert not self.cached
         r = self.op.mov(self[0],x)
         self.offset -= 1
         return r
 
+    def pop_item(self):
+        """Remove the TOS item and return where it is: %eax, one of
+        cache_regs or an address. Check is_borrowed first if it matters."""
+        r = self.tos()
+        self.borrowed.pop(r,None)
+        if self.tos_in_eax:
+            self.tos_in_eax = False
+        else:
+            if self.cached: self.cached.pop()
+            self.offset -= 1
+        return r
+
+    def spill(self):
+        """Get the code that writes the items in cache_regs to their places in
+        memory, without forgetting that they are in registers.
+
+        Borrowed items are given references first, so this is only for code
+        that leaves the function, unless followed by flush.
+
+        """
+        n = len(self.cached)
+        r = []
+        for i,reg in enumerate(self.cached):
+            if reg in self.borrowed: r += self.incref(reg)
+            r.append(self.op.mov(reg,self[n-1-i]))
+        return r
+
+    def flush(self,keep=0):
+        """Get the code that moves the items in cache_regs to memory, except
+        the top 'keep' items"""
+        n = len(self.cached)
+        deep = max(n - keep,0)
+        r = []
+        for i,reg in enumerate(self.cached[:deep]):
+            if self.borrowed.pop(reg,None) is not None: r += self.incref(reg)
+            r.append(self.op.mov(reg,self[n-1-i]))
+        self.cached = self.cached[deep:]
+        return r
+
+    def state(self):
+        """Get what restore needs to return to the current state, for
+        generating two versions of the same instructions"""
+        return self.__offset,self.tos_in_eax,list(self.cached),dict(self.borrowed)
+
+    def restore(self,state):
+        offset,self.tos_in_eax,cached,borrowed = state
+        self.__offset = offset
+        self.cached = list(cached)
+        self.borrowed = dict(borrowed)
+
+    def borrow(self,source):
+        """Mark the TOS item, which must be in %eax, as borrowed from source
+        (see borrowed)"""
+        assert self.tos_in_eax
+        self.borrowed[self.abi.r_ret] = source
+
+    def is_borrowed(self,n=0):
+        return self.item(n) in self.borrowed
+
+    def own(self,test=None):
+        """Get the code that gives a reference to every borrowed item whose
+        source passes test (every borrowed item if test is None)"""
+        r = []
+        for reg,source in list(self.borrowed.items()):
+            if test is None or test(source):
+                r += self.incref(reg)
+                del self.borrowed[reg]
+        return r
+
     def _stack_arg_at(self,n):
         assert n >= len(self.abi.r_arg)
         return self.abi.ops.Address(
@@ -153,20 +267,56 @@ class StackManager:
     
     def push_tos(self,set_again = False):
         """%eax is needed right now so if the TOS item hasn't been pushed onto 
-        the stack, do it now."""
-        r = [self.push_stack(self.abi.r_ret)] if self.tos_in_eax else []
+        the stack, do it now.
+
+        If caching is true, the item goes into a free register of cache_regs
+        instead, after moving the deepest cached item to memory if there are no
+        free ones.
+
+        """
+        r = []
+        if self.tos_in_eax:
+            source = self.borrowed.pop(self.abi.r_ret,None)
+            if self.caching and self.cache_regs:
+                if len(self.cached) == len(self.cache_regs):
+                    deepest = self.cached.pop(0)
+                    if self.borrowed.pop(deepest,None) is not None:
+                        r += self.incref(deepest)
+                    r.append(self.op.mov(deepest,self[len(self.cached)]))
+
+                reg = next(x for x in self.cache_regs if x not in self.cached)
+                self.offset += 1
+                self.cached.append(reg)
+                r.append(self.op.mov(self.abi.r_ret,reg))
+                if source is not None: self.borrowed[reg] = source
+            else:
+                if source is not None: r += self.incref(self.abi.r_ret)
+                r.append(self.push_stack(self.abi.r_ret))
         self.tos_in_eax = set_again
         return r
     
     def use_tos(self,set_again = False):
+        """Forget that the TOS item is in %eax and return whether it was. Check
+        is_borrowed first if it matters."""
         r = self.tos_in_eax
+        self.borrowed.pop(self.abi.r_ret,None)
         self.tos_in_eax = set_again
         return r
 
+    def item(self,n):
+        """Get the register or address of the nth item from the top"""
+        if self.tos_in_eax:
+            if n == 0: return self.abi.r_ret
+            n -= 1
+        if n < len(self.cached): return self.cached[-1-n]
+        return self[n]
+
     def tos(self):
-        return self.abi.r_ret if self.tos_in_eax else self[0]
+        return self.item(0)
 
     def conditional_jump(self,target):
+        assert not self.cached
+
         # I'm not sure if a new reset will ever need to be added anywhere except
         # the front
         for i,r in enumerate(self.resets):
@@ -190,7 +340,7 @@ class StackManager:
                 off = self.resets.pop(0)[1]
 
                 assert self.offset is None or off == self.offset
-                assert not self.tos_in_eax
+                assert not (self.tos_in_eax or self.cached)
 
                 if self.offset is None:
                     self.offset = off
@@ -218,14 +368,13 @@ class StackManager:
             return self.abi.r_arg[n]
 
         addr = self._stack_arg_at(n)
-        addr.offset += self.local_mem_size
-        return addr
+        return addr.replace(offset=addr.offset + self.local_mem_size)
 
     def call(self,func):
         self.args = 0
-        if isinstance(func,str):
+        if isinstance(func,int):
             return [
-                self.op.mov(pyinternals.raw_addresses[func],self.abi.r_ret),
+                self.op.mov(func,self.abi.r_ret),
                 self.op.call(self.abi.r_ret)]
 
         return [self.op.call(func)]
@@ -254,15 +403,49 @@ class JumpTarget:
 
 
 class JumpSource:
+    """A jump to a JumpTarget in the same function, in either direction.
+
+    The encoding is picked by resolve_jumps. A forward jump to the very next
+    instruction is left out, a jump whose displacement fits in a byte gets the
+    short form and any other jump gets the full-size form.
+
+    """
     def __init__(self,op,abi,target):
         self.op = op
         self.abi = abi
         self.target = target
         target.used = True
-    
-    def compile(self,displacement):
-        dis = displacement - self.target.displacement
-        return self.op(self.abi.ops.Displacement(dis)) if dis else b'' #optimize away useless jumps
+        self._sizes = None
+
+    def sizes(self):
+        """The lengths of the short and the full-size forms"""
+        if self._sizes is None:
+            D = self.abi.ops.Displacement
+            self._sizes = len(self.op(D(0))),len(self.op(D(0,True)))
+        return self._sizes
+
+    def size_for(self,distance,forward):
+        """Get the size of the smallest form that can reach the target.
+
+        distance is measured from the end of the jump if forward is true and
+        from the start otherwise, so that it doesn't depend on the size of the
+        jump itself.
+
+        """
+        short,full = self.sizes()
+        if forward:
+            if distance == 0: return 0 #optimize away useless jumps
+            return short if -128 <= distance <= 127 else full
+        return short if distance - short >= -128 else full
+
+    def compile(self,size,distance,forward):
+        """Encode the jump using the form with the given size"""
+        if not size: return b''
+        c = self.op(self.abi.ops.Displacement(
+            distance if forward else distance - size,
+            size != self.sizes()[0]))
+        assert len(c) == size
+        return c
 
 
 class DelayedCompile:
@@ -273,9 +456,10 @@ class InnerCall(DelayedCompile):
     """A function call with a relative target
 
     This is just like JumpSource, except the target is a different function and
-    the exact offset depends on how much padding is needed between this source's
-    function and the target function, which cannot be determined until the
-    length of the entire source function is determined.
+    the exact offset depends on the length of every function between this
+    source's function and the target function, which cannot be determined until
+    every function has been assembled. The displacements of both this object
+    and its target are relative to the end of the whole image (see link).
 
     """
     def __init__(self,opset,abi,target):
@@ -292,22 +476,169 @@ class InnerCall(DelayedCompile):
         return self.abi.ops.CALL_DISP_LEN
 
 
-class JumpRSource(DelayedCompile):
-    def __init__(self,op,abi,size,target):
+class CodeBuffer:
+    """The machine code of one function, written into a single buffer as it is
+    generated.
+
+    In binary mode 'data' is a bytearray. Otherwise it is a list of the
+    operations of AsmSequence objects. The only things not written to 'data'
+    are the ones whose bytes depend on code that may not have been generated
+    yet (JumpTarget, JumpSource and DelayedCompile objects). They are stored
+    in 'fixups' as (position,index,item) tuples, where position is the number
+    of bytes before the item and index is the length of 'data' at that point
+    (the two are the same in binary mode). 'relocs' has the positions of any
+    RelocAddress placeholders, in the same form as RelocBytes.relocs.
+
+    If 'op' is not None, single instructions (Instr objects or AsmSequence
+    objects with one operation) are held back until something that can be
+    jumped to, or whose contents are unknown, is written, or until flush is
+    called. The held back instructions are then passed through
+    peephole.optimize and 'op' is used to encode any replacements. The code
+    skipped by an instruction with a Displacement operand is not changed,
+    since the displacement depends on its size. 'frame_size' is how far the
+    base pointer is above the stack pointer wherever code is written (outside
+    of function calls), or None if it changes. It becomes None when held back
+    instructions change the stack or base pointer.
+
+    """
+    def __init__(self,binary=True,op=None,abi=None):
+        self.binary = binary
+        self.data = bytearray() if binary else []
+        self.fixups = []
+        self.relocs = []
+        self._size = 0
+
         self.op = op
         self.abi = abi
-        self.size = size
-        self.target = target
-        target.used = True
-        self.displacement = None
+        self.frame_size = None
+
+        # the held back instructions as (chunk,instruction) pairs and the
+        # "fixed" and "joins" arguments for peephole.optimize
+        self._pending = []
+        self._fixed = set()
+        self._joins = {}
+
+        # the number of bytes passed to __iadd__ so far, before any are
+        # removed
+        self._pos = 0
+
+        # the destinations of the forward jumps that skip code, as
+        # (position,index) pairs, where position is in the same terms as _pos
+        # and index is where the jump is in _pending (None if it was already
+        # written)
+        self._skips = []
+
+    def tell(self):
+        """The number of bytes written so far"""
+        return len(self.data) if self.binary else self._size
+
+    def _instruction(self,c):
+        if isinstance(c,Instr):
+            return c.name,c.args
+        if isinstance(c,AsmSequence) and len(c.ops) == 1:
+            return c.ops[0][1:]
+        if isinstance(c,JumpSource):
+            return peephole.JUMP
+        return None
+
+    def __iadd__(self,chunks):
+        if self.op is None:
+            self._write(destitch(chunks))
+            return self
 
-    def compile(self):
-        c = self.op(self.abi.ops.Displacement(self.displacement - self.target.displacement,True))
-        assert len(c) == self.size
-        return c
+        for c in destitch(chunks):
+            ins = self._instruction(c)
+            disp = None
+            if ins is not None:
+                disp = next((a for a in ins[1] if isinstance(a,self.abi.ops.Displacement)),None)
+
+            size = len(c) if isinstance(c,(bytes,AsmSequence)) else 0
+            if ins is None or (disp is not None and disp.val <= 0):
+                self.flush()
+                self._write([c])
+                self._pos += size
+                continue
+
+            i = len(self._pending)
+            joins = [j for pos,j in self._skips if pos <= self._pos]
+            if joins:
+                self._joins[i] = joins
+                self._skips = [(pos,j) for pos,j in self._skips if pos > self._pos]
+            if self._skips:
+                self._fixed.add(i)
+
+            self._pending.append((c,ins))
+            self._pos += size
+            if disp is not None:
+                self._skips.append((self._pos + disp.val,i))
 
-    def __len__(self):
-        return self.size
+        return self
+
+    def flush(self):
+        """Optimize and write the held back instructions"""
+        if not self._pending: return
+
+        pending = self._pending
+        out,self.frame_size = peephole.optimize_run(
+            [ins for c,ins in pending],
+            self.abi,
+            self.frame_size,
+            self._fixed,
+            self._joins)
+
+        self._pending = []
+        self._fixed = set()
+        self._joins = {}
+        self._skips = [(pos,None) for pos,j in self._skips]
+
+        self._write(
+            c if new is ins else getattr(self.op,new[0])(*new[1])
+            for (c,ins),new in zip(pending,out) if new is not None)
+
+    def _write(self,chunks):
+        data = self.data
+        for c in chunks:
+            if isinstance(c,bytes):
+                if isinstance(c,RelocBytes):
+                    pos = len(data)
+                    self.relocs.extend((pos + rpos,w,i) for rpos,w,i in c.relocs)
+                data += c
+            elif isinstance(c,(JumpTarget,JumpSource,DelayedCompile)):
+                self.fixups.append((self.tell(),len(data),c))
+            else:
+                data += c.ops
+                self._size += len(c)
+
+    def copy(self,buf,start,stop,size):
+        """Append buf.data[start:stop], which is size bytes long, without its
+        fixups or relocations"""
+        self.data += buf.data[start:stop]
+        self._size += size
+
+    def reserve(self,item):
+        """Leave room for a DelayedCompile object, to be filled in with
+        patch. The room is one item of 'data' in assembly mode, so reserving
+        and patching doesn't change the index of anything else."""
+        self.fixups.append((self.tell(),len(self.data),item))
+        if self.binary:
+            self.data += bytes(len(item))
+        else:
+            self.data.append(None)
+            self._size += len(item)
+
+    def patch(self,index,code):
+        """Replace the room left by reserve at index with code"""
+        if self.binary:
+            self.data[index:index+len(code)] = code
+        else:
+            self.data[index:index+1] = code.ops
+
+    def getvalue(self):
+        if not self.binary:
+            return AsmSequence(self.data)
+        if self.relocs:
+            return RelocBytes(self.data,self.relocs)
+        return bytes(self.data)
 
 
 
@@ -348,9 +679,6 @@ class JumpRSource(DelayedCompile):
 #                print('(' + free[oparg] + ')', end=' ')
 
 
-address_of = id
-
-
 def interleave_ops(regs,steps):
     """Take the operations from 'steps', give each one a different register than
     before, and interleave their instructions
@@ -392,23 +720,106 @@ class Tuning:
     build_seq_loop_threshhold = 5
     unpack_seq_loop_threshhold = 5
 
+    # put error handling and deallocation at the end of each function
+    # instead of in the middle of the code that normally runs
+    outline_cold_paths = True
+
+    # call code shared by the whole image (see SharedStubs) instead of
+    # repeating it wherever it's needed, for smaller but slightly slower code
+    shared_stubs = False
+
+    # the most registers to keep stack items in between instructions, instead
+    # of the stack memory (see stack_cache_regs)
+    stack_cache_size = 3
+
+    # don't increase the reference counts of local variables, constants and
+    # globals pushed onto the stack, when the reference can be borrowed
+    # instead (see StackManager.borrowed)
+    borrow_references = True
+
+    # remove redundant loads, stores and tests from the generated code (see
+    # peephole.py)
+    peephole = True
+
+    # do arithmetic and bitwise operations on small ints directly, instead
+    # of calling the generic number functions (see small_int_op)
+    inline_int_ops = True
+
+    # compute expressions of float variables and constants in SSE registers,
+    # creating an object only for the result (see floatexpr.py)
+    unboxed_floats = True
+
+    # compile a comparison followed by a conditional jump as a compare
+    # instruction and a jump, without creating a bool object, for identity
+    # comparisons and (with inline_int_ops) small ints
+    fuse_compare_jumps = True
+
+    # check for the same object before comparing a str constant for equality
+    # (see _str_const_compare)
+    inline_str_eq = True
+
+
+class SizeTuning(Tuning):
+    """Settings for the smallest code instead of the fastest"""
+    shared_stubs = True
+    inline_int_ops = False
+    unboxed_floats = False
+    inline_str_eq = False
+
+
+def stack_cache_regs(abi,tuning):
+    """Get the registers that compiled functions keep stack items in.
+
+    These are callee-saved registers, so the items don't have to be moved for
+    function calls, but the ones not already saved by the prologue have to be
+    saved by compile_eval.
+
+    """
+    return abi.r_pres[SAVED_REGS:SAVED_REGS + tuning.stack_cache_size]
+
 
 handlers = [None] * 0xFF
 
+def uses_stack_cache(func):
+    """Mark an opcode handler as able to handle stack items in registers (see
+    StackManager.cached). The cached items are moved to memory before every
+    other handler and at every jump target."""
+    func.stack_cache = True
+    return func
+
+def keeps_borrowed(test=lambda *arg: True):
+    """Mark an opcode handler as never running Python code (when test returns
+    true for its argument), so references borrowed from the globals and
+    builtins dicts are still good after it. Before every other handler, the
+    items with those references are given their own. Items borrowed from
+    local variables are only affected by handlers that change them."""
+    def decorator(func):
+        func.keeps_borrowed = test
+        return func
+    return decorator
+
+def is_global_ref(source):
+    return source[0] == 'global'
+
 def handler(func,name = None):
     opname = (name or func.__name__)[len('_op_'):]
+    stack_cache = getattr(func,'stack_cache',False)
+    keeps = getattr(func,'keeps_borrowed',lambda *arg: False)
     def inner(f,*extra):
         r = f()
         if isinstance(f.op,f.abi.ops.Assembly):
             r.comment(opname)
-        if f.forward_targets and f.forward_targets[0][0] <= f.byte_offset:
-            pos,t,pop = f.forward_targets.pop(0)
-            assert pos == f.byte_offset
-            r.push_tos()(t)
-            if pop:
-                r.pop_stack(f.r_scratch[1]).decref(f.r_scratch[1])
 
+        f.stack.caching = False
+        if not stack_cache or f.byte_offset in f.jump_targets:
+            r.flush_stack().own_stack()
+        elif not keeps(*extra):
+            r.own_stack(is_global_ref)
+
+        r += f.jumps_here()
         f.stack.current_pos(f.byte_offset)
+        f.prune_hints()
+        f.stack.caching = stack_cache
 
         if PRINT_STACK_OFFSET:
             print('stack items: {}  opcode: {}'.format(
@@ -421,14 +832,14 @@ def handler(func,name = None):
     return func
 
 def hasconst(func):
-    return handler(
+    return handler(update_wrapper(
         (lambda f,arg: func(f,f.code.co_consts[arg])),
-        func.__name__)
+        func))
 
 def hasname(func):
-    return handler(
+    return handler(update_wrapper(
         (lambda f,arg: func(f,f.code.co_names[arg])),
-        func.__name__)
+        func))
 
 
 def get_handler(op):
@@ -439,29 +850,236 @@ def get_handler(op):
 
 
 
-def raw_addr_if_str(x):
-    return pyinternals.raw_addresses[x] if isinstance(x,str) else x
+class RelocAddress(int):
+    """An address that is not known until the code is loaded.
+
+    The integer value is a placeholder that is emitted in place of the real
+    address. It's chosen so that the full-size form of every instruction is
+    used, leaving room for any address. 'index' is the index of the
+    ConstantPool entry that the real address comes from.
+
+    """
+    PLACEHOLDER = 0x7eadbeef
+
+    def __new__(cls,index):
+        r = int.__new__(cls,cls.PLACEHOLDER)
+        r.index = index
+        return r
+
+
+class RelocBytes(bytes):
+    """Machine code that contains one or more RelocAddress values.
+
+    'relocs' is a list of (position,width,index) tuples, one for every
+    placeholder in the code.
+
+    """
+    def __new__(cls,code,relocs):
+        r = bytes.__new__(cls,code)
+        r.relocs = relocs
+        return r
+
+    def __add__(self,b):
+        if isinstance(b,bytes):
+            return RelocBytes(
+                bytes(self) + b,
+                self.relocs + [(pos + len(self),w,i) for pos,w,i in getattr(b,'relocs',())])
+
+        return NotImplemented
+
+    def __radd__(self,b):
+        if isinstance(b,bytes):
+            return RelocBytes(
+                b + bytes(self),
+                getattr(b,'relocs',[]) + [(pos + len(b),w,i) for pos,w,i in self.relocs])
+
+        return NotImplemented
+
+
+class RelocatableOps:
+    """Wraps an instruction set module so that instructions that refer to a
+    RelocAddress come out as RelocBytes.
+
+    The placeholder is always the last field of the instruction it appears in
+    (either an immediate value or the displacement of an absolute address).
+
+    """
+    def __init__(self,ops):
+        self.ops = ops
+
+    def _reloc_index(self,x):
+        if isinstance(x,RelocAddress):
+            return x.index
+        if isinstance(x,self.ops.Address) and isinstance(x.offset,RelocAddress):
+            return x.offset.index
+        return None
+
+    def __getattr__(self,name):
+        func = getattr(self.ops,name)
+        if isinstance(func,type) or not callable(func):
+            return func
+
+        def inner(*args):
+            code = func(*args)
+            indices = [i for i in map(self._reloc_index,args) if i is not None]
+            if not indices:
+                return code
+
+            assert len(indices) == 1
+            for width in (8,4):
+                if code[-width:] == RelocAddress.PLACEHOLDER.to_bytes(width,'little'):
+                    return RelocBytes(code,[(len(code)-width,width,indices[0])])
+
+            raise NCSystemError('a relocatable address is not in the last field of the instruction')
+
+        # only create the wrapper once
+        setattr(self,name,inner)
+        return inner
+
+
+class Instr(RelocBytes):
+    """The machine code of a single instruction, along with the name and
+    operands it was generated from, so that the peephole pass can examine it
+    (see CodeBuffer). Joining Instr objects gives plain RelocBytes.
+
+    """
+    def __new__(cls,code,name,args):
+        r = RelocBytes.__new__(cls,code,getattr(code,'relocs',[]))
+        r.name = name
+        r.args = args
+        return r
+
+
+class InstrOps:
+    """Wraps an instruction set module (or RelocatableOps) so that every
+    instruction comes out as an Instr.
+
+    This is only needed in binary mode. The AsmSequence objects of assembly
+    mode already have the name and operands of every instruction.
+
+    """
+    def __init__(self,ops):
+        self.ops = ops
+
+    def __getattr__(self,name):
+        func = getattr(self.ops,name)
+        if isinstance(func,type) or not callable(func):
+            return func
+
+        def inner(*args):
+            return Instr(func(*args),name,args)
+
+        # only create the wrapper once
+        setattr(self,name,inner)
+        return inner
+
+
+class ConstantPool:
+    """The objects and run-time symbols referred to by relocatable code.
+
+    Each entry is a tuple describing where an address comes from once the code
+    is loaded:
+
+        ('symbol',name)     pyinternals.raw_addresses[name]
+        ('const',n,i)       co_consts[i] of code object n
+        ('name',n,i)        co_names[i] of code object n
+        ('varname',n,i)     co_varnames[i] of code object n
+        ('entry_point',n)   the compiled entry point of code object n
+
+    where code objects are numbered in the same order as the entry points
+    returned by compile_raw. 'relocations' is a list of
+    (position,width,entry index) tuples, where position is relative to the
+    start of the whole image.
+
+    """
+    def __init__(self):
+        self.entries = []
+        self.relocations = []
+        self.codes = []
+        self._indices = {}
+        self._code_indices = {}
+
+    def __getitem__(self,entry):
+        i = self._indices.get(entry)
+        if i is None:
+            i = self._indices[entry] = len(self.entries)
+            self.entries.append(entry)
+        return RelocAddress(i)
+
+    def add_code(self,code):
+        self._code_indices[id(code)] = len(self.codes)
+        self.codes.append(code)
+
+    def code_index(self,code):
+        return self._code_indices[id(code)]
+
+    def object_ref(self,code,x):
+        n = self.code_index(code)
+        for kind,items in (
+                ('name',code.co_names),
+                ('const',code.co_consts),
+                ('varname',code.co_varnames)):
+            for i,item in enumerate(items):
+                if item is x:
+                    return self[kind,n,i]
+
+        raise NCSystemError('relocatable code can only refer to objects that belong to its code object')
+
 
 class Frame:
-    def __init__(self,op,abi,tuning,local_mem_size,code=None,local_name=None,entry_points=None):
+    def __init__(self,op,abi,tuning,local_mem_size,code=None,local_name=None,entry_points=None,pool=None,function_starts=None,resolver=None,stubs=None):
         self.code = code
         self.op = op
         self.abi = abi
         self.tuning = tuning
-        self.stack = StackManager(op,abi,local_mem_size)
+        self.pool = pool
+        self.function_starts = function_starts
+        self.resolver = resolver
+
+        # a SharedStubs object if tuning.shared_stubs is true
+        self.stubs = stubs
+
+        # What is known about the objects on the stack at compile time. The keys
+        # are stack depths (see stack_depth) and the values are whatever
+        # resolver returned. A hint is never trusted by itself; the generated
+        # code always checks that it still holds.
+        self.hints = {}
+        self.stack = StackManager(op,abi,local_mem_size,stack_cache_regs(abi,tuning),self.incref)
         self._end = JumpTarget()
         self.local_name = local_name
         self.blockends = []
+
+        # Code that rarely runs (see outline), to be placed after the rest of
+        # the function. _end_stubs maps (stack offset,cached registers,clear
+        # eax) to the
+        # targets of the blocks made by end_stub.
+        self.cold = []
+        self._end_stubs = {}
+
         self.byte_offset = None
         self.next_byte_offset = None
         self.forward_targets = []
         self.entry_points = entry_points
 
+        # the offsets of the instructions that are jumped to (see
+        # flowgraph.FlowGraph)
+        self.jump_targets = frozenset()
+
+        # the instructions of the basic block being compiled and the index of
+        # the current one (see neighbour)
+        self.block = []
+        self.block_index = 0
+
+        # compile_eval skips the instructions before this offset, because a
+        # handler of an earlier one already generated their code
+        self.skip_to = 0
+
         # Although JUMP_ABSOLUTE could jump to any instruction, we assume
-        # compiled Python code only uses it in certain cases. Thus, we can make
-        # small optimizations between successive instructions without needing an
-        # extra pass over the byte code to determine all the jump targets.
+        # compiled Python code only uses it to go back to the start of a loop,
+        # so reverse jump targets are only made by FOR_ITER and at the
+        # offsets in loop_starts (the starts of other loops, like while loops).
         self.rtargets = {}
+        self.loop_starts = frozenset()
 
 
         a = itertools.count(abi.ptr_size * -(SAVED_REGS+1),-abi.ptr_size)
@@ -491,8 +1109,29 @@ class Frame:
     @property
     def ptr_size(self):
         return self.abi.ptr_size
+
+    def address_of(self,x):
+        """Get the address of an object referenced by the current code object"""
+        if self.pool is None: return id(x)
+        return self.pool.object_ref(self.code,x)
+
+    def entry_point_address(self,code):
+        if self.pool is None: return id(self.entry_points[id(code)][0])
+        return self.pool['entry_point',self.pool.code_index(code)]
+
+    def raw_address(self,name):
+        if self.pool is None: return pyinternals.raw_addresses[name]
+        return self.pool['symbol',name]
+
+    def raw_addr_if_str(self,x):
+        return self.raw_address(x) if isinstance(x,str) else x
     
     def check_err(self,inverted=False):
+        if self.tuning.outline_cold_paths:
+            return [
+                self.op.test(self.r_ret,self.r_ret),
+                JumpSource(partial(self.op.jcc,self.test_NZ if inverted else self.test_Z),self.abi,self.end_stub(inverted))]
+
         if inverted:
             return self.if_eax_is_not_zero(
                 [self.op.xor(self.r_ret,self.r_ret)] + 
@@ -500,10 +1139,53 @@ class Frame:
 
         return self.if_eax_is_zero(self.goto_end())
 
+    def is_exit(self,opcodes):
+        """Return True if opcodes is a list that ends by jumping to the end of
+        the function (e.g. with goto_end), which is how errors are handled"""
+        return (isinstance(opcodes,list) and bool(opcodes) and
+            isinstance(opcodes[-1],JumpSource) and opcodes[-1].target is self._end)
+
+    def outline(self,test,opcodes,resume=True):
+        """Get a conditional jump (using test) to opcodes, which are moved to
+        the cold section at the end of the function.
+
+        If resume is true, the moved code jumps back to right after the
+        conditional jump when it's done.
+
+        """
+        start = JumpTarget()
+        r = [JumpSource(partial(self.op.jcc,test),self.abi,start)]
+        self.cold.append(start)
+        self.cold += opcodes
+        if resume:
+            back = JumpTarget()
+            self.cold.append(self.goto(back))
+            r.append(back)
+        return r
+
+    def end_stub(self,clear_eax=False):
+        """Get the target of a block in the cold section that does what
+        goto_end does at the current stack depth, after setting %eax to zero if
+        clear_eax is true. The blocks are shared by every error check at the
+        same depth with the same items in registers."""
+        key = (self.stack.offset,
+            tuple((r,r in self.stack.borrowed) for r in self.stack.cached),
+            clear_eax)
+        t = self._end_stubs.get(key)
+        if t is None:
+            t = self._end_stubs[key] = JumpTarget()
+            self.cold.append(t)
+            if clear_eax: self.cold.append(self.op.xor(self.r_ret,self.r_ret))
+            self.cold += self.goto_end()
+        return t
+
     def invoke(self,func,*args):
-        return reduce(operator.concat,(self.stack.push_arg(raw_addr_if_str(a)) for a in args)) + self.stack.call(func)
+        return reduce(operator.concat,(self.stack.push_arg(self.raw_addr_if_str(a)) for a in args)) + self.stack.call(self.raw_addr_if_str(func))
 
     def _if_eax_is(self,test,opcodes):
+        if self.tuning.outline_cold_paths and self.is_exit(opcodes):
+            return [self.op.test(self.r_ret,self.r_ret)] + self.outline(test,opcodes,False)
+
         if isinstance(opcodes,(bytes,self.abi.ops.AsmSequence)):
             return [
                 self.op.test(self.r_ret,self.r_ret),
@@ -525,7 +1207,9 @@ class Frame:
         return JumpSource(self.op.jmp,self.abi,target)
 
     def goto_end(self):
-        return [self.op.lea(self.stack[0],self.r_pres[0]),JumpSource(self.op.jmp,self.abi,self._end)]
+        return self.stack.spill() + [
+            self.op.lea(self.stack[0],self.r_pres[0]),
+            JumpSource(self.op.jmp,self.abi,self._end)]
 
     def inc_or_add(self,x):
         return self.op.add(1,x) if self.tuning.prefer_addsub_over_incdec else self.op.inc(x)
@@ -567,34 +1251,133 @@ class Frame:
             return [self.op.mov(self.r_ret,self.TEMP_EAX)] + inv + [self.op.mov(self.TEMP_EAX,self.r_ret)] if preserve_eax else inv
 
         assert reg.reg != self.r_scratch[0].reg
+
+        dec = self.decl_or_subl(self.Address(pyinternals.REFCNT_OFFSET,reg))
+
+        if self.stubs is not None:
+            # the stub preserves %eax
+            mid = [self.stub_call('decref',reg.code)]
+            if self.tuning.outline_cold_paths:
+                return [dec] + self.outline(self.test_Z,mid)
+
+            after = JumpTarget()
+            return [dec,JumpSource(self.op.jnz,self.abi,after)] + mid + [after]
         
         mid = []
         
         if preserve_eax:
             mid.append(self.op.mov(self.r_ret,self.stack[-1]))
 
-        mid += [
-            self.op.mov(self.Address(pyinternals.TYPE_OFFSET,reg),self.r_pres[1]),
-        ]
-
-        mid += self.invoke(
-            self.Address(pyinternals.TYPE_DEALLOC_OFFSET,self.r_pres[1]),
-            reg)
-
-        if pyinternals.COUNT_ALLOCS:
-            mid += self.invoke('inc_count',self.r_pres[1])
+        mid += self.dealloc(reg)
         
         if preserve_eax:
             mid.append(self.op.mov(self.stack[-1],self.r_ret))
+
+        if self.tuning.outline_cold_paths:
+            return [dec] + self.outline(self.test_Z,mid)
         
         mid = join(mid)
         
         return [
-            self.decl_or_subl(self.Address(pyinternals.REFCNT_OFFSET,reg)),
+            dec,
             self.op.jnz(self.Displacement(len(mid))),
             mid
         ]
 
+    def pop_decref(self,preserve_eax = False):
+        """Remove the TOS item and release the reference to it, if it has one
+        (see StackManager.borrowed)"""
+        borrowed = self.stack.is_borrowed()
+        tos = self.stack.pop_item()
+        if borrowed: return []
+        r = []
+        if isinstance(tos,self.Address):
+            r.append(self.op.mov(tos,self.r_scratch[1]))
+            tos = self.r_scratch[1]
+        return r + self.decref(tos,preserve_eax)
+
+    def borrow(self,source):
+        """Use the reference of source (see StackManager.borrowed) for the TOS
+        item, which is in %eax, instead of increasing its reference count, if
+        tuning.borrow_references is true"""
+        if not self.tuning.borrow_references: return self.incref()
+        self.stack.borrow(source)
+        return []
+
+    def dealloc(self,reg):
+        """Call the deallocator of the object in reg, whose reference count
+        has reached zero"""
+        r = [self.op.mov(self.Address(pyinternals.TYPE_OFFSET,reg),self.r_pres[1])]
+
+        r += self.invoke(
+            self.Address(pyinternals.TYPE_DEALLOC_OFFSET,self.r_pres[1]),
+            reg)
+
+        if pyinternals.COUNT_ALLOCS:
+            r += self.invoke('inc_count',self.r_pres[1])
+
+        return r
+
+    def name_error(self,exc,msg,name):
+        """Set exception exc with a message made from format string msg and
+        the name 'name' (a string from the current code object)"""
+        if self.stubs is None:
+            return self.invoke('format_exc_check_arg',exc,msg,self.address_of(name))
+
+        return [
+            self.op.mov(self.address_of(name),self.r_pres[0]),
+            self.stub_call('name_error',exc,msg)]
+
+    def stub_call(self,*key):
+        return InnerCall(self.op,self.abi,self.stubs[key])
+
+    def stack_depth(self):
+        """The number of items on the stack, including the TOS item in %eax"""
+        if self.stack.offset is None: return None
+        return self.stack.offset + self.stack.tos_in_eax
+
+    def set_hint(self,hint):
+        """Associate hint with the TOS item"""
+        depth = self.stack_depth()
+        if depth is not None:
+            if hint is None:
+                self.hints.pop(depth,None)
+            else:
+                self.hints[depth] = hint
+
+    def get_hint(self,n=0):
+        """Get the hint associated with the nth item from the top"""
+        depth = self.stack_depth()
+        return None if depth is None else self.hints.get(depth - n)
+
+    def prune_hints(self):
+        depth = self.stack_depth()
+        if depth is None:
+            self.hints.clear()
+        else:
+            for d in [d for d in self.hints if d > depth]:
+                del self.hints[d]
+
+    def direct_call_target(self,arg):
+        """If the function that CALL_FUNCTION with argument arg is going to call
+        is probably compiled code in the same image, and a frame for it can be
+        created without any argument processing, return the code object.
+
+        The generated code still has to check that the function object really
+        has that code.
+
+        """
+        if self.function_starts is None or arg >> 8: return None
+
+        code = self.get_hint(arg)
+        if (isinstance(code,types.CodeType) and
+                id(code) in self.function_starts and
+                code.co_argcount == arg and
+                code.co_kwonlyargcount == 0 and
+                code.co_flags == (CO_OPTIMIZED | CO_NEWLOCALS | CO_NOFREE)):
+            return code
+        return None
+
     def rtarget(self):
         t = JumpTarget()
         self.rtargets[self.byte_offset] = t
@@ -623,8 +1406,40 @@ class Frame:
         self.forward_targets.append((at,t,pop))
         return t
 
-    def jump_to(self,op,max_size,to):
-        return JumpSource(op,self.abi,self.forward_target(to)) if to > self.byte_offset else JumpRSource(op,self.abi,max_size,self.reverse_target(to))
+    def jumps_here(self):
+        """Get the code that puts the targets of the jumps to the current byte
+        code offset, if there are any. This goes before the code of the
+        instruction at that offset."""
+        r = self()
+        if self.forward_targets and self.forward_targets[0][0] <= self.byte_offset:
+            pos,t,pop = self.forward_targets.pop(0)
+            assert pos == self.byte_offset
+            r.push_tos()(t)
+            if pop:
+                r.pop_stack(self.r_scratch[1]).decref(self.r_scratch[1])
+        if self.byte_offset in self.loop_starts:
+            r.push_tos()(self.rtarget())
+        return r
+
+    def neighbour(self,n):
+        """Get the instruction n places after the current one (before it if n
+        is negative), or None if it isn't in the same basic block. Nothing jumps
+        between instructions of the same block, so they always run in order."""
+        i = self.block_index + n
+        return self.block[i] if 0 <= i < len(self.block) else None
+
+    def continue_with(self,ins):
+        """Prepare for generating the code of the instruction after the
+        current one, ins, as part of the current handler (the next instruction
+        of a basic block is never a jump target)"""
+        self.byte_offset = ins.offset
+        self.next_byte_offset = ins.next
+        self.skip_to = ins.next
+        self.stack.current_pos(ins.offset)
+        self.prune_hints()
+
+    def jump_to(self,op,to):
+        return JumpSource(op,self.abi,self.forward_target(to) if to > self.byte_offset else self.reverse_target(to))
 
     def __call__(self):
         return Stitch(self)
@@ -642,6 +1457,9 @@ for x in (
         'test_NE',
         'test_NZ',
         'test_L',
+        'test_LE',
+        'test_G',
+        'test_GE',
         'CALL_DISP_LEN',
         'JCC_MIN_LEN',
         'JCC_MAX_LEN',
@@ -669,7 +1487,7 @@ def arg1_as_subscr(func):
 
 
 def strs_to_addrs(func):
-    return lambda *args: func(*map(raw_addr_if_str,args))
+    return lambda self,*args: func(self,*map(self.f.raw_addr_if_str,args))
 
 
 def destitch(x):
@@ -694,12 +1512,20 @@ class Stitch:
         self.code.append(self.f.stack.push_stack(x))
         return self
 
+    def flush_stack(self,keep=0):
+        self.code += self.f.stack.flush(keep)
+        return self
+
+    def own_stack(self,test=None):
+        self.code += self.f.stack.own(test)
+        return self
+
     def pop_stack(self,x):
         self.code.append(self.f.stack.pop_stack(x))
         return self
 
     def push_arg(self,x,*args,**kwds):
-        self.code += self.f.stack.push_arg(raw_addr_if_str(x),*args,**kwds)
+        self.code += self.f.stack.push_arg(self.f.raw_addr_if_str(x),*args,**kwds)
         return self
 
     def clear_args(self):
@@ -711,7 +1537,7 @@ class Stitch:
         return self
 
     def call(self,x):
-        self.code += self.f.stack.call(x)
+        self.code += self.f.stack.call(self.f.raw_addr_if_str(x))
         return self
 
     @strs_to_addrs
@@ -768,7 +1594,10 @@ class Stitch:
 
     @arg1_as_subscr
     def if_cond(self,test,opcodes):
-        if isinstance(opcodes,(bytes,self.f.abi.ops.AsmSequence)):
+        opcodes = destitch(opcodes)
+        if self.f.tuning.outline_cold_paths and self.f.is_exit(opcodes):
+            self.code += self.f.outline(test,opcodes,False)
+        elif isinstance(opcodes,(bytes,self.f.abi.ops.AsmSequence)):
             self.code += [
                 self.f.op.jcc(~test,self.f.Displacement(len(opcodes))),
                 opcodes]
@@ -776,7 +1605,7 @@ class Stitch:
             after = JumpTarget()
             self.code += [
                 JumpSource(partial(self.f.op.jcc,~test),self.f.abi,after)
-            ] + destitch(opcodes) + [
+            ] + opcodes + [
                 after
             ]
 
@@ -807,9 +1636,8 @@ class Stitch:
 
     def __getattr__(self,name):
         func = getattr(self.f.op,name)
-        @strs_to_addrs
         def inner(*args):
-            self.code.append(func(*args))
+            self.code.append(func(*map(self.f.raw_addr_if_str,args)))
             return self
         return inner
 
@@ -829,127 +1657,354 @@ for func in [
     'invoke',
     'incref',
     'decref',
-    'goto_end']:
+    'pop_decref',
+    'borrow',
+    'goto_end',
+    'name_error']:
     setattr(Stitch,func,_forward_list_func(getattr(Frame,func)))
 
 
 
+# The number functions that have an inline version for int objects with at
+# most one digit, and the instruction that does the same thing to their values
+SMALL_INT_OPS = {
+    'PyNumber_Add' : 'add',
+    'PyNumber_InPlaceAdd' : 'add',
+    'PyNumber_Subtract' : 'sub',
+    'PyNumber_InPlaceSubtract' : 'sub',
+    'PyNumber_Multiply' : 'imul',
+    'PyNumber_InPlaceMultiply' : 'imul',
+    'PyNumber_Lshift' : 'shl',
+    'PyNumber_InPlaceLshift' : 'shl',
+    'PyNumber_Rshift' : 'sar',
+    'PyNumber_InPlaceRshift' : 'sar',
+    'PyNumber_And' : 'and',
+    'PyNumber_InPlaceAnd' : 'and',
+    'PyNumber_Xor' : 'xor',
+    'PyNumber_InPlaceXor' : 'xor',
+    'PyNumber_Or' : 'or',
+    'PyNumber_InPlaceOr' : 'or'}
+
+def small_int_op(f,func):
+    """Get the instruction for the inline version of number function func, or
+    None if it doesn't have one or it can't be used (see small_ints_inline)"""
+    if not small_ints_inline(f): return None
+    return SMALL_INT_OPS.get(func)
+
+def small_ints_inline(f):
+    """Whether operations on small ints can be done inline.
+
+    The values of single-digit ints are loaded into 64-bit registers, which
+    can't overflow when adding, subtracting or multiplying two of them. This
+    needs 30-bit digits and an ABI with 64-bit registers.
+
+    """
+    return f.tuning.inline_int_ops and f.ptr_size == 8 and pyinternals.LONG_SHIFT == 30
+
+def _small_int_values(f,a,b,generic):
+    """Get the code that puts the values of int objects a and b into %eax and
+    the third argument register, and those registers, or jumps to generic if
+    either isn't exactly an int with at most one digit"""
+    r = f()
+    t = f.r_scratch[0]
+    tmp = f.r_scratch[1]
+    vals = f.r_ret,f.abi.r_arg[2]
+
+    objs = []
+    for x,reg in zip((a,b),f.abi.r_arg):
+        if not isinstance(x,f.Register):
+            r.mov(x,reg)
+            x = reg
+        objs.append(x)
+
+    r.mov('PyLong_Type',t)
+    for obj in objs:
+        (r
+            .cmp(t,f.Address(pyinternals.TYPE_OFFSET,obj))
+            (JumpSource(f.op.jne,f.abi,generic)))
+
+    for obj,val in zip(objs,vals):
+        # the size is -1, 0 or 1 and the value is the size times the digit
+        # (zero doesn't have a digit, so it isn't read)
+        (r
+            .mov(f.Address(pyinternals.VAR_SIZE_OFFSET,obj),val)
+            .lea(f.Address(1,val),tmp)
+            .cmp(2,tmp)
+            (JumpSource(f.op.ja,f.abi,generic))
+            .test(val,val)
+            .if_cond[f.test_NZ](f()
+                .mov(f.Address(pyinternals.LONG_DIGIT_OFFSET,obj),f.Register(f.abi.ops.SIZE_D,tmp.code))
+                .imul(tmp,val)))
+
+    return r,vals
+
+def _small_int_op(f,op,a,b,generic):
+    """Do instruction op with the values of int objects a and b and create an
+    int object with the result, or jump to generic if either isn't exactly an
+    int with at most one digit or the result might not fit in a register"""
+    r,vals = _small_int_values(f,a,b,generic)
+
+    if op in ('shl','sar'):
+        # the shift amount must be in %cl and the instructions only use the
+        # lowest 6 bits of it
+        limit = 63 - pyinternals.LONG_SHIFT - 1 if op == 'shl' else 63
+        (r
+            .cmp(limit,vals[1])
+            (JumpSource(f.op.ja,f.abi,generic))
+            .mov(vals[1],f.abi.ops.rcx)
+            (getattr(f.op,op)(f.abi.ops.cl,vals[0])))
+    else:
+        r(getattr(f.op,op)(vals[1],vals[0]))
+
+    return r.invoke('PyLong_FromSsize_t',vals[0])
+
 def _binary_op(f,func):
+    op = small_int_op(f,func)
     tos = f.stack.tos()
-    return (f()
-        .push_tos()
-        .invoke(func,f.stack[1],tos)
+    r = f().push_tos()
+
+    if op is not None:
+        generic = JumpTarget()
+        done = JumpTarget()
+        tos = f.stack.item(0)
+        r += _small_int_op(f,op,f.stack.item(1),tos,generic)
+        r.goto(done)(generic)
+
+    r.invoke(func,f.stack.item(1),tos)
+
+    if op is not None:
+        r(done)
+
+    return (r
         .check_err()
-        .mov(f.stack[1],f.r_scratch[1])
-        .mov(f.r_ret,f.stack[1])
-        .decref(f.r_scratch[1])
-        .pop_stack(f.r_scratch[1])
-        .decref(f.r_scratch[1])
+        .pop_decref(True)
+        .pop_decref(True)
+
+        # the result, in %eax, takes the place of the operands
+        .push_tos(True)
     )
 
+# The most values a float expression can have at once. They are kept in %xmm0
+# to %xmm4 and %xmm5 is used to check for division by zero. No ABI preserves
+# these across calls.
+FLOAT_EXPR_REGS = 5
+
+def float_expression(f,expr,handler):
+    """Generate the code of a float expression (see floatexpr.py), which
+    computes it without creating objects for the intermediate values if the
+    local variables it uses are floats and does what the instructions normally
+    do otherwise.
+
+    The stack items are moved to memory first, so that both versions start
+    and end with the same items in the same places.
+
+    """
+    first = expr.instructions[0]
+    f.byte_offset = first.offset
+    f.next_byte_offset = first.next
+    f.stack.caching = False
+    r = f().flush_stack().own_stack().push_tos()
+    r += f.jumps_here()
+    f.stack.current_pos(f.byte_offset)
+    offset = f.stack.offset
+    if isinstance(f.op,f.abi.ops.Assembly):
+        r.comment('float expression')
+
+    generic = JumpTarget()
+    done = JumpTarget()
+    xmm = [f.abi.ops.XMMRegister(i) for i in range(FLOAT_EXPR_REGS + 1)]
+    fast_locals = f.r_scratch[0]
+    obj = f.r_scratch[1]
+    float_type = f.abi.r_arg[0]
+
+    if any(ins.op == floatexpr.LOAD_FAST for ins in expr.instructions):
+        r.mov(f.FAST_LOCALS,fast_locals).mov('PyFloat_Type',float_type)
+
+    depth = 0
+    for ins in expr.instructions:
+        if ins.op == floatexpr.LOAD_FAST:
+            # unbound variables and anything but exactly float go to the
+            # normal version
+            (r
+                .mov(f.Address(f.ptr_size*ins.arg,fast_locals),obj)
+                .test(obj,obj)
+                (JumpSource(f.op.jz,f.abi,generic))
+                .cmp(float_type,f.Address(pyinternals.TYPE_OFFSET,obj))
+                (JumpSource(f.op.jne,f.abi,generic))
+                .movsd(f.Address(pyinternals.FLOAT_VAL_OFFSET,obj),xmm[depth]))
+            depth += 1
+        elif ins.op == floatexpr.LOAD_CONST:
+            c = f.code.co_consts[ins.arg]
+            if type(c) is float:
+                (r
+                    .mov(f.address_of(c),obj)
+                    .movsd(f.Address(pyinternals.FLOAT_VAL_OFFSET,obj),xmm[depth]))
+            else:
+                r.mov(c,obj).cvtsi2sd(obj,xmm[depth])
+            depth += 1
+        else:
+            depth -= 1
+            name = floatexpr.OPERATIONS[ins.op]
+            if name == 'divsd':
+                # division by zero raises an exception instead of giving
+                # infinity (NaN also compares equal to zero here, which only
+                # means the normal version is used)
+                (r
+                    .xorpd(xmm[-1],xmm[-1])
+                    .ucomisd(xmm[-1],xmm[depth])
+                    (JumpSource(f.op.je,f.abi,generic)))
+            getattr(r,name)(xmm[depth],xmm[depth-1])
+
+    (r
+        # the value is already in %xmm0, where the argument goes
+        .call('PyFloat_FromDouble')
+        .check_err()
+        .goto(done)
+    (generic))
+
+    # If the expression is at the start of a loop, the loop's reverse target
+    # was put before the fast version above. The handler of the first
+    # instruction must not replace it with one in the normal version, or the
+    # jumps back to the start of the loop would skip the fast version.
+    loop_starts = f.loop_starts
+    f.loop_starts = loop_starts - {first.offset}
+    for ins in expr.instructions:
+        f.byte_offset = ins.offset
+        f.next_byte_offset = ins.next
+        if ins.arg is None:
+            r += handler(ins.op)(f)
+        else:
+            r += handler(ins.op)(f,ins.arg)
+    f.loop_starts = loop_starts
+
+    # the result is in %eax either way
+    assert f.stack.tos_in_eax and not f.stack.cached and f.stack.offset == offset
+    return r(done)
+
 @handler
+@uses_stack_cache
 def _op_BINARY_MULTIPLY(f):
     return _binary_op(f,'PyNumber_Multiply')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_TRUE_DIVIDE(f):
     return _binary_op(f,'PyNumber_TrueDivide')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_FLOOR_DIVIDE(f):
     return _binary_op(f,'PyNumber_FloorDivide')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_ADD(f):
     # TODO: implement the optimization that ceval.c uses for unicode strings
     return _binary_op(f,'PyNumber_Add')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_SUBTRACT(f):
     return _binary_op(f,'PyNumber_Subtract')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_SUBSCR(f):
     return _binary_op(f,'PyObject_GetItem')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_LSHIFT(f):
     return _binary_op(f,'PyNumber_Lshift')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_RSHIFT(f):
     return _binary_op(f,'PyNumber_Rshift')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_AND(f):
     return _binary_op(f,'PyNumber_And')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_XOR(f):
     return _binary_op(f,'PyNumber_Xor')
 
 @handler
+@uses_stack_cache
 def _op_BINARY_OR(f):
     return _binary_op(f,'PyNumber_Or')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_MULTIPLY(f):
     return _binary_op(f,'PyNumber_InPlaceMultiply')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_TRUE_DIVIDE(f):
     return _binary_op(f,'PyNumber_InPlaceTrueDivide')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_FLOOR_DIVIDE(f):
     return _binary_op(f,'PyNumber_InPlaceFloorDivide')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_MODULO(f):
     return _binary_op(f,'PyNumber_InPlaceRemainder')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_ADD(f):
     # TODO: implement the optimization that ceval.c uses for unicode strings
     return _binary_op(f,'PyNumber_InPlaceAdd')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_SUBTRACT(f):
     return _binary_op(f,'PyNumber_InPlaceSubtract')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_LSHIFT(f):
     return _binary_op(f,'PyNumber_InPlaceLshift')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_RSHIFT(f):
     return _binary_op(f,'PyNumber_InPlaceRshift')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_AND(f):
     return _binary_op(f,'PyNumber_InPlaceAnd')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_XOR(f):
     return _binary_op(f,'PyNumber_InPlaceXor')
 
 @handler
+@uses_stack_cache
 def _op_INPLACE_OR(f):
     return _binary_op(f,'PyNumber_InPlaceOr')
 
 
 @handler
+@uses_stack_cache
 def _op_POP_TOP(f):
-    r = f.decref()
-    if not f.stack.use_tos():
-        r.insert(0,f.stack.pop_stack(f.r_ret))
-    return r
+    return f.pop_decref()
 
 @hasname
+@uses_stack_cache
 def _op_LOAD_NAME(f,name):
     return (f()
         .push_tos(True)
-        .mov(address_of(name),f.r_pres[0])
+        .mov(f.address_of(name),f.r_pres[0])
         (InnerCall(f.op,f.abi,f.local_name))
         .check_err()
         .incref()
@@ -961,7 +2016,7 @@ def _op_STORE_NAME(f,name):
     return (f()
         .push_tos()
         .push_arg(tos,n=2)
-        .push_arg(address_of(name),n=1)
+        .push_arg(f.address_of(name),n=1)
         .mov(f.LOCALS,f.r_ret)
         .if_eax_is_zero(f()
             .clear_args()
@@ -972,7 +2027,7 @@ def _op_STORE_NAME(f,name):
         .cmpl('PyDict_Type',f.Address(pyinternals.TYPE_OFFSET,f.r_ret))
         .push_arg(f.r_ret,n=0)
         .if_cond[f.test_E](
-            f.op.mov(pyinternals.raw_addresses['PyDict_SetItem'],f.r_scratch[0])
+            f.op.mov(f.raw_address('PyDict_SetItem'),f.r_scratch[0])
         )
         .call(f.r_scratch[0])
         .check_err(True)
@@ -989,35 +2044,34 @@ def _op_DELETE_NAME(f,name):
             .invoke('PyErr_Format',
                 'PyExc_SystemError',
                 'NO_LOCALS_DELETE_MSG',
-                address_of(name))
+                f.address_of(name))
             .goto_end()
         )
-        .invoke('PyObject_DelItem',f.r_ret,address_of(name))
+        .invoke('PyObject_DelItem',f.r_ret,f.address_of(name))
         .if_eax_is_zero(f()
-            .invoke('format_exc_check_arg',
-                'PyExc_NameError',
-                'NAME_ERROR_MSG',
-                address_of(name))
+            .name_error('PyExc_NameError','NAME_ERROR_MSG',name)
             .goto_end()
         )
     )
 
 @hasname
+@uses_stack_cache
+@keeps_borrowed()
 def _op_LOAD_GLOBAL(f,name):
-    return (f()
-        .push_tos(True)
-        .invoke('PyDict_GetItem',f.GLOBALS,address_of(name))
+    r = f().push_tos(True)
+    if f.resolver is not None:
+        f.set_hint(f.resolver.global_ref(f.code,name))
+
+    return (r
+        .invoke('PyDict_GetItem',f.GLOBALS,f.address_of(name))
         .if_eax_is_zero(f()
-            .invoke('PyDict_GetItem',f.BUILTINS,address_of(name))
+            .invoke('PyDict_GetItem',f.BUILTINS,f.address_of(name))
             .if_eax_is_zero(f()
-                .invoke('format_exc_check_arg',
-                     'PyExc_NameError',
-                     'GLOBAL_NAME_ERROR_MSG',
-                     address_of(name))
+                .name_error('PyExc_NameError','GLOBAL_NAME_ERROR_MSG',name)
                 .goto_end()
             )
         )
-        .incref()
+        .borrow(('global',))
     )
 
 @hasname
@@ -1025,33 +2079,69 @@ def _op_STORE_GLOBAL(f,name):
     tos = f.stack.tos()
     return (f()
         .push_tos()
-        .invoke('PyDict_SetItem',f.GLOBALS,address_of(name),tos)
+        .invoke('PyDict_SetItem',f.GLOBALS,f.address_of(name),tos)
         .check_err(True)
         .pop_stack(f.r_ret)
         .decref()
     )
 
 @hasconst
+@uses_stack_cache
+@keeps_borrowed()
 def _op_LOAD_CONST(f,const):
+    r = f().push_tos(True)
     if isinstance(const,types.CodeType):
-        const = f.entry_points[id(const)][0]
+        return r.mov(f.entry_point_address(const),f.r_ret).incref()
 
-    return (f()
-        .push_tos(True)
-        .mov(address_of(const),f.r_ret)
-        .incref()
-    )
+    # co_consts keeps the constant alive for as long as the code runs
+    return r.mov(f.address_of(const),f.r_ret).borrow(('const',))
 
 @handler
 def _op_CALL_FUNCTION(f,arg):
+    target = f.direct_call_target(arg)
     argreg = f.stack.arg_reg(n=0)
-    return (f()
-        .push_tos(True)
+    r = f().push_tos(True)
+
+    if target is not None:
+        # The function is probably compiled code in the same image. If it is,
+        # create its frame and call its code directly.
+
+        generic = JumpTarget()
+        done = JumpTarget()
+        frame = f.r_pres[0]
+        ret = f.r_pres[1]
+
+        (r
+            .lea(f.stack[0],argreg)
+            .invoke('_direct_frame',argreg,arg,f.entry_point_address(target))
+            .test(f.r_ret,f.r_ret)
+            (JumpSource(f.op.jz,f.abi,generic))
+            .mov(f.r_ret,frame)
+            .push_arg(frame,n=0)
+            (InnerCall(f.op,f.abi,f.function_starts[id(target)]))
+            .clear_args()
+            .mov(f.r_ret,ret)
+            .lea(f.stack[0],f.r_scratch[0])
+            .invoke('_direct_finish',frame,f.r_scratch[0],arg)
+            .mov(ret,f.r_ret)
+            .goto(done)
+        (generic)
+
+            # the frame couldn't be created
+            .call('PyErr_Occurred')
+            .check_err(True)
+        )
+
+    r = (r
         .push_arg(arg,n=1)
         .lea(f.stack[0],argreg)
         .push_arg(argreg,n=0)
-        .call('call_function')
+        .call('call_function'))
+
+    if target is not None:
+        r(done)
 
+    return (r
         # +1 for the function object
         .add_to_stack(-((arg & 0xFF) + ((arg >> 8) & 0xFF) * 2 + 1))
 
@@ -1059,8 +2149,15 @@ def _op_CALL_FUNCTION(f,arg):
     )
 
 @handler
+@uses_stack_cache
 def _op_RETURN_VALUE(f):
-    return f().goto_end() if f.stack.use_tos() else f().pop_stack(f.r_ret).goto_end()
+    r = f()
+    borrowed = f.stack.is_borrowed()
+    if not f.stack.use_tos():
+        r.mov(f.stack.pop_item(),f.r_ret)
+    if borrowed:
+        r.incref()
+    return r.goto_end()
 
 @handler
 def _op_SETUP_LOOP(f,to):
@@ -1108,20 +2205,22 @@ def _op_FOR_ITER(f,to):
 @handler
 def _op_JUMP_ABSOLUTE(f,to):
     assert to < f.byte_offset
-    return f().push_tos()(
-        JumpRSource(f.op.jmp,f.abi,f.JMP_DISP_MAX_LEN,f.reverse_target(to)))
+    return f().push_tos().goto(f.reverse_target(to))
 
 @hasname
+@uses_stack_cache
 def _op_LOAD_ATTR(f,name):
     tos = f.stack.tos()
-    return (f()
+    hint = f.get_hint()
+    r = (f()
         .push_tos()
-        .invoke('PyObject_GetAttr',tos,address_of(name))
+        .invoke('PyObject_GetAttr',tos,f.address_of(name))
         .check_err()
-        .pop_stack(f.r_scratch[1])
-        .push_stack(f.r_ret)
-        .decref(f.r_scratch[1])
+        .pop_decref(True)
+        .push_tos(True)
     )
+    f.set_hint(hint and f.resolver.attr_ref(hint,name))
+    return r
 
 def _op_pop_jump_if_(f,to,state):
     dont_jump = JumpTarget()
@@ -1130,26 +2229,40 @@ def _op_pop_jump_if_(f,to,state):
     r = (f()
         .push_tos()
         .invoke('PyObject_IsTrue',tos)
-        .pop_stack(f.r_scratch[1])
-        .decref(f.r_scratch[1],True)
+        .pop_decref(True)
+
+        # both ways go to code that expects the stack to be in memory
+        .flush_stack()
         .test(f.r_ret,f.r_ret)
-        (JumpSource(jop1,f.abi,dont_jump))
-        (f.jump_to(jop2,f.JCC_MAX_LEN,to))
-        .mov(0,f.r_ret)
-        .goto_end()
-        (dont_jump)
     )
 
+    if f.tuning.outline_cold_paths:
+        # PyObject_IsTrue returns -1 on error
+        (r
+            (JumpSource(partial(f.op.jcc,f.test_L),f.abi,f.end_stub(True)))
+            (f.jump_to(f.op.jnz if state else f.op.jz,to))
+        )
+    else:
+        (r
+            (JumpSource(jop1,f.abi,dont_jump))
+            (f.jump_to(jop2,to))
+            .mov(0,f.r_ret)
+            .goto_end()
+            (dont_jump)
+        )
+
     if to > f.byte_offset:
         f.stack.conditional_jump(to)
 
     return r
 
 @handler
+@uses_stack_cache
 def _op_POP_JUMP_IF_FALSE(f,to):
     return _op_pop_jump_if_(f,to,False)
 
 @handler
+@uses_stack_cache
 def _op_POP_JUMP_IF_TRUE(f,to):
     return _op_pop_jump_if_(f,to,True)
 
@@ -1162,7 +2275,6 @@ def _op_BUILD_(f,items,new,item_offset,deref):
     if items:
         if items >= f.tuning.build_seq_loop_threshhold:
             top = f.stack[0]
-            top.scale = 4
             if deref:
                 f.stack.tos_in_eax = False
                 (r
@@ -1171,7 +2283,7 @@ def _op_BUILD_(f,items,new,item_offset,deref):
                     .mov(0,f.r_ret)
                 )
 
-                top.index = f.r_ret
+                top = top.replace(index=f.r_ret,scale=4)
 
                 lbody = (
                     f.op.mov(top,f.r_scratch[1]) +
@@ -1180,7 +2292,7 @@ def _op_BUILD_(f,items,new,item_offset,deref):
             else:
                 r.mov(0,f.r_pres[0])
 
-                top.index = f.r_pres[0]
+                top = top.replace(index=f.r_pres[0],scale=4)
 
                 lbody = (
                     f.op.mov(top,f.r_scratch[1]) +
@@ -1254,26 +2366,33 @@ def _op_MAKE_CLOSURE(f,arg):
     return _op_make_callable(f,arg,True)
 
 @handler
+@uses_stack_cache
+@keeps_borrowed()
 def _op_LOAD_FAST(f,arg):
     return (f()
         .push_tos(True)
         .mov(f.FAST_LOCALS,f.r_scratch[0])
         .mov(f.Address(f.ptr_size*arg,f.r_scratch[0]),f.r_ret)
         .if_eax_is_zero(f()
-            .invoke('format_exc_check_arg',
-                'PyExc_UnboundLocalError',
-                'UNBOUNDLOCAL_ERROR_MSG',
-                address_of(f.code.co_varnames[arg]))
+            .name_error('PyExc_UnboundLocalError','UNBOUNDLOCAL_ERROR_MSG',f.code.co_varnames[arg])
             .goto_end()
         )
-        .incref()
+        .borrow(('fast',arg))
     )
 
 @handler
+@uses_stack_cache
 def _op_STORE_FAST(f,arg):
     r = f()
+    borrowed = f.stack.is_borrowed()
     if not f.stack.use_tos():
-        r.pop_stack(f.r_ret)
+        r.mov(f.stack.pop_item(),f.r_ret)
+    if borrowed:
+        r.incref()
+
+    # the items borrowed from the variable need their own references before
+    # it changes
+    r.own_stack(lambda source: source == ('fast',arg))
 
     item = f.Address(f.ptr_size*arg,f.r_scratch[0])
     return (r
@@ -1282,7 +2401,7 @@ def _op_STORE_FAST(f,arg):
         .mov(f.r_ret,item)
         .test(f.r_scratch[1],f.r_scratch[1])
         .if_cond[f.test_NZ](
-            join(f.decref(f.r_scratch[1]))
+            f.decref(f.r_scratch[1])
         )
     )
 
@@ -1301,7 +2420,6 @@ def _op_UNPACK_SEQUENCE(f,arg):
     done = JumpTarget()
 
     s_top = f.stack[-1]
-    s_top.scale = f.ptr_size
 
     # a place to temporarily store the sequence
     seq_store = f.stack[-1-arg]
@@ -1314,7 +2432,7 @@ def _op_UNPACK_SEQUENCE(f,arg):
             (JumpSource(f.op.jne,f.abi,else_)))
 
     if arg >= f.tuning.unpack_seq_loop_threshhold:
-        s_top.index = f.r_ret
+        s_top = s_top.replace(index=f.r_ret,scale=f.ptr_size)
         body = join(f()
             .mov(f.Address(pyinternals.TUPLE_ITEM_OFFSET-f.ptr_size,f.r_pres[0],f.r_scratch[0],f.ptr_size),f.r_scratch[1])
             .incref(f.r_scratch[1])
@@ -1347,7 +2465,7 @@ def _op_UNPACK_SEQUENCE(f,arg):
                 .mov(f.Address(pyinternals.LIST_ITEM_OFFSET,f.r_pres[0]),f.r_scratch[1]))
     
     if arg >= f.tuning.unpack_seq_loop_threshhold:
-        s_top.index = f.r_pres[0]
+        s_top = s_top.replace(index=f.r_pres[0],scale=f.ptr_size)
         body = join(f()
             .mov(f.Address(-f.ptr_size,f.r_scratch[1],f.r_scratch[0],f.ptr_size),f.r_ret)
             .incref(f.r_ret)
@@ -1410,54 +2528,282 @@ def _op_UNPACK_EX(f,arg):
         )
     )
 
-def false_true_addr(swap):
+def false_true_addr(f,swap):
     return map(
-        pyinternals.raw_addresses.__getitem__,
+        f.raw_address,
         ('Py_True','Py_False') if swap else ('Py_False','Py_True'))
 
+POP_JUMP_IF = {
+    dis.opmap['POP_JUMP_IF_FALSE'] : False,
+    dis.opmap['POP_JUMP_IF_TRUE'] : True}
+
+LOAD_CONST = dis.opmap['LOAD_CONST']
+
+# instructions that push one item without popping any
+LOADS = frozenset(dis.opmap[x] for x in [
+    'LOAD_FAST','LOAD_CONST','LOAD_GLOBAL','LOAD_NAME','LOAD_DEREF'])
+
+# the comparisons that can be done with the values of small ints and the
+# tests that are true when they are
+INT_COMPARE_TESTS = {
+    '<' : 'test_L',
+    '<=' : 'test_LE',
+    '==' : 'test_E',
+    '!=' : 'test_NE',
+    '>' : 'test_G',
+    '>=' : 'test_GE'}
+
+NAME_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+def compared_consts(f):
+    """Get the constants that the current COMPARE_OP compares, as far as can
+    be told from the instructions before it in the same basic block"""
+    r = []
+    b = f.neighbour(-1)
+    if b is None or b.op not in LOADS: return r
+    if b.op == LOAD_CONST: r.append(f.code.co_consts[b.arg])
+    a = f.neighbour(-2)
+    if a is not None and a.op == LOAD_CONST: r.append(f.code.co_consts[a.arg])
+    return r
+
+def interned_const(c):
+    """Whether c is a str constant that the Python compiler interns"""
+    return type(c) is str and all(x in NAME_CHARS for x in c)
+
+def _fast_or_generic(f,fast,generic):
+    """Get the code of fast, a function that takes the target to jump to when
+    it can't be used and the target to jump to when it's done, followed by the
+    code of generic, which is what runs when it can't. Both are generated
+    starting with the same stack state and must leave it the same way."""
+    state = f.stack.state()
+    pos = f.byte_offset,f.next_byte_offset
+    use_generic = JumpTarget()
+    done = JumpTarget()
+    r = fast(use_generic,done)
+    end = f.stack.state()
+
+    f.stack.restore(state)
+    f.byte_offset,f.next_byte_offset = pos
+    r(use_generic)
+    r += generic()
+    assert f.stack.state() == end
+    return r(done)
+
+def _pop_operands(f):
+    """Remove the two items that a comparison uses from the stack and get a
+    function that generates the code that releases them.
+
+    Each way the comparison can go needs its own copy of this code. The items
+    must not be in %eax or scratch registers, which releasing the first one
+    doesn't preserve.
+
+    """
+    b_borrowed = f.stack.is_borrowed()
+    b = f.stack.pop_item()
+    a_borrowed = f.stack.is_borrowed()
+    a = f.stack.pop_item()
+
+    def release():
+        r = f()
+        for x,borrowed in ((b,b_borrowed),(a,a_borrowed)):
+            if borrowed: continue
+            if isinstance(x,f.Address):
+                r.mov(x,f.r_scratch[1])
+                x = f.r_scratch[1]
+            r.decref(x)
+        return r
+
+    return release
+
+def _compare_jump(f,test,jump,release):
+    """Get the code that does what POP_JUMP_IF_FALSE or POP_JUMP_IF_TRUE
+    instruction 'jump' does with the result of a comparison, if test is true
+    for the flags the comparison set when its result is true. release is what
+    _pop_operands returned."""
+    to = jump.target
+    if not POP_JUMP_IF[jump.op]: test = ~test
+    f.continue_with(jump)
+
+    r = f()
+    first = release()
+    if first.code:
+        stay = JumpTarget()
+        r(JumpSource(partial(f.op.jcc,~test),f.abi,stay))
+        r += first
+        r(f.jump_to(f.op.jmp,to))(stay)
+        r += release()
+    else:
+        r(f.jump_to(partial(f.op.jcc,test),to))
+
+    if to > f.byte_offset:
+        f.stack.conditional_jump(to)
+
+    return r
+
+def _generic_compare_jump(f,arg,jump):
+    r = f()
+    r += _compare(f,arg)
+    f.continue_with(jump)
+    r.own_stack(is_global_ref)
+    return r + _op_pop_jump_if_(f,jump.target,POP_JUMP_IF[jump.op])
+
+def _identity_jump(f,op,jump):
+    """'is' or 'is not' followed by a conditional jump, which is done by
+    comparing the addresses"""
+    r = f().push_tos().flush_stack(2)
+    if not (f.stack.is_borrowed() and f.stack.is_borrowed(1)):
+        # releasing an operand can run any code, which can remove the
+        # borrowed globals from their dicts
+        r.own_stack(is_global_ref)
+
+    b = f.stack.item(0)
+    if not isinstance(b,f.Register):
+        r.mov(b,f.r_scratch[1])
+        b = f.r_scratch[1]
+    r.cmp(b,f.stack.item(1))
+
+    return r + _compare_jump(
+        f,
+        f.test_E if op == 'is' else f.test_NE,
+        jump,
+        _pop_operands(f))
+
+def _small_int_compare_jump(f,arg,jump):
+    """A comparison followed by a conditional jump, which compares the values
+    of the operands directly if they are ints with at most one digit"""
+    test = getattr(f,INT_COMPARE_TESTS[dis.cmp_op[arg]])
+    r = f().push_tos().flush_stack(2)
+    a = f.stack.item(1)
+    b = f.stack.item(0)
+
+    def fast(generic,done):
+        s,vals = _small_int_values(f,a,b,generic)
+        s.cmp(vals[1],vals[0])
+        s += _compare_jump(f,test,jump,_pop_operands(f))
+        return s.goto(done)
+
+    return r + _fast_or_generic(f,fast,partial(_generic_compare_jump,f,arg,jump))
+
+def _str_const_compare(f,arg,jump):
+    """== or != with an interned str constant, optionally followed by a
+    conditional jump. The other operand is often the same object (strings
+    that look like identifiers are interned too), which has to be equal to
+    itself. Otherwise, the normal comparison is done."""
+    equal = dis.cmp_op[arg] == '=='
+    r = f()
+    if jump: r.push_tos().flush_stack(2)
+    a = f.stack.item(1)
+    b = f.stack.item(0)
+
+    def fast(generic,done):
+        s = f()
+        b_reg = b
+        if not isinstance(b,f.Register):
+            s.mov(b,f.r_scratch[1])
+            b_reg = f.r_scratch[1]
+        s.cmp(b_reg,a)
+
+        if not jump:
+            return (s
+                (JumpSource(f.op.jne,f.abi,generic))
+                .pop_decref(True)
+                .pop_decref(True)
+                .mov('Py_True' if equal else 'Py_False',f.r_ret)
+                .incref()
+                .push_tos(True)
+                .goto(done))
+
+        release = _pop_operands(f)()
+        f.continue_with(jump)
+        to = jump.target
+        taken = equal == POP_JUMP_IF[jump.op]
+        if taken and to > f.byte_offset:
+            f.stack.conditional_jump(to)
+
+        if not release.code:
+            # the generic version comes right after this
+            return s(f.jump_to(f.op.je,to) if taken else JumpSource(f.op.je,f.abi,done))
+
+        s(JumpSource(f.op.jne,f.abi,generic))
+        s += release
+        return s(f.jump_to(f.op.jmp,to) if taken else f.goto(done))
+
+    if jump:
+        generic = partial(_generic_compare_jump,f,arg,jump)
+    else:
+        generic = partial(_compare,f,arg)
+    return r + _fast_or_generic(f,fast,generic)
+
 @handler
+@uses_stack_cache
+@keeps_borrowed(lambda arg: dis.cmp_op[arg] in ('is','is not'))
 def _op_COMPARE_OP(f,arg):
     op = dis.cmp_op[arg]
 
+    # when a conditional jump uses the result, the two can be done together
+    # without creating a bool object, at least for some operands
+    jump = f.neighbour(1)
+    if not (f.tuning.fuse_compare_jumps and jump is not None and jump.op in POP_JUMP_IF):
+        jump = None
+
+    consts = compared_consts(f)
+    if op == 'is' or op == 'is not':
+        if jump: return _identity_jump(f,op,jump)
+    elif op in ('==','!=') and f.tuning.inline_str_eq and any(map(interned_const,consts)):
+        return _str_const_compare(f,arg,jump)
+    elif (jump and op in INT_COMPARE_TESTS and small_ints_inline(f)
+            and all(type(c) is int for c in consts)):
+        return _small_int_compare_jump(f,arg,jump)
+
+    return _compare(f,arg)
+
+def _compare(f,arg):
+    op = dis.cmp_op[arg]
+
     def pop_args():
-        return (f()
-            .mov(f.stack[1],f.r_scratch[1])
-            .mov(f.r_ret,f.stack[1])
-            .decref(f.r_scratch[1])
-            .pop_stack(f.r_scratch[1])
-            .decref(f.r_scratch[1])
-        )
+        # the result, in %eax, takes the place of the operands
+        return f().pop_decref(True).pop_decref(True).push_tos(True)
 
     if op == 'is' or op == 'is not':
-        outcome_a,outcome_b = false_true_addr(op == 'is not')
+        outcome_a,outcome_b = false_true_addr(f,op == 'is not')
 
         r = f()
-        if f.stack.use_tos(True):
-            r.mov(f.r_ret,f.r_scratch[1])
-        else:
-            r.pop_stack(f.r_scratch[1])
+        b_borrowed = f.stack.is_borrowed()
+        if not (b_borrowed and f.stack.is_borrowed(1)):
+            # releasing an operand can run any code, which can remove the
+            # borrowed globals from their dicts
+            r.own_stack(is_global_ref)
+            b_borrowed = f.stack.is_borrowed()
+
+        b = f.stack.pop_item()
+        if b not in f.stack.cache_regs:
+            r.mov(b,f.r_scratch[1])
+            b = f.r_scratch[1]
 
         temp = f.stack[-1]
-        return (r
-            .cmp(f.r_scratch[1],f.stack[0])
+        (r
+            .cmp(b,f.stack.tos())
             .mov(outcome_a,temp)
             .if_cond[f.test_E](
                 f.op.movl(outcome_b,temp)
             )
-            .decref(f.r_scratch[1])
-            .pop_stack(f.r_scratch[1])
-            .decref(f.r_scratch[1])
+        )
+        if not b_borrowed:
+            r.decref(b)
+        return (r
+            .pop_decref()
             .mov(temp,f.r_ret)
             .incref()
+            .push_tos(True)
         )
 
     if op == 'in' or op == 'not in':
-        outcome_a,outcome_b = false_true_addr(op == 'not in')
+        outcome_a,outcome_b = false_true_addr(f,op == 'not in')
 
         tos = f.stack.tos()
         return (f()
             .push_tos()
-            .invoke('PySequence_Contains',tos,f.stack[1])
+            .invoke('PySequence_Contains',tos,f.stack.item(1))
             .test(f.r_ret,f.r_ret)
             .if_cond[f.test_L](f()
                 .mov(0,f.r_ret)
@@ -1474,14 +2820,14 @@ def _op_COMPARE_OP(f,arg):
         tos = f.stack.tos()
         return (f()
             .push_tos()
-            .invoke('_exception_cmp',f.stack[1],tos)
+            .invoke('_exception_cmp',f.stack.item(1),tos)
             .check_err()
         ) + pop_args()
 
     tos = f.stack.tos()
     return (f()
         .push_tos()
-        .invoke('PyObject_RichCompare',f.stack[1],tos,arg)
+        .invoke('PyObject_RichCompare',f.stack.item(1),tos,arg)
         .check_err()
     ) + pop_args()
 
@@ -1583,7 +2929,7 @@ def _op_STORE_LOCALS(f):
         .push_tos()
         .mov(f.LOCALS,f.r_ret)
         .if_eax_is_not_zero(
-            join(f.decref())
+            f.decref()
         )
         .pop_stack(f.r_ret)
         .mov(f.FRAME,f.r_scratch[0])
@@ -1596,7 +2942,7 @@ def _op_STORE_ATTR(f,name):
     tos = f.stack.tos()
     return (f()
         .push_tos()
-        .invoke('PyObject_SetAttr',tos,address_of(name),f.stack[1])
+        .invoke('PyObject_SetAttr',tos,f.address_of(name),f.stack[1])
         .mov(f.r_ret,f.r_pres[0])
         .pop_stack(f.r_ret)
         .decref()
@@ -1614,11 +2960,11 @@ def _op_IMPORT_FROM(f,name):
     tos = f.stack.tos()
     return (f()
         .push_tos(True)
-        .invoke('PyObject_GetAttr',tos,address_of(name))
+        .invoke('PyObject_GetAttr',tos,f.address_of(name))
         .if_eax_is_zero(f()
             .invoke('PyErr_ExceptionMatches','PyExc_AttributeError')
             .if_eax_is_not_zero(join(f()
-               .invoke('PyErr_Format','CANNOT_IMPORT_MSG',address_of(name))
+               .invoke('PyErr_Format','CANNOT_IMPORT_MSG',f.address_of(name))
                .mov(0,f.r_ret)
             .code))
             .goto_end()
@@ -1649,7 +2995,7 @@ def _op_IMPORT_NAME(f,name):
         return (f()
             .mov(f.LOCALS,f.r_ret)
             .push_arg(n)
-            .push_arg(address_of(name))
+            .push_arg(f.address_of(name))
             .push_arg(f.GLOBALS)
             .push_arg(f.r_ret)
             .test(f.r_ret,f.r_ret)
@@ -1716,49 +3062,234 @@ def _op_IMPORT_NAME(f,name):
 
 
 def join(x):
-    return b''.join(x) if isinstance(x[0],bytes) else reduce(operator.add,x)
+    if not isinstance(x[0],bytes):
+        return AsmSequence([op for seq in x for op in seq.ops])
 
-def resolve_jumps(op,chunks,end_targets=()):
-    displacement = 0
-    
-    for i in range(len(chunks)-1,-1,-1):
-        if isinstance(chunks[i],JumpTarget):
-            chunks[i].displacement = displacement
-            del chunks[i]
+    r = b''.join(x)
+
+    relocs = []
+    pos = 0
+    for c in x:
+        if isinstance(c,RelocBytes):
+            relocs.extend((pos + rpos,w,i) for rpos,w,i in c.relocs)
+        pos += len(c)
+
+    return RelocBytes(r,relocs) if relocs else r
+
+def jump_distance(addrs,sizes,n,t):
+    """Get the distance from jump n to target t in the form that
+    JumpSource.size_for takes, where n and t are indices of fixups, and addrs
+    and sizes are the addresses and sizes of the fixups"""
+    if t > n: return addrs[t] - addrs[n] - sizes[n],True
+    return addrs[t] - addrs[n],False
+
+def relax_jumps(buf):
+    """Pick the size of every jump in buf.
+
+    Every jump starts out at its smallest size. Each pass works out where
+    everything is with the current sizes and makes bigger any jump that can't
+    reach its target. Since jumps only ever get bigger, this stops, usually
+    after two or three passes. Returns the size of each fixup of buf, the
+    address of each fixup and a dict that maps the id of each JumpTarget to the
+    index of its fixup.
+
+    """
+    fixups = buf.fixups
+    sizes = [len(item) if isinstance(item,DelayedCompile) else 0 for pos,index,item in fixups]
+    targets = dict((id(item),n) for n,(pos,index,item) in enumerate(fixups) if isinstance(item,JumpTarget))
+    jumps = [(n,item,targets[id(item.target)]) for n,(pos,index,item) in enumerate(fixups) if isinstance(item,JumpSource)]
+
+    changed = True
+    while changed:
+        addrs = []
+        shift = 0
+        for (pos,index,item),size in zip(fixups,sizes):
+            addrs.append(pos + shift)
+            shift += size
+
+        changed = False
+        for n,item,t in jumps:
+            size = item.size_for(*jump_distance(addrs,sizes,n,t))
+            if size > sizes[n]:
+                sizes[n] = size
+                changed = True
+
+    return sizes,addrs,targets
+
+def resolve_jumps(op,buf,profile=None):
+    """Compile the jumps within a function and pad its end for alignment.
+
+    buf is the CodeBuffer of the function. Returns a new CodeBuffer where the
+    only fixups left are InnerCall objects (see link), with room reserved for
+    them and their displacements relative to the end of the padded function,
+    and the length of the function.
+
+    If profile is not None, the number and size of the jumps are added to it
+    (see profiling.CompileProfile.jumps).
+
+    """
+    fixups = buf.fixups
+    sizes,addrs,targets = relax_jumps(buf)
+    displacement = buf.tell() + sum(sizes)
+
+    r = CodeBuffer(buf.binary)
+    relocs = buf.relocs
+    next_reloc = 0
+    shift = 0
+    prev = prev_pos = 0
+    for n,(pos,index,item) in enumerate(fixups):
+        while next_reloc < len(relocs) and relocs[next_reloc][0] < pos:
+            rpos,w,i = relocs[next_reloc]
+            r.relocs.append((rpos + shift,w,i))
+            next_reloc += 1
+        r.copy(buf,prev,index,pos - prev_pos)
+        prev = index
+        prev_pos = pos
+
+        if isinstance(item,JumpTarget):
+            item.displacement = displacement - addrs[n]
+        elif isinstance(item,JumpSource):
+            if sizes[n]:
+                r += [item.compile(sizes[n],*jump_distance(addrs,sizes,n,targets[id(item.target)]))]
+            if profile is not None:
+                profile.add_jump(sizes[n],item.sizes())
         else:
-            if isinstance(chunks[i],JumpSource):
-                chunks[i] = chunks[i].compile(displacement)
-                if not chunks[i]:
-                    del chunks[i]
-                    continue
-            elif isinstance(chunks[i],DelayedCompile):
-                chunks[i].displacement = displacement
-            
-            displacement += len(chunks[i])
+            item.displacement = displacement - addrs[n] - sizes[n]
+            r.reserve(item)
+        shift += sizes[n]
+
+    r.relocs.extend((rpos + shift,w,i) for rpos,w,i in relocs[next_reloc:])
+    r.copy(buf,prev,len(buf.data),buf.tell() - prev_pos)
 
     # add padding for alignment
+    pad_size = 0
     if CALL_ALIGN_MASK:
         pad_size = aligned_size(displacement) - displacement
-        chunks += [op.nop()] * pad_size
-        for et in end_targets:
-            et.displacement -= pad_size
-    
-    code = join([(c.compile() if isinstance(c,DelayedCompile) else c) for c in chunks])
+        r += [op.nop()] * pad_size
+
+    for pos,index,item in r.fixups:
+        item.displacement += pad_size
+
+    return r,displacement + pad_size
+
+
+def compile_function(ceval,op,code,profile=None):
+    """Compile one function and resolve its jumps. Returns what resolve_jumps
+    returns and the time it took."""
+    start = timer()
+    with phase(profile,'compile_eval'):
+        buf = ceval(code,profile=profile)
+    with phase(profile,'resolve_jumps'):
+        r = resolve_jumps(op,buf,profile)
+    return r,timer() - start
+
+
+# the objects that the worker processes of compile_parallel need
+_worker_state = None
+
+def _compile_in_worker(key):
+    """Compile and resolve the jumps of one function in a worker process.
+
+    The worker is a fork of the parent process, so the objects in _worker_state
+    (and their addresses) are the same as in the parent. The result is the
+    machine code, its relocations and the calls to other functions, which are
+    sent back to the parent in a form that can be pickled.
+
+    """
+    entry_points,ceval,op,pool,targets,stubs,profile = _worker_state
+    if profile is not None: profile = CompileProfile()
+    (buf,length),elapsed = compile_function(ceval,op,entry_points[key][1],profile)
+
+    def target_key(t):
+        # a stub may have been used for the first time by this process
+        stub = stubs is not None and stubs.key_of(t)
+        return ('stub',stub) if stub else targets[id(t)]
+
+    relocs = [(pos,width,pool.entries[i]) for pos,width,i in buf.relocs] if pool is not None else []
+    calls = [(pos,c.displacement,target_key(c.target)) for pos,index,c in buf.fixups]
+
+    return (bytes(buf.data),relocs,calls),length,elapsed,profile
+
+
+def compile_parallel(keys,workers,entry_points,ceval,op,abi,pool,function_starts,local_name,stubs=None,profile=None):
+    """Compile the functions of entry_points with the given keys in a pool of
+    worker processes. Returns a dict that maps each key to what
+    compile_function would return.
+
+    The workers are forked, so this must only be called while no other thread
+    is running.
+
+    """
+    global _worker_state
+
+    targets = dict((id(t),key) for key,t in function_starts.items())
+    targets[id(local_name)] = None
+
+    _worker_state = (entry_points,ceval,op,pool,targets,stubs,profile)
+    try:
+        workpool = multiprocessing.Pool(workers)
+        try:
+            results = workpool.map(_compile_in_worker,keys)
+        finally:
+            workpool.terminate()
+            workpool.join()
+    finally:
+        _worker_state = None
+
+    resolved = {}
+    for key,((code,relocs,calls),length,elapsed,wprofile) in zip(keys,results):
+        if wprofile is not None: profile.merge(wprofile)
+
+        buf = CodeBuffer()
+        buf.data += code
+        buf.relocs = [(pos,width,pool[e].index) for pos,width,e in relocs]
+        for pos,displacement,target in calls:
+            if target is None:
+                target = local_name
+            elif isinstance(target,tuple):
+                target = stubs[target[1]]
+            else:
+                target = function_starts[target]
+            call = InnerCall(op,abi,target)
+            call.displacement = displacement
+            buf.fixups.append((pos,pos,call))
+        resolved[key] = ((buf,length),elapsed)
+
+    return resolved
+
+
+def link(functions):
+    """Finish the calls between functions and get the code of each.
 
-    for et in end_targets:
-        et.displacement -= displacement
+    functions is a list of (buf,length,start) tuples, in the order the
+    functions will appear in the image, where buf and length come from
+    resolve_jumps and start is the JumpTarget that marks the start of the
+    function.
 
-    return code
+    """
+    remaining = sum(length for buf,length,start in functions)
+    for buf,length,start in functions:
+        start.displacement = remaining
+        remaining -= length
+        for pos,index,c in buf.fixups:
+            c.displacement += remaining
+
+    r = []
+    for buf,length,start in functions:
+        for pos,index,c in buf.fixups:
+            buf.patch(index,c.compile())
+        r.append(buf.getvalue())
+    return r
 
 
-def local_name_func(op,abi,tuning):
+def local_name_func(op,abi,tuning,pool=None):
     # this function uses an ad hoc calling convention and is only callable from
     # the code generated by this module
 
     local_stack_size = aligned_size((MAX_ARGS + 1) * abi.ptr_size)
     stack_ptr_shift = local_stack_size - abi.ptr_size
 
-    f = Frame(op,abi,tuning,local_stack_size)
+    f = Frame(op,abi,tuning,local_stack_size,pool=pool)
 
     
     else_ = JumpTarget()
@@ -1806,12 +3337,78 @@ def local_name_func(op,abi,tuning):
         (ret)
         .add(stack_ptr_shift,abi.r_sp)
         .ret()
+    ) + f.cold
+
+
+
+class SharedStubs:
+    """Code shared by every function of an image, used when
+    Tuning.shared_stubs is true.
+
+    Each stub is a small function with an ad hoc calling convention (like
+    local_name_func), called with InnerCall and identified by a key:
+
+        ('decref',code)         Call the deallocator of the object in the
+                                register with the given code, preserving %eax.
+        ('name_error',exc,msg)  Call format_exc_check_arg with exc, msg and
+                                the name in r_pres[0], and return zero.
+
+    The keys are made of strings and numbers so they can be sent back by the
+    worker processes of compile_parallel. 'targets' maps the key of every stub
+    used so far to its JumpTarget.
+
+    """
+    def __init__(self):
+        self.targets = collections.OrderedDict()
+        self._keys = {}
+
+    def __getitem__(self,key):
+        t = self.targets.get(key)
+        if t is None:
+            t = self.targets[key] = JumpTarget()
+            self._keys[id(t)] = key
+        return t
+
+    def key_of(self,target):
+        """Get the key of the stub with JumpTarget target, or None if target
+        isn't a stub"""
+        return self._keys.get(id(target))
+
+
+def stub_func(key,op,abi,tuning,pool=None):
+    """Generate the stub identified by key (see SharedStubs)"""
+
+    # like local_name_func, but with a place to keep %eax right below the
+    # return address
+    local_stack_size = aligned_size((MAX_ARGS + 2) * abi.ptr_size + abi.shadow)
+    stack_ptr_shift = local_stack_size - abi.ptr_size
+    saved = abi.ops.Address(stack_ptr_shift - abi.ptr_size,abi.r_sp)
+
+    f = Frame(op,abi,tuning,local_stack_size,pool=pool)
+    r = f().sub(stack_ptr_shift,abi.r_sp)
+
+    if key[0] == 'decref':
+        reg = next(x for x in [abi.r_ret] + abi.r_scratch + abi.r_pres if x.code == key[1])
+        r.mov(f.r_ret,saved)
+        r += f.dealloc(reg)
+        r.mov(saved,f.r_ret)
+    elif key[0] == 'name_error':
+        (r
+            .invoke('format_exc_check_arg',key[1],key[2],f.r_pres[0])
+            .mov(0,f.r_ret))
+    else:
+        raise ValueError('unknown stub: {!r}'.format(key))
+
+    return (r
+        .add(stack_ptr_shift,abi.r_sp)
+        .ret()
     )
 
 
 
-def compile_eval(code,op,abi,tuning,local_name,entry_points):
-    """Generate a function equivalent to PyEval_EvalFrame called with f.code"""
+def compile_eval(code,op,abi,tuning,local_name,entry_points,pool=None,function_starts=None,resolver=None,profile=None,stubs=None):
+    """Generate a function equivalent to PyEval_EvalFrame called with f.code
+    and return it as a CodeBuffer"""
 
     # the stack will have following items:
     #     - return address
@@ -1823,10 +3420,12 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
     #     - BUILTINS
     #     - LOCALS
     #     - FAST_LOCALS
+    #     - the old values of the registers from stack_cache_regs
     #
     # the first 2 will already be on the stack by the time %esp is adjusted
 
-    stack_first = 7
+    cache_regs = stack_cache_regs(abi,tuning)
+    stack_first = 7 + len(cache_regs)
 
     if pyinternals.REF_DEBUG:
         # a place to store %eax,%ecx and %edx when increasing reference counts
@@ -1842,7 +3441,7 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
 
     stack_ptr_shift = local_stack_size - (PRE_STACK+SAVED_REGS) * abi.ptr_size
 
-    f = Frame(op,abi,tuning,local_stack_size,code,local_name,entry_points)
+    f = Frame(op,abi,tuning,local_stack_size,code,local_name,entry_points,pool,function_starts,resolver,stubs)
 
     opcodes = (f()
         .push(abi.r_bp)
@@ -1853,6 +3452,9 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
     )
     f.stack.offset = PRE_STACK+SAVED_REGS
 
+    # where the code to save the registers of stack_cache_regs goes (see below)
+    save_cache_regs_at = len(opcodes.code)
+
     argreg = f.stack.arg_reg(n=0)
     (opcodes
         .mov(f.stack.func_arg(0),f.r_pres[0])
@@ -1864,7 +3466,7 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
         # as far as I can tell, after expanding the macros and removing the
         # "dynamic annotations" (see dynamic_annotations.h in the CPython
         # headers), this is all that PyThreadState_GET boils down to:
-        .mov(f.Address(pyinternals.raw_addresses['_PyThreadState_Current']),f.r_scratch[0])
+        .mov(f.Address(f.raw_address('_PyThreadState_Current')),f.r_scratch[0])
 
         .mov(f.Address(pyinternals.FRAME_GLOBALS_OFFSET,f.r_pres[0]),f.r_scratch[1])
         .mov(f.Address(pyinternals.FRAME_BUILTINS_OFFSET,f.r_pres[0]),f.r_ret)
@@ -1887,32 +3489,59 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
         # a place to store %eax,%ecx and %edx when increasing reference counts
         # (which calls a function when ref_debug is True
         f.stack.offset += DEBUG_TEMPS
+
+    # The old values of the registers of stack_cache_regs are stored after the
+    # other items, but they are stored before the first check for an error,
+    # since the code at the end of the function restores them.
+    saved_cache_regs = []
+    for reg in cache_regs:
+        f.stack.offset += 1
+        saved_cache_regs.append(f.stack[0])
+    opcodes.code[save_cache_regs_at:save_cache_regs_at] = [
+        f.op.mov(reg,addr) for reg,addr in zip(cache_regs,saved_cache_regs)]
     
     stack_prolog = f.stack.offset
+
+    # the code of each opcode is written to buf as soon as it's generated
+    buf = CodeBuffer(
+        not isinstance(op,abi.ops.Assembly),
+        op if tuning.peephole else None,
+        abi)
+    buf += opcodes
+    buf.flush()
+    buf.frame_size = stack_ptr_shift + SAVED_REGS * abi.ptr_size
     
-    i = 0
-    extended_arg = 0
-    f.byte_offset = 0
-    while i < len(f.code.co_code):
-        bop = f.code.co_code[i]
-        i += 1
-        
-        if bop >= dis.HAVE_ARGUMENT:
-            boparg = f.code.co_code[i] + (f.code.co_code[i+1] << 8) + extended_arg
-            i += 2
-            
-            if bop == dis.EXTENDED_ARG:
-                extended_arg = bop << 16
+    handler = get_handler
+    if profile is not None:
+        handler = lambda bop: profile.handler(dis.opname[bop],get_handler(bop))
+
+    with phase(profile,'flow_graph'):
+        graph = FlowGraph(code)
+    f.jump_targets = graph.targets
+    f.loop_starts = graph.loop_starts()
+
+    float_exprs = {}
+    if tuning.unboxed_floats and abi.ptr_size == 8:
+        float_exprs = floatexpr.find_expressions(graph,code.co_consts,FLOAT_EXPR_REGS)
+
+    for block in graph.blocks:
+        f.block = block.instructions
+        for i,ins in enumerate(block.instructions):
+            if ins.offset < f.skip_to: continue
+            f.block_index = i
+
+            expr = float_exprs.get(ins.offset)
+            if expr is not None:
+                buf += float_expression(f,expr,handler)
+                f.skip_to = expr.instructions[-1].next
+                continue
+
+            f.byte_offset = ins.offset
+            f.next_byte_offset = ins.next
+            if ins.arg is None:
+                buf += handler(ins.op)(f)
             else:
-                extended_arg = 0
-                
-                f.next_byte_offset = i
-                opcodes += get_handler(bop)(f,boparg)
-                f.byte_offset = i
-        else:
-            f.next_byte_offset = i
-            opcodes += get_handler(bop)(f)
-            f.byte_offset = i
+                buf += handler(ins.op)(f,ins.arg)
     
     
     if f.stack.offset != stack_prolog:
@@ -1923,31 +3552,33 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
     if f.blockends:
         raise NCSystemError('there is an unclosed block statement')
     
-    dr = join(f()
-        .mov(f.Address(base=f.r_pres[0]),f.r_scratch[1])
-        .decref(f.r_scratch[1])
-        .add(f.ptr_size,f.r_pres[0])
-        .code)
-    
-    cmpjl = f.op.cmp(abi.r_bp,f.r_pres[0])
-    jlen = -(len(dr) + len(cmpjl) + f.JCC_MIN_LEN)
-    assert jlen <= 127
-    cmpjl += f.op.jb(f.Displacement(jlen))
+    dr_loop = JumpTarget()
+    dr_cond = JumpTarget()
 
     # have to compensate for subtracting from the base pointer below
-    f.FRAME.offset += f.ptr_size * stack_prolog
+    f.FRAME = f.FRAME.replace(offset=f.FRAME.offset + f.ptr_size * stack_prolog)
     
+    buf.flush()
+    buf.frame_size = None
+    r = f()(f._end)
+    for reg,addr in zip(cache_regs,saved_cache_regs):
+        r.mov(addr,reg)
+
     # call Py_DECREF on anything left on the stack and return %eax
-    (opcodes
-        (f._end)
+    buf += (r
         .mov(f.r_ret,f.Address(f.ptr_size*-stack_prolog,abi.r_bp))
         .sub(f.ptr_size*stack_prolog,abi.r_bp)
-        .jmp(f.Displacement(len(dr)))
-        (dr)
-        (cmpjl)
+        .goto(dr_cond)
+    (dr_loop)
+        .mov(f.Address(base=f.r_pres[0]),f.r_scratch[1])
+        .decref(f.r_scratch[1])
+        .add(f.ptr_size,f.r_pres[0])
+    (dr_cond)
+        .cmp(abi.r_bp,f.r_pres[0])
+        (JumpSource(f.op.jb,f.abi,dr_loop))
         .call('_LeaveRecursiveCall')
         .mov(f.Address(base=abi.r_bp),f.r_ret)
-        .mov(f.Address(pyinternals.raw_addresses['_PyThreadState_Current']),f.r_scratch[0])
+        .mov(f.Address(f.raw_address('_PyThreadState_Current')),f.r_scratch[0])
         .mov(f.FRAME,f.r_scratch[1])
         .add(stack_ptr_shift,abi.r_sp)
         .pop(f.r_pres[1])
@@ -1958,60 +3589,153 @@ def compile_eval(code,op,abi,tuning,local_name,entry_points):
         .ret()
     )
 
-    return opcodes
-
+    # the error handling and deallocation moved out of the way by Frame.outline
+    buf.flush()
+    buf.frame_size = stack_ptr_shift + SAVED_REGS * abi.ptr_size
+    buf += f.cold
+    buf.flush()
+
+    return buf
+
+
+def compile_raw(_code,abi,binary = True,tuning=Tuning(),pool=None,resolver=None,lazy=False,tiered=False,workers=None,profile=None):
+    """Compile one or more code objects and all the code objects nested inside
+    them.
+
+    If pool is not None, it must be an empty ConstantPool and the generated
+    code will not contain the address of any object or run-time symbol.
+    Instead, pool will receive a description of every address needed and the
+    position of every place they need to be written to when the code is
+    loaded.
+
+    If resolver is not None, it is used to guess which functions are called by
+    CALL_FUNCTION. When the guess is a function compiled as part of the same
+    call to compile_raw, the function is called directly (after checking at run
+    time that the guess is right). It must have two methods:
+    global_ref(code,name), which returns what the global variable 'name' of
+    code object 'code' probably refers to, and attr_ref(ref,name), which
+    returns what attribute 'name' of the object described by 'ref' probably
+    refers to. Either can return None if there is no guess. When the guess is a
+    function, the return value must be its code object.
+
+    If lazy is true, only the code objects in _code are compiled. The entry
+    points of the code objects nested in them are returned with the offset
+    pyinternals.OFFSET_LAZY and are compiled the first time they are run.
+
+    If tiered is true, the nested code objects are left uncompiled like with
+    lazy, but their entry points get the offset pyinternals.OFFSET_TIERED
+    instead. They are run by the interpreter, with counting byte code (see
+    tier0), until they have been called and have looped a certain number of
+    times (see compile.set_tier_threshold) and are then compiled.
+
+    If workers is greater than 1, the functions are compiled in that many
+    worker processes. This requires binary to be true and an operating system
+    with fork; otherwise workers is ignored. It is also ignored while other
+    threads are running (such as importer.BackgroundCompiler), since forking a
+    process with more than one thread can leave locks held in the children.
+
+    If profile is not None, it must be a profiling.CompileProfile object, which
+    will receive the time spent in each phase of compilation.
 
-def compile_raw(_code,abi,binary = True,tuning=Tuning()):
+    """
     assert len(abi.r_scratch) >= 2 and len(abi.r_pres) >= 2
+    assert pool is None or binary
 
     if isinstance(_code,types.CodeType):
         _code = (_code,)
 
     local_name = JumpTarget()
+    stubs = SharedStubs() if tuning.shared_stubs else None
     entry_points = collections.OrderedDict()
+    function_starts = {}
     op = abi.ops if binary else abi.ops.Assembly()
+    if pool is not None:
+        op = RelocatableOps(op)
+    if binary and tuning.peephole:
+        op = InstrOps(op)
 
     ceval = partial(compile_eval,
         op=op,
         abi=abi,
         tuning=tuning,
         local_name=local_name,
-        entry_points=entry_points)
-
-    # if this ever gets ported to C or C++, this will be a prime candidate for
-    # parallelization
-    def compile_code_constants(code):
+        entry_points=entry_points,
+        pool=pool,
+        function_starts=function_starts,
+        resolver=resolver,
+        stubs=stubs)
+
+    # Every entry point is created before anything is compiled, so that any
+    # function can refer to (or call) any other function in the image.
+    def find_code_constants(code,compiled=True):
         for c in code:
             if isinstance(c,types.CodeType) and id(c) not in entry_points:
-                # reserve the entry
-                entry_points[id(c)] = None
-
-                compile_code_constants(c.co_consts)
                 entry_points[id(c)] = (
                     pyinternals.create_compiled_entry_point(c),
-                    ceval(c))
+                    c if compiled else None)
+                if pool is not None: pool.add_code(c)
+
+                if compiled:
+                    function_starts[id(c)] = JumpTarget()
+                    find_code_constants(c.co_consts,not (lazy or tiered))
     
-    compile_code_constants(_code)
+    find_code_constants(_code)
+
+    keys = [key for key,(ep,c) in entry_points.items() if c is not None]
+    if (workers is not None and workers > 1 and binary and len(keys) > 1 and
+            hasattr(os,'fork') and threading.active_count() == 1):
+        resolved = compile_parallel(keys,workers,entry_points,ceval,op,abi,pool,function_starts,local_name,stubs,profile)
+    else:
+        resolved = {}
+        for key in keys:
+            resolved[key] = compile_function(ceval,op,entry_points[key][1],profile)
 
     functions = []
-    end_targets = []
+    for key in keys:
+        (chunks,length),elapsed = resolved[key]
+        fire_compile_hooks(entry_points[key][1],length,elapsed)
+        functions.append((chunks,length,function_starts[key]))
     
     if local_name.used:
-        local_name.displacement = 0
-        end_targets.append(local_name)
-        functions.append(resolve_jumps(op,local_name_func(op,abi,tuning).code))
-
-    entry_points = list(entry_points.values())
-    for ep,func in reversed(entry_points):
-        functions.insert(0,resolve_jumps(op,func.code,end_targets))
-
-    offset = 0
-    for epf,func in zip(entry_points,functions):
-        pyinternals.cep_set_offset(epf[0],offset)
-        offset += len(func)
-
-    if not binary:
-        functions = join(functions)
+        with phase(profile,'resolve_jumps'):
+            buf = CodeBuffer(binary)
+            buf += local_name_func(op,abi,tuning,pool)
+            functions.append(resolve_jumps(op,buf,profile) + (local_name,))
+
+    if stubs is not None:
+        with phase(profile,'resolve_jumps'):
+            for key,target in stubs.targets.items():
+                buf = CodeBuffer(binary)
+                buf += stub_func(key,op,abi,tuning,pool)
+                functions.append(resolve_jumps(op,buf,profile) + (target,))
+
+    with phase(profile,'link'):
+        functions = link(functions)
+
+    with phase(profile,'finish'):
+        entry_points = list(entry_points.values())
+
+        offset = 0
+        func_iter = iter(functions)
+        for ep,func in entry_points:
+            if func is None:
+                if tiered:
+                    tier0.make_tiered(ep)
+                else:
+                    pyinternals.cep_set_offset(ep,pyinternals.OFFSET_LAZY)
+            else:
+                pyinternals.cep_set_offset(ep,offset)
+                offset += len(next(func_iter))
+
+        if pool is not None:
+            offset = 0
+            for func in functions:
+                if isinstance(func,RelocBytes):
+                    pool.relocations.extend((offset + pos,w,i) for pos,w,i in func.relocs)
+                offset += len(func)
+
+        if not binary:
+            functions = join(functions)
     
     return functions,[ep for ep,func in entry_points]
 
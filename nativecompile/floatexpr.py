@@ -0,0 +1,110 @@
+"""Finding arithmetic that can be done on unboxed floats.
+
+Every arithmetic instruction normally creates a new object for its result,
+even when that result is only used by the next instruction. compile_eval looks
+for runs of byte code instructions in the same basic block that compute a
+single value out of local variables and number constants with +, -, * and /
+("float expressions"). When the variables all hold floats at run time, the
+generated code computes the whole expression in SSE registers and only creates
+an object for the final value. When they don't, the instructions run as usual.
+
+"""
+
+import dis
+import collections
+
+
+LOAD_FAST = dis.opmap['LOAD_FAST']
+LOAD_CONST = dis.opmap['LOAD_CONST']
+
+# the operations that can be part of a float expression and the SSE2
+# instructions that do them
+OPERATIONS = dict(
+    (dis.opmap[prefix + name],ins)
+    for name,ins in [
+        ('ADD','addsd'),
+        ('SUBTRACT','subsd'),
+        ('MULTIPLY','mulsd'),
+        ('TRUE_DIVIDE','divsd')]
+    for prefix in ['BINARY_','INPLACE_'])
+
+# int constants are converted to floats, which is only exact up to here
+MAX_EXACT_INT = 2**53
+
+FLOAT = 'float'
+INT = 'int'
+
+
+def const_kind(c):
+    """Whether constant c is a FLOAT, an INT that a float expression can use
+    or neither (None)"""
+    if type(c) is float: return FLOAT
+    if type(c) is int and -MAX_EXACT_INT <= c <= MAX_EXACT_INT: return INT
+    return None
+
+
+class FloatExpression(collections.namedtuple('FloatExpression','instructions depth')):
+    """The instructions of a float expression and the most values it has at
+    once (the number of registers needed to compute it)"""
+    __slots__ = ()
+
+
+def expression_at(instructions,consts,max_depth):
+    """Get the longest FloatExpression at the start of instructions, or None.
+
+    Local variables are assumed to be floats (the generated code checks). An
+    operation on two int constants would have an int result, so it can't be
+    part of one. Neither can anything that needs more than max_depth values
+    at once. Expressions that can't save more than a function call (a single
+    operation without a float constant or a division, like the i + 1 of a
+    counter) are ignored.
+
+    """
+    kinds = []
+    depth = 0
+    ops = 0
+    worthwhile = False
+    best = None
+    for n,ins in enumerate(instructions):
+        if ins.op == LOAD_FAST:
+            kinds.append(FLOAT)
+        elif ins.op == LOAD_CONST and const_kind(consts[ins.arg]):
+            kinds.append(const_kind(consts[ins.arg]))
+            if kinds[-1] is FLOAT: worthwhile = True
+        elif ins.op in OPERATIONS and len(kinds) >= 2:
+            b = kinds.pop()
+            a = kinds.pop()
+            if a is INT and b is INT: break
+            kinds.append(FLOAT)
+            ops += 1
+            if OPERATIONS[ins.op] == 'divsd': worthwhile = True
+            if len(kinds) == 1 and (worthwhile or ops > 1):
+                best = FloatExpression(instructions[0:n+1],depth)
+        else:
+            break
+
+        if len(kinds) > max_depth: break
+        depth = max(depth,len(kinds))
+
+    return best
+
+
+def find_expressions(graph,consts,max_depth):
+    """Get a dict that maps the offset of the first instruction of every float
+    expression in graph (a FlowGraph) to its FloatExpression.
+
+    The expressions don't overlap and each one is inside a basic block, so
+    nothing jumps into the middle of one.
+
+    """
+    r = {}
+    for b in graph.blocks:
+        i = 0
+        while i < len(b.instructions):
+            expr = expression_at(b.instructions[i:],consts,max_depth)
+            if expr:
+                r[b.instructions[i].offset] = expr
+                i += len(expr.instructions)
+            else:
+                i += 1
+    return r
@@ -0,0 +1,207 @@
+"""The basic blocks of a code object and the jumps between them.
+
+compile_eval builds a FlowGraph before generating any machine code. While
+building it, jumps to unconditional jumps are redirected to where those go
+("jump threading") and blocks that can't be reached are dropped, so that no
+code is generated for them.
+
+"""
+
+import dis
+import collections
+
+
+JUMP_FORWARD = dis.opmap['JUMP_FORWARD']
+JUMP_ABSOLUTE = dis.opmap['JUMP_ABSOLUTE']
+FOR_ITER = dis.opmap['FOR_ITER']
+EXTENDED_ARG = dis.opmap['EXTENDED_ARG']
+
+UNCONDITIONAL_JUMPS = frozenset([JUMP_FORWARD,JUMP_ABSOLUTE])
+
+# instructions after which the next instruction is never run
+TERMINATORS = UNCONDITIONAL_JUMPS | frozenset(
+    dis.opmap[x] for x in ['RETURN_VALUE','RAISE_VARARGS'])
+
+# jumps whose target can be changed without changing what they do
+THREADABLE = UNCONDITIONAL_JUMPS | frozenset(
+    dis.opmap[x] for x in [
+        'POP_JUMP_IF_FALSE',
+        'POP_JUMP_IF_TRUE',
+        'JUMP_IF_FALSE_OR_POP',
+        'JUMP_IF_TRUE_OR_POP'])
+
+
+class Instruction(collections.namedtuple('Instruction','offset op arg next')):
+    """One byte code instruction.
+
+    offset is where the instruction starts, including any EXTENDED_ARG prefix,
+    and next is where the following instruction starts. arg is None if the
+    instruction doesn't take an argument.
+
+    """
+    __slots__ = ()
+
+    @property
+    def target(self):
+        """The offset that this instruction can jump to, or None"""
+        if self.op in dis.hasjrel: return self.next + self.arg
+        if self.op in dis.hasjabs: return self.arg
+        return None
+
+    def retarget(self,to):
+        """Get a copy of this jump that goes to offset 'to' instead.
+
+        An unconditional jump becomes JUMP_FORWARD or JUMP_ABSOLUTE depending
+        on the direction, since the compiler expects JUMP_ABSOLUTE to only go
+        backward.
+
+        """
+        op = self.op
+        if op in UNCONDITIONAL_JUMPS:
+            op = JUMP_FORWARD if to >= self.next else JUMP_ABSOLUTE
+        return self._replace(op=op,arg=to - self.next if op in dis.hasjrel else to)
+
+
+def decode(co_code):
+    """Generate the Instruction objects of the byte string co_code"""
+    i = 0
+    start = 0
+    extended_arg = 0
+    while i < len(co_code):
+        op = co_code[i]
+        i += 1
+        arg = None
+        if op >= dis.HAVE_ARGUMENT:
+            arg = co_code[i] + (co_code[i+1] << 8) + extended_arg
+            i += 2
+            if op == EXTENDED_ARG:
+                extended_arg = arg << 16
+                continue
+            extended_arg = 0
+
+        yield Instruction(start,op,arg,i)
+        start = i
+
+
+class BasicBlock:
+    """A run of instructions that is only entered at the first one and only
+    jumps at the last one"""
+    def __init__(self,instructions):
+        self.instructions = instructions
+
+    @property
+    def start(self):
+        return self.instructions[0].offset
+
+    @property
+    def end(self):
+        return self.instructions[-1].next
+
+    def successors(self):
+        """The offsets of the blocks that can run after this one"""
+        last = self.instructions[-1]
+        r = []
+        if last.op not in TERMINATORS: r.append(last.next)
+        if last.target is not None: r.append(last.target)
+        return r
+
+
+class FlowGraph:
+    """The basic blocks of a code object, in the order of the byte code.
+
+    blocks is a list of the BasicBlock objects that can run, after jump
+    threading. targets is the set of offsets that something still jumps to.
+    threaded and removed are the number of jumps that were redirected and the
+    number of blocks that were dropped.
+
+    """
+    def __init__(self,code):
+        instructions = list(decode(code.co_code))
+
+        leaders = {0}
+        for ins in instructions:
+            t = ins.target
+            if t is not None:
+                leaders.add(t)
+            if t is not None or ins.op in TERMINATORS:
+                leaders.add(ins.next)
+
+        self.blocks = []
+        for ins in instructions:
+            if ins.offset in leaders:
+                self.blocks.append(BasicBlock([]))
+            self.blocks[-1].instructions.append(ins)
+
+        self.by_start = dict((b.start,b) for b in self.blocks)
+
+        self.threaded = self._thread_jumps()
+        self.removed = self._remove_unreachable()
+
+        self.targets = frozenset(
+            b.instructions[-1].target for b in self.blocks
+            if b.instructions[-1].target is not None)
+
+    def _final_target(self,to):
+        """Follow the chain of unconditional jumps that starts at 'to'"""
+        seen = set()
+        while to not in seen:
+            seen.add(to)
+            first = self.by_start[to].instructions[0]
+            if first.op not in UNCONDITIONAL_JUMPS: break
+            to = first.target
+        return to
+
+    def _thread_jumps(self):
+        # the exits of FOR_ITER loops pop the iterator, so nothing else may be
+        # redirected to them
+        for_exits = set(b.instructions[-1].target for b in self.blocks
+            if b.instructions[-1].op == FOR_ITER)
+
+        count = 0
+        for b in self.blocks:
+            last = b.instructions[-1]
+            if last.op not in THREADABLE: continue
+
+            to = self._final_target(last.target)
+            if to == last.target or to in for_exits: continue
+
+            # the compiler can only jump backward to the start of a loop
+            if to < last.next and self.by_start[to].instructions[0].op != FOR_ITER:
+                continue
+
+            b.instructions[-1] = last.retarget(to)
+            count += 1
+
+        return count
+
+    def _remove_unreachable(self):
+        reachable = set()
+        pending = [0]
+        while pending:
+            start = pending.pop()
+            if start in reachable or start not in self.by_start: continue
+            reachable.add(start)
+            pending.extend(self.by_start[start].successors())
+
+        before = len(self.blocks)
+        self.blocks = [b for b in self.blocks if b.start in reachable]
+        for start in set(self.by_start) - reachable:
+            del self.by_start[start]
+        return before - len(self.blocks)
+
+    def loop_starts(self):
+        """Get the set of offsets that something jumps backward to, besides the
+        FOR_ITER instructions"""
+        r = set()
+        for b in self.blocks:
+            last = b.instructions[-1]
+            to = last.target
+            if (to is not None and to <= last.offset
+                    and self.by_start[to].instructions[0].op != FOR_ITER):
+                r.add(to)
+        return frozenset(r)
+
+    def instructions(self):
+        for b in self.blocks:
+            for ins in b.instructions:
+                yield ins
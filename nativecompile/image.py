@@ -0,0 +1,128 @@
+"""Relocatable compiled code.
+
+An Image holds machine code that doesn't contain the address of any object or
+run-time symbol. The addresses are written into a copy of the code when the
+image is loaded, so an image can be compiled once, saved with dumps and loaded
+by any process running the same build of Python.
+
+"""
+
+import sys
+import marshal
+
+from . import pyinternals
+from .compile import Abi
+from .compile_raw import compile_raw, ConstantPool, NCSystemError, Tuning, SizeTuning
+from . import tier0
+
+
+# increase this whenever the format of the serialized data changes
+FORMAT_VERSION = 2
+
+
+def build_key():
+    """Get the properties of the running build of Python that machine code
+    depends on. An image can only be loaded by a build with the same key."""
+    return (
+        sys.hexversion,
+        getattr(sys,'abiflags',''),
+        pyinternals.ARCHITECTURE,
+        pyinternals.REF_DEBUG,
+        pyinternals.COUNT_ALLOCS,
+        pyinternals.LONG_SHIFT,
+        tuple((name,getattr(pyinternals,name)) for name in sorted(dir(pyinternals))
+            if name.endswith('_OFFSET')))
+
+
+class Image:
+    def __init__(self,code,codes,offsets,entries,relocations):
+        self.code = code
+        self.codes = codes
+        self.offsets = offsets
+        self.entries = entries
+        self.relocations = relocations
+
+    def dumps(self):
+        return marshal.dumps((
+            FORMAT_VERSION,
+            build_key(),
+            self.code,
+            tuple(self.codes),
+            tuple(self.offsets),
+            tuple(self.entries),
+            tuple(self.relocations)))
+
+    @classmethod
+    def loads(cls,data):
+        version,build,*fields = marshal.loads(data)
+        if version != FORMAT_VERSION:
+            raise ValueError('the image was created by an incompatible version of this package')
+        if build != build_key():
+            raise ValueError('the image was created for a different build of Python')
+
+        return cls(*fields)
+
+    def _address(self,entry):
+        kind = entry[0]
+        if kind == 'symbol':
+            return pyinternals.raw_addresses[entry[1]]
+        if kind == 'entry_point':
+            raise NCSystemError('entry point addresses are resolved separately')
+
+        code = self.codes[entry[1]]
+        return id({
+            'const' : code.co_consts,
+            'name' : code.co_names,
+            'varname' : code.co_varnames}[kind][entry[2]])
+
+    def load(self):
+        """Create a CompiledCode object from this image.
+
+        The objects whose addresses are written into the code all belong to the
+        code objects of the entry points, so the CompiledCode object keeps them
+        alive.
+
+        """
+        entry_points = [pyinternals.create_compiled_entry_point(c) for c in self.codes]
+        for ep,offset in zip(entry_points,self.offsets):
+            if offset == pyinternals.OFFSET_TIERED:
+                tier0.make_tiered(ep)
+            else:
+                pyinternals.cep_set_offset(ep,offset)
+
+        addresses = [
+            (id(entry_points[e[1]]) if e[0] == 'entry_point' else self._address(e))
+            for e in self.entries]
+
+        code = bytearray(self.code)
+        for pos,width,index in self.relocations:
+            # fields narrower than a pointer are sign-extended by the CPU
+            code[pos:pos+width] = addresses[index].to_bytes(
+                width,
+                'little',
+                signed=width < Abi.ptr_size)
+
+        return pyinternals.CompiledCode(code,entry_points)
+
+
+def compile_image(code,resolver=None,lazy=False,tiered=False,workers=None,optimize_size=False):
+    """Compile code (a code object or a sequence of them) into an Image.
+
+    See compile_raw for the meaning of resolver, lazy, tiered and workers, and
+    compile.compile for optimize_size.
+
+    """
+    pool = ConstantPool()
+    parts,entry_points = compile_raw(code,Abi,
+        tuning=SizeTuning() if optimize_size else Tuning(),
+        pool=pool,
+        resolver=resolver,
+        lazy=lazy,
+        tiered=tiered,
+        workers=workers)
+    return Image(
+        b''.join(parts),
+        pool.codes,
+        [pyinternals.cep_get_offset(ep) for ep in entry_points],
+        pool.entries,
+        pool.relocations)
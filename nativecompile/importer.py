@@ -2,13 +2,209 @@
 import imp
 import importlib
 import importlib._bootstrap
+import os
 import os.path
 import warnings
 import types
 import sys
+import marshal
+import mmap
+import queue
+import threading
 
-from .compile import compile
-from . import pyinternals
+from .compile import compile, Abi
+from .compile_raw import Tuning
+from .image import Image, compile_image, FORMAT_VERSION
+from . import pyinternals, __version__
+
+
+# the compiled code of a module is cached in the same folder as its .pyc file
+# under the same name, with this suffix instead of .pyc
+NATIVE_CACHE_SUFFIX = '.nativecompile'
+
+use_cache = True
+use_lazy = False
+use_tiered = False
+use_background = False
+
+
+class CacheStats:
+    """Counts how often the native code cache is used.
+
+    A miss is counted when a module has to be compiled because its cache entry
+    doesn't exist, can't be read or was made from a different source file,
+    version of this package, Python build, architecture, ABI or tuning.
+
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'CacheStats(hits={},misses={})'.format(self.hits,self.misses)
+
+cache_stats = CacheStats()
+
+
+def native_cache_path(path,sourceless=False):
+    """Get the name of the file that holds the cached machine code of the
+    module at path"""
+    if not sourceless:
+        path = imp.cache_from_source(path)
+    return os.path.splitext(path)[0] + NATIVE_CACHE_SUFFIX
+
+
+def native_cache_key(path,tuning=Tuning(),lazy=False,tiered=False):
+    """Get the value that a cache entry of the module at path must match.
+
+    If any part of this changes, the cached code cannot be used.
+
+    """
+    st = os.stat(path)
+    return (
+        int(st.st_mtime),
+        st.st_size,
+        __version__,
+        FORMAT_VERSION,
+        sys.version,
+        pyinternals.ARCHITECTURE,
+        Abi.__module__ + '.' + Abi.__name__,
+        lazy,
+        tiered,
+        tuple((k,v) for k,v in ((k,getattr(tuning,k)) for k in sorted(dir(tuning)))
+            if not (k.startswith('_') or callable(v))))
+
+
+def load_cached(cache_path,key):
+    """Return the cached Image at cache_path if it was stored with key.
+    Otherwise return None."""
+    try:
+        with open(cache_path,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as data:
+            ckey,image = marshal.loads(data)
+            if ckey != key:
+                return None
+
+            return Image.loads(image)
+    except (EnvironmentError,EOFError,ValueError,TypeError):
+        return None
+
+
+def store_cached(cache_path,key,image):
+    """Write image to cache_path.
+
+    Like with .pyc files, failing to write the cache is not an error.
+
+    """
+    if sys.dont_write_bytecode: return
+
+    tmp_path = '{}.{}.tmp'.format(cache_path,os.getpid())
+    try:
+        dirname = os.path.dirname(cache_path)
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+
+        with open(tmp_path,'wb') as f:
+            f.write(marshal.dumps((key,image.dumps())))
+
+        if sys.platform == 'win32' and os.path.exists(cache_path):
+            os.remove(cache_path)
+        os.rename(tmp_path,cache_path)
+    except EnvironmentError:
+        try:
+            os.remove(tmp_path)
+        except EnvironmentError:
+            pass
+
+
+def native_functions(namespace,ccode):
+    """Make the functions in namespace use the entry points of ccode.
+
+    Functions and methods that can be reached from namespace (a module's
+    __dict__) and whose code was compiled into ccode get the compiled entry
+    point as their __code__, so calls from compiled code run the machine code.
+    Returns the number of functions changed.
+
+    """
+    # an entry point shares co_code and co_consts with the code object it was
+    # made from, unless it's running counting byte code (see tier0)
+    entries = {}
+    for ep in ccode.entry_points:
+        source = pyinternals.cep_get_source(ep)
+        if source is None: source = ep
+        entries[(id(source.co_code),id(source.co_consts))] = ep
+
+    changed = 0
+    seen = set()
+    def visit(obj):
+        nonlocal changed
+        if id(obj) in seen: return
+        seen.add(id(obj))
+
+        if isinstance(obj,types.FunctionType):
+            ep = entries.get((id(obj.__code__.co_code),id(obj.__code__.co_consts)))
+            if ep is not None and ep is not obj.__code__:
+                obj.__code__ = ep
+                changed += 1
+        elif isinstance(obj,(staticmethod,classmethod)):
+            visit(obj.__func__)
+        elif isinstance(obj,property):
+            for f in (obj.fget,obj.fset,obj.fdel): visit(f)
+        elif isinstance(obj,type) and obj.__module__ == namespace.get('__name__'):
+            for v in list(obj.__dict__.values()): visit(v)
+
+    for v in list(namespace.values()): visit(v)
+    return changed
+
+
+class BackgroundCompiler:
+    """Compiles modules on a separate thread.
+
+    A module given to add has already been run as bytecode. When its machine
+    code is ready, its functions are switched over with native_functions.
+
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self,module,code,cache_path=None,key=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,name='nativecompile')
+                self.thread.daemon = True
+                self.thread.start()
+
+        self.queue.put((module,code,cache_path,key))
+
+    def run(self):
+        while True:
+            module,code,cache_path,key = self.queue.get()
+            try:
+                if cache_path is None:
+                    ccode = compile(code,use_lazy,use_tiered)
+                else:
+                    image = compile_image(code,lazy=use_lazy,tiered=use_tiered)
+                    store_cached(cache_path,key,image)
+                    ccode = image.load()
+
+                module.__nativecompile_compiled_code__ = ccode
+                native_functions(module.__dict__,ccode)
+            except Exception as e:
+                warnings.warn(
+                    'module {} could not be compiled: {}'.format(module.__name__,e),
+                    RuntimeWarning)
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """Block until every module given to add has been compiled"""
+        self.queue.join()
+
+background_compiler = BackgroundCompiler()
 
 
 class Finder:
@@ -42,7 +238,6 @@ def xloader(base):
         @importlib._bootstrap.module_for_loader
         def _load_module(self, module, *, sourceless=False):
             name = module.__name__
-            code_object = self.get_code(name)
             module.__file__ = self.get_filename(name)
             if not sourceless:
                 module.__cached__ = imp.cache_from_source(module.__file__)
@@ -55,7 +250,28 @@ def xloader(base):
                 module.__package__ = module.__package__.rpartition('.')[0]
             module.__loader__ = self
 
-            ccode = compile(code_object)
+            if use_cache:
+                cache_path = native_cache_path(module.__file__,sourceless)
+                key = native_cache_key(module.__file__,lazy=use_lazy,tiered=use_tiered)
+                image = load_cached(cache_path,key)
+                if image is None:
+                    cache_stats.misses += 1
+                    code = self.get_code(name)
+                    if use_background:
+                        return self._run_bytecode(module,code,cache_path,key)
+
+                    image = compile_image(code,lazy=use_lazy,tiered=use_tiered)
+                    store_cached(cache_path,key,image)
+                else:
+                    cache_stats.hits += 1
+
+                ccode = image.load()
+            else:
+                code = self.get_code(name)
+                if use_background:
+                    return self._run_bytecode(module,code)
+
+                ccode = compile(code,use_lazy,use_tiered)
 
             # stick the CompiledCode object here to keep it alive
             module.__nativecompile_compiled_code__ = ccode
@@ -63,6 +279,11 @@ def xloader(base):
             pyinternals.cep_exec(ccode.entry_points[0], module.__dict__)
             return module
 
+        def _run_bytecode(self,module,code,cache_path=None,key=None):
+            exec(code,module.__dict__)
+            background_compiler.add(module,code,cache_path,key)
+            return module
+
     return inner
 
 
@@ -88,7 +309,29 @@ def path_hook(path):
     else:
         raise ImportError("only directories are supported")
 
-def install_importer():
+def install_importer(cache=True,lazy=False,tiered=False,background=False):
+    """Compile modules as they are imported.
+
+    If cache is true, compiled modules are cached on disk and reused by later
+    imports, the same way .pyc files are.
+
+    If lazy is true, only the module-level code is compiled when a module is
+    imported. Functions and class bodies are compiled the first time they run.
+
+    If tiered is true, functions and class bodies are only compiled once they
+    become hot (see compile.set_tier_threshold).
+
+    If background is true, a module that isn't in the cache is run as bytecode
+    right away and compiled on a separate thread. Once its machine code is
+    ready, its functions and methods are switched to it (see native_functions).
+    background_compiler.wait() blocks until every such module is done.
+
+    """
+    global use_cache, use_lazy, use_tiered, use_background
+    use_cache = cache
+    use_lazy = lazy
+    use_tiered = tiered
+    use_background = background
     sys.path_hooks.append(path_hook)
 
 def uninstall_importer():
@@ -7,29 +7,121 @@ import inspect
 registry = {}
 
 
-# Since this implementation doesn't match derived types to base types, a class
-# can define __mmtype__ to specifiy what type it is a substitute for (it's not a
-# complete solution but it's enough for this package).
-def mmtype(x):
-    return getattr(x,'__mmtype__',x)
+def _dominates(a,b):
+    return a != b and all(issubclass(x,y) for x,y in zip(a,b))
+
+
+_DISPATCH_TEMPLATE = '''
+def dispatch({args}):
+    f = cache.get({key})
+    if f is None: f = resolve({key})
+    return f({args})
+'''
+
+_MEMO_DISPATCH_TEMPLATE = '''
+def dispatch({args}):
+    k = ({args}{comma})
+    r = memo.get(k)
+    if r is None:
+        f = cache.get({key})
+        if f is None: f = resolve({key})
+        r = f({args})
+        if len(memo) >= memo_size: memo.clear()
+        memo[k] = r
+    return r
+'''
+
+def _make_dispatcher(arity,cache,resolve,memo=None,memo_size=0):
+    """Generate a function that takes exactly arity arguments and calls the
+    overload that matches their classes.
+
+    If memo is not None, it is used to remember the result for every
+    combination of arguments. It is emptied whenever it reaches memo_size
+    entries.
+
+    """
+    args = ','.join('a{}'.format(i) for i in range(arity))
+    comma = ',' if arity == 1 else ''
+    key = '({}{})'.format(','.join('a{}.__class__'.format(i) for i in range(arity)),comma)
+    ns = {'cache' : cache,'resolve' : resolve,'memo' : memo,'memo_size' : memo_size}
+    template = _DISPATCH_TEMPLATE if memo is None else _MEMO_DISPATCH_TEMPLATE
+    exec(template.format(args=args,key=key,comma=comma),ns)
+    return ns['dispatch']
 
 
 class MultiMethod(object):
+    """A function that calls one of several overloads depending on the classes
+    of its arguments.
+
+    An overload matches if every argument is an instance of the corresponding
+    registered type. If more than one overload matches, the one whose types
+    are all subclasses of the other matching overloads' types is used.
+    Resolved overloads are cached by the exact classes of the arguments.
+
+    Every instance has its own subclass so that __call__ can be replaced with a
+    dispatcher specialized for the number of arguments the overloads take.
+
+    After memoize is called, the result of every call is remembered. This is
+    only correct if the overloads are pure functions and every argument is
+    immutable and hashable.
+
+    """
+    def __new__(cls,name):
+        return object.__new__(type(cls.__name__,(cls,),{}))
+
     def __init__(self, name):
         self.name = name
         self.typemap = {}
+        self.cache = {}
+        self.memo = None
+        self.memo_size = 0
+        self._update()
+
     def __call__(self, *args,**kwds):
         if kwds:
             raise TypeError("keyword arguments not supported by multimethods")
-        types = tuple(mmtype(arg.__class__) for arg in args)
-        function = self.typemap.get(types)
-        if function is None:
-            raise TypeError("no match for {} called with ({})".format(self.name,','.join(t.__name__ for t in types)))
-        return function(*args)
+        return self.resolve(tuple(arg.__class__ for arg in args))(*args)
+
+    def resolve(self,types):
+        matches = [k for k in self.typemap
+            if len(k) == len(types) and all(issubclass(t,k_t) for t,k_t in zip(types,k))]
+        best = [k for k in matches if not any(_dominates(m,k) for m in matches)]
+        if len(best) != 1:
+            raise TypeError("{} for {} called with ({})".format(
+                'ambiguous overloads' if best else 'no match',
+                self.name,
+                ','.join(t.__name__ for t in types)))
+        function = self.cache[types] = self.typemap[best[0]]
+        return function
+
+    def _update(self):
+        self.cache.clear()
+        if self.memo is not None: self.memo.clear()
+        arities = set(len(k) for k in self.typemap)
+        if len(arities) == 1:
+            dispatch = _make_dispatcher(arities.pop(),self.cache,self.resolve,self.memo,self.memo_size)
+            type(self).__call__ = staticmethod(dispatch)
+        elif arities:
+            dispatchers = dict((n,_make_dispatcher(n,self.cache,self.resolve,self.memo,self.memo_size)) for n in arities)
+            def dispatch(*args):
+                d = dispatchers.get(len(args))
+                if d is None:
+                    raise TypeError("no match for {} called with {} arguments".format(self.name,len(args)))
+                return d(*args)
+            type(self).__call__ = staticmethod(dispatch)
+
+    def memoize(self,size):
+        """Remember the results of up to size calls, or stop remembering them
+        if size is 0"""
+        self.memo = {} if size else None
+        self.memo_size = size
+        self._update()
+
     def register(self, types, function):
         if types in self.typemap:
             raise TypeError("duplicate registration")
         self.typemap[types] = function
+        self._update()
 
     def inherit(self,b):
         """Add all overloads from b that this multimethod doesn't already
@@ -37,6 +129,7 @@ class MultiMethod(object):
 
         for k,v in b.typemap.items():
             self.typemap.setdefault(k,v)
+        self._update()
 
 
 def multimethod(function):
@@ -44,8 +137,6 @@ def multimethod(function):
     mm = registry.get(i)
     if mm is None:
         mm = registry[i] = MultiMethod(function.__name__)
-    types = tuple(mmtype(function.__annotations__[arg]) for arg in inspect.getfullargspec(function)[0])
+    types = tuple(function.__annotations__[arg] for arg in inspect.getfullargspec(function)[0])
     mm.register(types, function)
     return mm
-
-
@@ -0,0 +1,298 @@
+"""Whole-package native images.
+
+compile_package compiles every module of a package into a single Image. Since
+all the code ends up in the same block of memory, a call from one function of
+the package to another can be made with a direct call instruction instead of
+going through call_function, provided the compiler can tell which function is
+being called. PackageResolver makes that guess by looking at how each module
+binds its global names. The guess is checked every time the call is made, so a
+wrong guess (e.g. a function replaced by monkey-patching) only makes the call
+take the normal route.
+
+"""
+
+import os
+import os.path
+import sys
+import dis
+import types
+import marshal
+import builtins
+
+from . import pyinternals
+from .image import Image, compile_image
+
+
+# increase this whenever the format of the serialized data changes
+FORMAT_VERSION = 1
+
+
+# a global name bound in more than one way
+AMBIGUOUS = object()
+
+
+def instructions(code):
+    """Yield (op,arg) for every instruction in code. arg is None for
+    instructions that don't take an argument."""
+    co_code = code.co_code
+    i = 0
+    extended_arg = 0
+    while i < len(co_code):
+        op = co_code[i]
+        i += 1
+        if op >= dis.HAVE_ARGUMENT:
+            arg = co_code[i] + (co_code[i+1] << 8) + extended_arg
+            i += 2
+            if op == dis.EXTENDED_ARG:
+                extended_arg = arg << 16
+                continue
+            extended_arg = 0
+            yield op,arg
+        else:
+            yield op,None
+
+
+def nested_code(code):
+    """Yield code and every code object nested in it"""
+    yield code
+    for c in code.co_consts:
+        if isinstance(c,types.CodeType):
+            for n in nested_code(c): yield n
+
+
+def absolute_name(module,is_package,name,level):
+    """Get the absolute name of a module imported by module with the given
+    level (the number of leading dots in a relative import)"""
+    if level == 0: return name
+
+    base = module.split('.')
+    if not is_package: base.pop()
+    if level > 1: base = base[:-(level-1)]
+    if name: base.append(name)
+    return '.'.join(base)
+
+
+class PackageResolver:
+    """Guess what the global names of a package's modules refer to.
+
+    Only the module-level code is examined. A name is known if it is bound
+    exactly once, by a def statement without default arguments, decorators or
+    annotations, or by an import statement. A name that is assigned to by any
+    other means, anywhere in the module, is not known.
+
+    """
+    def __init__(self):
+        self.modules = {}
+        self.code_modules = {}
+
+    def add_module(self,name,code,is_package=False):
+        bindings = {}
+        def bind(n,ref):
+            bindings[n] = ref if ref is not None and bindings.get(n,ref) == ref else AMBIGUOUS
+
+        # A very small part of the stack is simulated: only the instructions
+        # needed to follow def and import statements. Any other instruction
+        # makes the contents of the stack unknown.
+        stack = []
+        def pop():
+            return stack.pop() if stack else None
+
+        for op,arg in instructions(code):
+            opname = dis.opname[op]
+            if opname == 'LOAD_CONST':
+                stack.append(('const',code.co_consts[arg]))
+            elif opname == 'MAKE_FUNCTION':
+                c = pop()
+                stack.append(('function',c[1])
+                    if c and c[0] == 'const' and isinstance(c[1],types.CodeType) and arg == 0
+                    else None)
+            elif opname == 'IMPORT_NAME':
+                fromlist = pop()
+                level = pop()
+                imported = None
+                if fromlist and level:
+                    imported = absolute_name(name,is_package,code.co_names[arg],level[1])
+                    if fromlist[1] is None:
+                        # "import a.b" binds "a"
+                        imported = imported.partition('.')[0] if level[1] == 0 else None
+                stack.append(imported and ('module',imported))
+            elif opname in ('IMPORT_FROM','LOAD_ATTR'):
+                module = stack[-1] if stack else None
+                if opname == 'LOAD_ATTR': pop()
+                stack.append(('attr',module[1],code.co_names[arg])
+                    if module and module[0] == 'module'
+                    else None)
+            elif opname in ('STORE_NAME','STORE_GLOBAL'):
+                value = pop()
+                bind(code.co_names[arg],None if value and value[0] == 'const' else value)
+            elif opname in ('DELETE_NAME','DELETE_GLOBAL'):
+                bind(code.co_names[arg],None)
+            elif opname == 'IMPORT_STAR':
+                # any name bound so far could be replaced
+                for n in bindings: bindings[n] = AMBIGUOUS
+                del stack[:]
+            elif opname == 'POP_TOP':
+                pop()
+            else:
+                del stack[:]
+
+        for c in nested_code(code):
+            self.code_modules[id(c)] = name
+            if c is not code:
+                # functions can rebind globals too
+                for op,arg in instructions(c):
+                    if dis.opname[op] in ('STORE_GLOBAL','DELETE_GLOBAL'):
+                        bindings[c.co_names[arg]] = AMBIGUOUS
+
+        self.modules[name] = bindings
+
+    def lookup(self,module,name,_seen=frozenset()):
+        bindings = self.modules.get(module)
+        if bindings is None or (module,name) in _seen: return None
+
+        ref = bindings.get(name)
+        if ref is None or ref is AMBIGUOUS: return None
+        if ref[0] == 'function': return ref[1]
+        if ref[0] == 'attr':
+            return self.attr_ref(('module',ref[1]),ref[2],_seen | {(module,name)})
+        return ref
+
+    def global_ref(self,code,name):
+        module = self.code_modules.get(id(code))
+        return None if module is None else self.lookup(module,name)
+
+    def attr_ref(self,ref,name,_seen=frozenset()):
+        if not (isinstance(ref,tuple) and ref[0] == 'module'):
+            return None
+
+        # a submodule takes precedence because importing it binds it as an
+        # attribute of its package
+        sub = ref[1] + '.' + name
+        if sub in self.modules: return ('module',sub)
+        return self.lookup(ref[1],name,_seen)
+
+
+class PackageImage:
+    """An Image of all the modules of a package.
+
+    modules maps the full name of every module to a tuple of the index of its
+    code object in image.codes, whether it is a package and its file name.
+
+    """
+    def __init__(self,image,modules):
+        self.image = image
+        self.modules = modules
+
+    def dumps(self):
+        return marshal.dumps((FORMAT_VERSION,self.image.dumps(),self.modules))
+
+    @classmethod
+    def loads(cls,data):
+        version,image,modules = marshal.loads(data)
+        if version != FORMAT_VERSION:
+            raise ValueError('the package image was created by an incompatible version of this package')
+
+        return cls(Image.loads(image),modules)
+
+    def install(self):
+        """Load the image and make the modules in it importable.
+
+        The modules take precedence over any other modules with the same name.
+
+        """
+        importer = PackageImporter(self.image.load(),self.modules)
+        sys.meta_path.insert(0,importer)
+        return importer
+
+
+class PackageImporter:
+    """A PEP 302 finder and loader for the modules of a loaded PackageImage"""
+    def __init__(self,ccode,modules):
+        self.ccode = ccode
+        self.modules = modules
+
+    def find_module(self,fullname,path=None):
+        return self if fullname in self.modules else None
+
+    def load_module(self,fullname):
+        module = sys.modules.get(fullname)
+        if module is not None: return module
+
+        index,is_package,filename = self.modules[fullname]
+        module = types.ModuleType(fullname)
+        module.__file__ = filename
+        module.__loader__ = self
+        if is_package:
+            module.__path__ = [os.path.dirname(filename)]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+
+        # stick the CompiledCode object here to keep it alive
+        module.__nativecompile_compiled_code__ = self.ccode
+
+        sys.modules[fullname] = module
+        try:
+            pyinternals.cep_exec(self.ccode.entry_points[index],module.__dict__)
+        except:
+            del sys.modules[fullname]
+            raise
+
+        return sys.modules[fullname]
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+
+def package_modules(path,name=None):
+    """Yield (module name,file name,is package) for every module of the package
+    in directory path"""
+    if name is None: name = os.path.basename(os.path.normpath(path))
+
+    for dirpath,dirnames,filenames in os.walk(path):
+        rel = os.path.relpath(dirpath,path)
+        prefix = name if rel == os.curdir else name + '.' + rel.replace(os.sep,'.')
+        if '__init__.py' not in filenames:
+            del dirnames[:]
+            continue
+
+        dirnames.sort()
+        for fname in sorted(filenames):
+            base,ext = os.path.splitext(fname)
+            if ext != '.py': continue
+
+            full = os.path.join(dirpath,fname)
+            if base == '__init__':
+                yield prefix,full,True
+            else:
+                yield prefix + '.' + base,full,False
+
+
+def compile_package(path,name=None,direct_calls=True,workers=None):
+    """Compile every module of the package in directory path into a
+    PackageImage.
+
+    If direct_calls is true, calls between functions of the package are made
+    directly when possible (see PackageResolver).
+
+    If workers is greater than 1, the package is compiled by that many
+    processes.
+
+    """
+    resolver = PackageResolver() if direct_calls else None
+    codes = []
+    names = []
+    for modname,filename,is_package in package_modules(path,name):
+        with open(filename,'rb') as f:
+            code = builtins.compile(f.read(),filename,'exec',dont_inherit=True)
+        codes.append(code)
+        names.append((modname,filename,is_package))
+        if resolver is not None:
+            resolver.add_module(modname,code,is_package)
+
+    image = compile_image(codes,resolver,workers=workers)
+    indices = dict((id(c),i) for i,c in enumerate(image.codes))
+
+    return PackageImage(image,dict(
+        (modname,(indices[id(code)],is_package,filename))
+        for code,(modname,filename,is_package) in zip(codes,names)))
@@ -0,0 +1,240 @@
+"""Removing redundant instructions from generated machine code.
+
+The opcode handlers generate their instructions without knowing what came
+before them, so the same value is often loaded into a register that already
+has it, or read back from memory right after being written there. CodeBuffer
+collects runs of instructions that can only be entered at the start (there are
+no jump targets in between) and passes them to 'optimize', which keeps track
+of which registers are known to hold which values and removes or simplifies
+the instructions that don't change anything.
+
+Instructions are (name,args) tuples, the same as the operations of an
+AsmSequence: a mnemonic and the operands in AT&T order (the destination is
+last). A jump out of the run is given as JUMP. Jumps that skip over part of
+the run (the ones with a Displacement operand) are also part of it, but the
+instructions they skip must stay the same size and are not changed.
+
+"""
+
+from .x86_ops import Register, Address, Displacement
+
+
+JUMP = ('$JUMP$',())
+COMMENT = '$COMMENT$'
+
+# instructions that only set the flags
+COMPARISONS = frozenset(['test','testb','testl','cmp','cmpb','cmpl'])
+
+# instructions that change their last operand and the flags, and do nothing
+# else besides reading their operands
+ARITHMETIC = frozenset(
+    n + s for n in ['add','sub','and','or','xor','shl','shr','sar','inc','dec']
+    for s in ['','b','l']) | frozenset(['imul'])
+
+# SSE instructions, which only change their last operand (an XMM register or,
+# with movsd, memory) and, with ucomisd, the flags
+SSE = frozenset(['movsd','addsd','subsd','mulsd','divsd','ucomisd','xorpd','cvtsi2sd'])
+
+
+class _Pass:
+    def __init__(self,abi,frame_size):
+        self.word = abi.r_sp.size
+        self.word_bytes = abi.ptr_size
+        self.sp = abi.r_sp
+        self.bp = abi.r_bp
+        self.stack_regs = (abi.r_sp,abi.r_bp)
+
+        # how far the base pointer is above the stack pointer, until either
+        # changes
+        self.frame_size = frame_size
+
+        # for each register, the operands it's known to be equal to
+        self.values = {}
+
+        # the register that the flags were last set from with "test r,r"
+        self.flags = None
+
+    def forget(self):
+        self.values.clear()
+        self.flags = None
+
+    def snapshot(self):
+        return dict((r,set(vals)) for r,vals in self.values.items()),self.flags,self.frame_size
+
+    def merge(self,state):
+        """Keep only what is also true in state, which is what snapshot
+        returned somewhere that jumps to here, or None if that's unknown"""
+        if state is None:
+            self.forget()
+            self.frame_size = None
+            return
+
+        values,flags,frame_size = state
+        for r in list(self.values):
+            self.values[r] &= values.get(r,set())
+        if flags != self.flags: self.flags = None
+        if frame_size != self.frame_size: self.frame_size = None
+
+    def plain(self,x):
+        """Whether x can be remembered as a value.
+
+        RelocAddress placeholders are equal to any other instance with the
+        same placeholder value and RIP-relative addresses depend on where the
+        instruction is, so they can't be.
+
+        """
+        if isinstance(x,Register): return x.size == self.word
+        if isinstance(x,Address):
+            return (type(x.offset) is int
+                and (x.base is None or isinstance(x.base,Register))
+                and (x.base is None or x.base.size == self.word)
+                and (x.index is None or x.index.size == self.word))
+        return type(x) is int
+
+    def on_stack(self,addr):
+        return addr.base in self.stack_regs
+
+    def from_sp(self,addr):
+        if self.frame_size is not None and addr.base == self.bp and addr.index is None:
+            return addr.replace(offset=addr.offset + self.frame_size,base=self.sp)
+        return addr
+
+    def may_alias(self,a,b):
+        if not (self.plain(a) and self.plain(b)):
+            return self.on_stack(a) == self.on_stack(b)
+        a = self.from_sp(a)
+        b = self.from_sp(b)
+        if a.base == b.base and a.index == b.index and a.scale == b.scale:
+            return abs(a.offset - b.offset) < self.word_bytes
+
+        # the native stack is never reached through any register besides the
+        # stack and base pointers
+        return self.on_stack(a) == self.on_stack(b)
+
+    def write(self,r):
+        """Forget everything that depends on the value of register r"""
+        if r in self.stack_regs: self.frame_size = None
+        self.values.pop(r,None)
+        for vals in self.values.values():
+            for v in list(vals):
+                if v == r or (isinstance(v,Address) and (v.base == r or v.index == r)):
+                    vals.discard(v)
+        if self.flags == r: self.flags = None
+
+    def store(self,addr):
+        """Forget everything that memory at addr might have been equal to"""
+        for vals in self.values.values():
+            for v in list(vals):
+                if isinstance(v,Address) and self.may_alias(v,addr):
+                    vals.discard(v)
+
+    def known(self,r,x):
+        vals = self.values.get(r,())
+        return x in vals or (isinstance(x,Register) and r in self.values.get(x,()))
+
+    def mov(self,ins,a,b):
+        if isinstance(b,Register):
+            if a == b or (self.plain(a) and self.known(b,a)): return None
+
+            if isinstance(a,Address) and self.plain(a):
+                # read a register instead of memory with the same value
+                for r,vals in self.values.items():
+                    if r != b and a in vals:
+                        ins = ('mov',(r,b))
+                        break
+
+            self.write(b)
+            if self.plain(a) and not (isinstance(a,Address) and (a.base == b or a.index == b)):
+                vals = self.values[b] = {a}
+                if isinstance(a,Register):
+                    vals.update(self.values.get(a,()))
+            return ins
+
+        if isinstance(a,Register) and self.plain(b) and b in self.values.get(a,()):
+            return None
+
+        self.store(b)
+        if isinstance(a,Register) and self.plain(b) and b.base != a and b.index != a:
+            self.values.setdefault(a,set()).add(b)
+        return ins
+
+    def step(self,ins):
+        name,args = ins
+        if ins == JUMP or name == COMMENT: return ins
+
+        # a jump within instrs (see optimize)
+        if name.startswith('j') and args and isinstance(args[-1],Displacement):
+            return ins
+
+        if name == 'call' or any(isinstance(a,Register) and a.size != self.word for a in args):
+            self.forget()
+            return ins
+
+        if name == 'mov' and len(args) == 2:
+            return self.mov(ins,*args)
+
+        if name == 'test' and len(args) == 2 and isinstance(args[0],Register) and args[0] == args[1]:
+            if self.flags == args[0]: return None
+            self.flags = args[0]
+            return ins
+
+        if name in SSE:
+            if name == 'ucomisd': self.flags = None
+            if isinstance(args[-1],Address): self.store(args[-1])
+            return ins
+
+        if name in COMPARISONS:
+            self.flags = None
+            return ins
+
+        if name in ARITHMETIC or name in ('lea','movb','movl'):
+            if name not in ('lea','movb','movl'): self.flags = None
+            dest = args[-1]
+            if isinstance(dest,Register):
+                self.write(dest)
+                if name == 'xor' and args[0] == dest: self.values[dest] = {0}
+            else:
+                self.store(dest)
+            return ins
+
+        if name in ('push','pop','leave','ret'): self.frame_size = None
+        self.forget()
+        return ins
+
+
+def optimize(instrs,abi,frame_size=None,fixed=(),joins=None):
+    """Get a list the same length as instrs, where every instruction is either
+    the same tuple, a replacement for it or None if it can be removed.
+
+    frame_size is how far the base pointer is above the stack pointer at the
+    start of instrs, if that is known. Otherwise, every write to the stack is
+    assumed to change anything on the stack that isn't addressed relative to
+    the same register.
+
+    fixed has the indices of the instructions that can't be changed. joins
+    maps the index of an instruction to the indices of the jumps (in instrs)
+    that go to it. A jump given as None comes from somewhere outside instrs.
+
+    """
+    return optimize_run(instrs,abi,frame_size,fixed,joins)[0]
+
+def optimize_run(instrs,abi,frame_size=None,fixed=(),joins=None):
+    """Like optimize, but return an (instructions,frame_size) pair, where
+    frame_size is how far the base pointer is above the stack pointer at the
+    end of instrs, or None if an instruction changed either of them"""
+    p = _Pass(abi,frame_size)
+    jumps = {}
+    if joins:
+        for sources in joins.values():
+            jumps.update((j,None) for j in sources if j is not None)
+
+    r = []
+    for i,ins in enumerate(instrs):
+        if joins and i in joins:
+            for j in joins[i]:
+                p.merge(jumps.get(j) if j is not None else None)
+
+        new = p.step(ins)
+        r.append(ins if i in fixed else new)
+        if i in jumps: jumps[i] = p.snapshot()
+    return r,p.frame_size
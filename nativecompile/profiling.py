@@ -0,0 +1,175 @@
+"""Measuring the compiler.
+
+A CompileProfile passed to compile_raw records how much time is spent in each
+phase of compilation and in the handler of each opcode. Where the tracemalloc
+module is available and tracing, the net amount of memory allocated is recorded
+too; otherwise (always on Python 3.2, which has no tracemalloc) the memory is
+None, meaning unknown, rather than 0.
+
+Functions added with add_compile_hook are called with a CompileEvent after
+every code object is compiled, whether or not a profile is used.
+
+"""
+
+import time
+import collections
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+timer = getattr(time,'perf_counter',time.time)
+
+
+CompileEvent = collections.namedtuple('CompileEvent',
+    'name filename firstlineno bytecode_size native_size compile_time')
+
+
+compile_hooks = []
+
+def add_compile_hook(func):
+    """Call func with a CompileEvent every time a code object is compiled"""
+    compile_hooks.append(func)
+
+def remove_compile_hook(func):
+    compile_hooks.remove(func)
+
+def fire_compile_hooks(code,native_size,compile_time):
+    if compile_hooks:
+        event = CompileEvent(
+            code.co_name,
+            code.co_filename,
+            code.co_firstlineno,
+            len(code.co_code),
+            native_size,
+            compile_time)
+        for h in compile_hooks: h(event)
+
+
+def allocated():
+    """Get the amount of memory currently traced by tracemalloc, or None if it
+    isn't tracing"""
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+
+def add_memory(a,b):
+    """Add two amounts of memory, either of which may be None (unknown)"""
+    return None if a is None or b is None else a + b
+
+
+class Stats:
+    """The number of times something was measured and the total time and
+    memory it took. memory is None if it wasn't known every time."""
+    __slots__ = ('count','time','memory')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.memory = 0
+
+    def __repr__(self):
+        return 'Stats(count={},time={:.6f},memory={})'.format(self.count,self.time,self.memory)
+
+
+class Measure:
+    def __init__(self,stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.memory = allocated()
+        self.start = timer()
+
+    def __exit__(self,*exc):
+        self.stats.time += timer() - self.start
+        end = allocated()
+        self.stats.memory = add_memory(
+            self.stats.memory,
+            None if end is None or self.memory is None else end - self.memory)
+        self.stats.count += 1
+
+
+class NullMeasure:
+    def __enter__(self): pass
+    def __exit__(self,*exc): pass
+
+null_measure = NullMeasure()
+
+
+def phase(profile,name):
+    """Measure phase name if profile is not None"""
+    return null_measure if profile is None else profile.phase(name)
+
+
+class CompileProfile:
+    """Time and memory spent by compile_raw.
+
+    phases maps the name of each phase to a Stats object. The phases are
+    "compile_eval" (generating the code of every function, including the
+    opcode handlers), "flow_graph" (finding the basic blocks of each function,
+    which is part of compile_eval), "resolve_jumps", "link" and "finish"
+    (setting the entry point offsets and joining the code). handlers maps
+    opcode names to the Stats of their handlers.
+
+    jumps counts the jumps within functions by the form they were given
+    ("removed", "short" or "full"), and has the total number of bytes they
+    take ("bytes") and would take if they all had the full-size form
+    ("full_size_bytes").
+
+    """
+    def __init__(self):
+        self.phases = collections.defaultdict(Stats)
+        self.handlers = collections.defaultdict(Stats)
+        self.jumps = collections.Counter()
+
+    def phase(self,name):
+        """A context manager that adds the time spent in its body to phase
+        name"""
+        return Measure(self.phases[name])
+
+    def handler(self,opname,func):
+        """Wrap the handler of opcode opname to measure it"""
+        stats = self.handlers[opname]
+        def inner(*args):
+            with Measure(stats):
+                return func(*args)
+        return inner
+
+    def add_jump(self,size,sizes):
+        """Count a jump that was given size bytes, where sizes are the lengths
+        of its short and full-size forms"""
+        short,full = sizes
+        self.jumps['removed' if size == 0 else 'short' if size == short else 'full'] += 1
+        self.jumps['bytes'] += size
+        self.jumps['full_size_bytes'] += full
+
+    def merge(self,other):
+        self.jumps.update(other.jumps)
+        for mine,theirs in ((self.phases,other.phases),(self.handlers,other.handlers)):
+            for name,s in theirs.items():
+                m = mine[name]
+                m.count += s.count
+                m.time += s.time
+                m.memory = add_memory(m.memory,s.memory)
+
+    def report(self,top=20):
+        """Return a table of the phases and the slowest handlers as a string"""
+        lines = ['{:<24}{:>8}{:>12}{:>12}'.format('phase','count','seconds','bytes')]
+        def add(items):
+            for name,s in items:
+                lines.append('{:<24}{:>8}{:>12.6f}{:>12}'.format(
+                    name,s.count,s.time,'?' if s.memory is None else s.memory))
+
+        add(sorted(self.phases.items(),key=lambda x: -x[1].time))
+        lines.append('')
+        lines.append('{:<24}{:>8}{:>12}{:>12}'.format('handler','count','seconds','bytes'))
+        add(sorted(self.handlers.items(),key=lambda x: -x[1].time)[:top])
+        j = self.jumps
+        if j:
+            lines.append('')
+            lines.append('jumps: {} short, {} full, {} removed; {} bytes ({} with only full-size jumps)'.format(
+                j['short'],j['full'],j['removed'],j['bytes'],j['full_size_bytes']))
+        return '\n'.join(lines)
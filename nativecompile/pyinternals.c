@@ -2,11 +2,12 @@
 #include <Python.h>
 #include <structmember.h>
 #include <frameobject.h>
+#include <longintrepr.h>
 
 #if defined(__linux__) || defined(__linux) || defined(linux)
     #include <sys/mman.h>
     #include <unistd.h>
-    #include <fcntl.h>
+    #include <errno.h>
     
     #define USE_MMAP 1
 #endif
@@ -89,9 +90,16 @@ typedef struct {
     /* a tuple of CodeObjectWithCCode objects */
     PyObject *entry_points;
 
+    /* a list of the CompiledCode objects created when the lazy entry points in
+       entry_points were compiled, or NULL */
+    PyObject *children;
+
 #ifdef USE_MMAP
-    int fd;
     size_t len;
+
+    /* the code arena that entry is part of or NULL if entry has its own
+       mapping */
+    struct Arena *arena;
 #endif
 } CompiledCode;
 
@@ -150,8 +158,20 @@ static PyTypeObject CompiledCodeType = {
 
 
 #define CO_COMPILED (1 << 31)
+
+/* An entry point with one of these offsets doesn't have machine code yet. With
+   OFFSET_LAZY, the code is compiled when it is first run (see get_ccode).
+   With OFFSET_TIERED, the code is run by the interpreter until it has been
+   called and has looped tier_threshold times in total and is then compiled
+   (see tier0_enter). With
+   OFFSET_NONE, the code is always run by the interpreter. */
+#define OFFSET_LAZY ((unsigned int)-1)
+#define OFFSET_NONE ((unsigned int)-2)
+#define OFFSET_TIERED ((unsigned int)-3)
+
 #define HAS_CCODE(obj) (((PyCodeObject*)obj)->co_flags & CO_COMPILED && \
-                        ((CodeObjectWithCCode*)obj)->compiled_code)
+                        ((CodeObjectWithCCode*)obj)->compiled_code && \
+                        ((CodeObjectWithCCode*)obj)->offset < OFFSET_TIERED)
 #define GET_CCODE_FUNC(obj) ((entry_type)(\
     (char*)(((CodeObjectWithCCode*)obj)->compiled_code->entry) + \
     ((CodeObjectWithCCode*)obj)->offset))
@@ -186,6 +206,18 @@ typedef struct {
     CompiledCode *compiled_code;
 
     unsigned int offset;
+
+    /* for tiered compilation: the number of times this code has been run by
+       the interpreter and the number of loop iterations it ran while doing
+       so */
+    unsigned int calls;
+    unsigned int backedges;
+
+    /* if the byte code of a tiered entry point was replaced with counting
+       byte code (see cep_set_tier0), this is a code object with the original,
+       which is what gets compiled. Like compiled_code, it is only set while
+       the entry point belongs to a CompiledCode object. */
+    PyCodeObject *source;
 } CodeObjectWithCCode;
 
 
@@ -198,7 +230,10 @@ static PyObject *create_compiled_entry_point(PyObject *self,PyObject *_arg) {
         return NULL;
     }
 
-    if(arg->co_flags & CO_COMPILED) {
+    /* a lazy entry point is compiled by creating a new entry point from it */
+    if(arg->co_flags & CO_COMPILED &&
+            ((CodeObjectWithCCode*)arg)->offset != OFFSET_LAZY &&
+            ((CodeObjectWithCCode*)arg)->offset != OFFSET_TIERED) {
         PyErr_SetString(PyExc_TypeError,"argument is already a compiled entry point");
         return NULL;
     }
@@ -235,6 +270,9 @@ static PyObject *create_compiled_entry_point(PyObject *self,PyObject *_arg) {
 
         ep->compiled_code = NULL;
         ep->offset = 0;
+        ep->calls = 0;
+        ep->backedges = 0;
+        ep->source = NULL;
     }
 
     return (PyObject*)ep;
@@ -279,6 +317,231 @@ static PyObject *cep_set_offset(PyObject *self,PyObject *args) {
     Py_RETURN_NONE;
 }
 
+static PyObject *lazy_compiler = NULL;
+
+static PyObject *set_lazy_compiler(PyObject *self,PyObject *arg) {
+    if(arg == Py_None) arg = NULL;
+    else if(!PyCallable_Check(arg)) {
+        PyErr_SetString(PyExc_TypeError,"argument must be callable or None");
+        return NULL;
+    }
+
+    Py_XINCREF(arg);
+    Py_XDECREF(lazy_compiler);
+    lazy_compiler = arg;
+
+    Py_RETURN_NONE;
+}
+
+static unsigned int tier_threshold = 1000;
+
+static PyObject *set_tier_threshold(PyObject *self,PyObject *arg) {
+    unsigned long t = PyLong_AsUnsignedLong(arg);
+    if(PyErr_Occurred()) return NULL;
+    tier_threshold = (unsigned int)t;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *cep_get_counters(PyObject *self,PyObject *_arg) {
+    CodeObjectWithCCode *arg = (CodeObjectWithCCode*)_arg;
+
+    CEP_CHECK(arg)
+
+    return Py_BuildValue("II",arg->calls,arg->backedges);
+}
+
+/* Make a tiered entry point run the given byte code, which must be the entry
+   point's own byte code with the counters of tier0.py added, until it is
+   compiled. A code object with the original byte code is kept as the
+   entry point's source. */
+static PyObject *cep_set_tier0(PyObject *self,PyObject *args) {
+    CodeObjectWithCCode *cep;
+    PyObject *code;
+    PyObject *consts;
+    PyObject *lnotab;
+    int stacksize;
+    PyCodeObject *source;
+
+    if(!PyArg_ParseTuple(args,"OSO!Si",&cep,&code,&PyTuple_Type,&consts,&lnotab,&stacksize))
+        return NULL;
+
+    CEP_CHECK(cep)
+
+    if(cep->offset != OFFSET_TIERED || cep->source || cep->compiled_code) {
+        PyErr_SetString(PyExc_ValueError,
+            "argument must be a tiered entry point that doesn't belong to a CompiledCode object");
+        return NULL;
+    }
+
+    source = PyCode_New(
+        cep->co_argcount,
+        cep->co_kwonlyargcount,
+        cep->co_nlocals,
+        cep->co_stacksize,
+        cep->co_flags & ~CO_COMPILED,
+        cep->co_code,
+        cep->co_consts,
+        cep->co_names,
+        cep->co_varnames,
+        cep->co_freevars,
+        cep->co_cellvars,
+        cep->co_filename,
+        cep->co_name,
+        cep->co_firstlineno,
+        cep->co_lnotab);
+    if(!source) return NULL;
+
+    Py_INCREF(code);
+    Py_DECREF(cep->co_code);
+    cep->co_code = code;
+    Py_INCREF(consts);
+    Py_DECREF(cep->co_consts);
+    cep->co_consts = consts;
+    Py_INCREF(lnotab);
+    Py_DECREF(cep->co_lnotab);
+    cep->co_lnotab = lnotab;
+    cep->co_stacksize = stacksize;
+    cep->source = source;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *cep_get_source(PyObject *self,PyObject *_arg) {
+    PyObject *ret;
+    CodeObjectWithCCode *arg = (CodeObjectWithCCode*)_arg;
+
+    CEP_CHECK(arg)
+
+    ret = arg->source ? (PyObject*)arg->source : Py_None;
+    Py_INCREF(ret);
+    return ret;
+}
+
+/* Compile a lazy entry point by calling lazy_compiler, which must return a new
+   CompiledCode object and the offset of the entry point's code in it. The new
+   object is kept alive by the CompiledCode object that the lazy entry point
+   belongs to. */
+static int compile_lazy(CodeObjectWithCCode *co) {
+    PyObject *r;
+    CompiledCode *parent = co->compiled_code;
+    CompiledCode *child;
+    unsigned int offset;
+
+    if(!lazy_compiler) {
+        co->offset = OFFSET_NONE;
+        return 0;
+    }
+
+    r = PyObject_CallFunctionObjArgs(lazy_compiler,(PyObject*)co,NULL);
+    if(!r) return -1;
+
+    if(!PyArg_ParseTuple(r,"O!I",&CompiledCodeType,&child,&offset)) goto error;
+
+    if(!parent->children && !(parent->children = PyList_New(0))) goto error;
+    if(PyList_Append(parent->children,(PyObject*)child)) goto error;
+
+    co->compiled_code = child;
+    co->offset = offset;
+
+    Py_DECREF(r);
+    return 0;
+
+error:
+    Py_DECREF(r);
+    return -1;
+}
+
+/* Add one to a counter of a tiered entry point that hasn't been compiled yet
+   and compile it if the sum of its counters reached tier_threshold */
+static int tier_count(CodeObjectWithCCode *co,unsigned int *counter) {
+    if(co->offset != OFFSET_TIERED) return 0;
+
+    ++*counter;
+    return co->calls + co->backedges >= tier_threshold ? compile_lazy(co) : 0;
+}
+
+/* Get the machine code of a code object, compiling it first if it is a lazy
+   entry point. *entry is set to NULL if the code object has to be run by the
+   interpreter. Returns -1 if an error occurred. */
+static int get_ccode(PyObject *co,entry_type *entry) {
+    CodeObjectWithCCode *cco = (CodeObjectWithCCode*)co;
+
+    if(((PyCodeObject*)co)->co_flags & CO_COMPILED && cco->compiled_code) {
+        /* counting byte code counts its own calls (see tier0_enter) */
+        if(cco->offset == OFFSET_TIERED && !cco->source) {
+            if(tier_count(cco,&cco->calls)) return -1;
+        }
+        else if(cco->offset == OFFSET_LAZY) {
+            if(compile_lazy(cco)) return -1;
+        }
+    }
+
+    *entry = HAS_CCODE(co) ? GET_CCODE_FUNC(co) : NULL;
+    return 0;
+}
+
+static PyObject *eval_frame(PyObject *co,PyFrameObject *f) {
+    entry_type entry;
+
+    if(get_ccode(co,&entry)) return NULL;
+    return entry ? entry(f) : PyEval_EvalFrameEx(f,0);
+}
+
+/* returned by tier0_enter when the interpreter should keep running the byte
+   code */
+static PyObject *tier0_continue = NULL;
+
+/* Get the tiered entry point with counting byte code that the interpreter is
+   running in frame f, or NULL if there isn't one */
+static CodeObjectWithCCode *tier0_code(PyFrameObject *f) {
+    CodeObjectWithCCode *co;
+
+    if(!f) return NULL;
+    co = (CodeObjectWithCCode*)f->f_code;
+    return co->co_flags & CO_COMPILED && co->compiled_code && co->source ? co : NULL;
+}
+
+/* Called at the start of the counting byte code of a tiered entry point (see
+   tier0.py), however the code was called. Counts the call and, once the code
+   has been compiled, runs the machine code in the frame the interpreter has
+   already set up. Returns what the machine code returned, or tier0_continue
+   if the interpreter should run the rest of the byte code. */
+static PyObject *tier0_enter(PyObject *self,PyObject *_arg) {
+    PyFrameObject *f = PyEval_GetFrame();
+    CodeObjectWithCCode *co = tier0_code(f);
+    PyObject *r;
+
+    if(co) {
+        if(tier_count(co,&co->calls)) return NULL;
+
+        /* a generator frame can't be taken over, since the interpreter
+           resumes it after every yield */
+        if(HAS_CCODE(co) && !(co->co_flags & CO_GENERATOR)) {
+            r = GET_CCODE_FUNC(co)(f);
+
+            /* the machine code sets the thread's frame to f_back when it
+               returns, but the interpreter is still running f */
+            PyThreadState_GET()->frame = f;
+            return r;
+        }
+    }
+
+    Py_INCREF(tier0_continue);
+    return tier0_continue;
+}
+
+/* Called by the counting byte code of a tiered entry point at the start of
+   every loop iteration (see tier0.py). The iteration that makes the code hot
+   still finishes in the interpreter; the next call runs the machine code. */
+static PyObject *tier0_backedge(PyObject *self,PyObject *_arg) {
+    CodeObjectWithCCode *co = tier0_code(PyEval_GetFrame());
+
+    if(co && tier_count(co,&co->backedges)) return NULL;
+
+    Py_RETURN_NONE;
+}
+
 static PyObject *cep_exec(PyObject *self,PyObject *args) {
     PyObject *r;
     PyObject *cep;
@@ -336,6 +599,368 @@ static PyObject *cep_exec(PyObject *self,PyObject *args) {
 
 
 
+#ifdef USE_MMAP
+/* Copy "len" bytes of machine code into a new region of executable memory.
+
+   Where available, the code is written to an anonymous memory file (memfd)
+   which is then mapped with PROT_EXEC, the same way a regular file would be
+   (merely using mprotect is not enough because some security-conscious
+   systems don't allow marking allocated memory executable unless it was
+   already executable). Otherwise, anonymous memory is mapped, filled and then
+   made executable with mprotect. Either way, nothing touches the file system.
+ */
+static void *alloc_executable(const char *code,size_t len) {
+    void *mem;
+
+#ifdef MFD_CLOEXEC
+    int fd;
+    size_t written = 0;
+    ssize_t r;
+
+    if((fd = memfd_create("nativecompile",MFD_CLOEXEC)) != -1) {
+        while(written < len) {
+            if((r = write(fd,code + written,len - written)) == -1) {
+                if(errno == EINTR) continue;
+                close(fd);
+                PyErr_SetFromErrno(PyExc_OSError);
+                return NULL;
+            }
+            written += (size_t)r;
+        }
+
+        mem = mmap(0,len,PROT_READ|PROT_EXEC,MAP_PRIVATE,fd,0);
+
+        /* the mapping keeps the memory alive after the descriptor is closed */
+        close(fd);
+
+        if(mem != MAP_FAILED) return mem;
+
+        /* fall back to anonymous memory */
+    }
+#endif
+
+    if((mem = mmap(0,len,PROT_READ|PROT_WRITE,MAP_PRIVATE|MAP_ANONYMOUS,-1,0)) == MAP_FAILED) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+
+    memcpy(mem,code,len);
+
+    if(mprotect(mem,len,PROT_READ|PROT_EXEC)) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        munmap(mem,len);
+        return NULL;
+    }
+
+    return mem;
+}
+#endif
+
+#ifdef USE_MMAP
+/* The code arena packs the machine code of many CompiledCode objects into a
+   few large regions of executable memory. This reduces the number of separate
+   mappings and, with huge pages, the number of TLB entries needed for the
+   code.
+
+   Each arena keeps a list of free ranges, sorted by position, so that the
+   range of a freed CompiledCode object can be reused and merged with its
+   neighbors. An arena that becomes completely empty is unmapped, unless it's
+   the last one.
+
+   Where memfd_create is available, an arena is a memory file that is mapped
+   twice: once writable, where new code is copied to, and once executable,
+   where it runs from (see alloc_executable for why memory isn't simply made
+   executable). Adding code then never changes the protection of memory that
+   other functions' code lives in. Otherwise, the arena is anonymous memory
+   and is briefly made writable (and not executable) to add code. That is
+   safe because it only happens while the GIL is held, and compiled code only
+   runs while the GIL is held. */
+
+#define ARENA_ALIGN 16
+#define ARENA_SIZE (2*1024*1024)
+#define HUGE_PAGE_SIZE (2*1024*1024)
+
+#define ALIGN_UP(X,A) (((X) + (A) - 1) & ~((size_t)(A) - 1))
+
+typedef struct FreeRange {
+    size_t start;
+    size_t len;
+    struct FreeRange *next;
+} FreeRange;
+
+typedef struct Arena {
+    /* the executable view and, if the arena is a memory file, the writable
+       view (otherwise NULL) */
+    char *mem;
+    char *wmem;
+    size_t size;
+    size_t used;
+    size_t units;
+    FreeRange *free;
+    struct Arena *next;
+} Arena;
+
+static Arena *arenas = NULL;
+static int arena_enabled = 0;
+static int arena_huge_pages = 0;
+
+
+static Arena *new_arena(size_t min_size) {
+    Arena *a;
+    char *mem;
+    char *wmem = NULL;
+    size_t size;
+    size_t extra = 0;
+#ifdef MFD_CLOEXEC
+    int fd;
+    int err;
+#endif
+
+    size = ALIGN_UP(min_size > ARENA_SIZE ? min_size : ARENA_SIZE,
+        arena_huge_pages ? HUGE_PAGE_SIZE : (size_t)sysconf(_SC_PAGESIZE));
+
+    /* huge pages can only be used for aligned memory, so map more than needed
+       and trim the excess */
+    if(arena_huge_pages) extra = HUGE_PAGE_SIZE;
+
+    mem = mmap(0,size + extra,PROT_READ|PROT_EXEC,MAP_PRIVATE|MAP_ANONYMOUS,-1,0);
+    if(mem == MAP_FAILED) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+
+    if(extra) {
+        char *aligned = (char*)ALIGN_UP((size_t)mem,HUGE_PAGE_SIZE);
+        if(aligned != mem) munmap(mem,(size_t)(aligned - mem));
+        if(aligned + size != mem + size + extra)
+            munmap(aligned + size,(size_t)((mem + size + extra) - (aligned + size)));
+        mem = aligned;
+
+#ifdef MADV_HUGEPAGE
+        /* this is only a hint; failure is not an error */
+        madvise(mem,size,MADV_HUGEPAGE);
+#endif
+    }
+
+#ifdef MFD_CLOEXEC
+    /* the anonymous mapping only reserved the address range; the executable
+       view of the memory file replaces it */
+    if((fd = memfd_create("nativecompile-arena",MFD_CLOEXEC)) != -1) {
+        if(ftruncate(fd,(off_t)size) == 0 &&
+                (wmem = mmap(0,size,PROT_READ|PROT_WRITE,MAP_SHARED,fd,0)) != MAP_FAILED) {
+            if(mmap(mem,size,PROT_READ|PROT_EXEC,MAP_SHARED|MAP_FIXED,fd,0) == MAP_FAILED) {
+                err = errno;
+                munmap(wmem,size);
+                munmap(mem,size);
+                close(fd);
+                errno = err;
+                PyErr_SetFromErrno(PyExc_OSError);
+                return NULL;
+            }
+        } else {
+            wmem = NULL;
+        }
+
+        /* the mappings keep the memory alive after the descriptor is closed */
+        close(fd);
+    }
+#endif
+
+    if((a = PyMem_Malloc(sizeof(Arena))) == NULL) goto nomem;
+    if((a->free = PyMem_Malloc(sizeof(FreeRange))) == NULL) {
+        PyMem_Free(a);
+        goto nomem;
+    }
+
+    a->mem = mem;
+    a->wmem = wmem;
+    a->size = size;
+    a->used = 0;
+    a->units = 0;
+    a->free->start = 0;
+    a->free->len = size;
+    a->free->next = NULL;
+    a->next = arenas;
+    arenas = a;
+
+    return a;
+
+nomem:
+    if(wmem) munmap(wmem,size);
+    munmap(mem,size);
+    PyErr_NoMemory();
+    return NULL;
+}
+
+/* Take len bytes from the first free range of "a" that is big enough. Returns
+   NULL if there isn't one. */
+static char *arena_take(Arena *a,size_t len) {
+    FreeRange **fr, *tmp;
+    char *r;
+
+    for(fr = &a->free; *fr; fr = &(*fr)->next) {
+        if((*fr)->len >= len) {
+            r = a->mem + (*fr)->start;
+            (*fr)->start += len;
+            (*fr)->len -= len;
+            if(!(*fr)->len) {
+                tmp = *fr;
+                *fr = tmp->next;
+                PyMem_Free(tmp);
+            }
+            a->used += len;
+            ++a->units;
+            return r;
+        }
+    }
+    return NULL;
+}
+
+static void arena_free(Arena *a,void *mem,size_t len);
+
+/* Copy code into an arena. On success, the arena is stored in *arena_out. */
+static void *arena_alloc(const char *code,size_t len,Arena **arena_out) {
+    Arena *a;
+    char *mem = NULL;
+    size_t alen = ALIGN_UP(len,ARENA_ALIGN);
+    int err;
+
+    for(a = arenas; a; a = a->next) {
+        if(a->size - a->used >= alen && (mem = arena_take(a,alen))) break;
+    }
+
+    if(!mem) {
+        if((a = new_arena(alen)) == NULL) return NULL;
+        mem = arena_take(a,alen);
+        assert(mem);
+    }
+
+    if(a->wmem) {
+        memcpy(a->wmem + (mem - a->mem),code,len);
+    } else {
+        if(mprotect(a->mem,a->size,PROT_READ|PROT_WRITE)) goto error;
+        memcpy(mem,code,len);
+        if(mprotect(a->mem,a->size,PROT_READ|PROT_EXEC)) goto error;
+    }
+
+    *arena_out = a;
+    return mem;
+
+error:
+    err = errno;
+
+    /* the arena has other functions' code in it, so it can't be left
+       writable, and the range has to be given back */
+    mprotect(a->mem,a->size,PROT_READ|PROT_EXEC);
+    arena_free(a,mem,len);
+
+    errno = err;
+    PyErr_SetFromErrno(PyExc_OSError);
+    return NULL;
+}
+
+static void arena_free(Arena *a,void *mem,size_t len) {
+    Arena **ap;
+    FreeRange **fr, *prev = NULL, *fresh;
+    size_t start = (size_t)((char*)mem - a->mem);
+
+    len = ALIGN_UP(len,ARENA_ALIGN);
+    a->used -= len;
+    --a->units;
+
+    if(!a->units && (arenas != a || a->next)) {
+        /* the arena is empty and isn't the only one */
+        for(ap = &arenas; *ap != a; ap = &(*ap)->next) {}
+        *ap = a->next;
+
+        while(a->free) {
+            fresh = a->free->next;
+            PyMem_Free(a->free);
+            a->free = fresh;
+        }
+        if(a->wmem) munmap(a->wmem,a->size);
+        munmap(a->mem,a->size);
+        PyMem_Free(a);
+        return;
+    }
+
+    for(fr = &a->free; *fr && (*fr)->start < start; fr = &(*fr)->next) prev = *fr;
+
+    if(prev && prev->start + prev->len == start) {
+        /* merge with the previous range */
+        prev->len += len;
+        if(*fr && start + len == (*fr)->start) {
+            fresh = *fr;
+            prev->len += fresh->len;
+            prev->next = fresh->next;
+            PyMem_Free(fresh);
+        }
+    } else if(*fr && start + len == (*fr)->start) {
+        /* merge with the next range */
+        (*fr)->start = start;
+        (*fr)->len += len;
+    } else {
+        /* if this fails, the range is simply lost */
+        if((fresh = PyMem_Malloc(sizeof(FreeRange))) == NULL) return;
+        fresh->start = start;
+        fresh->len = len;
+        fresh->next = *fr;
+        *fr = fresh;
+    }
+}
+
+static PyObject *arena_enable(PyObject *self,PyObject *args,PyObject *kwds) {
+    int huge_pages = 0;
+
+    static char *kwlist[] = {"huge_pages",NULL};
+
+    if(!PyArg_ParseTupleAndKeywords(args,kwds,"|i",kwlist,&huge_pages)) return NULL;
+
+    arena_enabled = 1;
+    arena_huge_pages = huge_pages;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *arena_disable(PyObject *self,PyObject *_arg) {
+    /* existing arenas stay until everything in them is freed */
+    arena_enabled = 0;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *arena_stats(PyObject *self,PyObject *_arg) {
+    Arena *a;
+    FreeRange *fr;
+    size_t count = 0, size = 0, used = 0, units = 0, free_ranges = 0, largest_free = 0;
+
+    for(a = arenas; a; a = a->next) {
+        ++count;
+        size += a->size;
+        used += a->used;
+        units += a->units;
+        for(fr = a->free; fr; fr = fr->next) {
+            ++free_ranges;
+            if(fr->len > largest_free) largest_free = fr->len;
+        }
+    }
+
+    return Py_BuildValue("{s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:d}",
+        "arenas",(Py_ssize_t)count,
+        "size",(Py_ssize_t)size,
+        "used",(Py_ssize_t)used,
+        "free",(Py_ssize_t)(size - used),
+        "units",(Py_ssize_t)units,
+        "free_ranges",(Py_ssize_t)free_ranges,
+        "largest_free",(Py_ssize_t)largest_free,
+
+        /* 0 when all the free memory is in one piece, approaching 1 as it gets
+           split into smaller pieces */
+        "fragmentation",size - used ? 1.0 - (double)largest_free / (double)(size - used) : 0.0);
+}
+#endif
+
+
 static void CompiledCode_dealloc(CompiledCode *self) {
     int i;
     PyObject *ep;
@@ -344,48 +969,48 @@ static void CompiledCode_dealloc(CompiledCode *self) {
         for(i=0; i<PyTuple_GET_SIZE(self->entry_points); ++i) {
             ep = PyTuple_GET_ITEM(self->entry_points,i);
             ((CodeObjectWithCCode*)ep)->compiled_code = NULL;
+            Py_CLEAR(((CodeObjectWithCCode*)ep)->source);
         }
         Py_DECREF(self->entry_points);
     }
+    Py_XDECREF(self->children);
     if(self->entry) {
 #ifdef USE_MMAP
-        munmap(self->entry,self->len);
-        close(self->fd);
+        if(self->arena)
+            arena_free(self->arena,self->entry,self->len);
+        else
+            munmap(self->entry,self->len);
 #else
         PyMem_Free(self->entry);
 #endif
     }
+
+    Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
 static PyObject *CompiledCode_new(PyTypeObject *type,PyObject *args,PyObject *kwds) {
     CompiledCode *self;
-    PyObject *filename_o;
-    const char *filename_s;
+    Py_buffer code;
     PyObject *entry_points;
     int i;
     PyObject *item;
 
-#ifdef USE_MMAP
-    off_t slen;
-    void *mem;
-#else
-    FILE *f;
-    long len;
-    size_t read;
-#endif
-
-    static char *kwlist[] = {"filename","entry_points",NULL};
+    static char *kwlist[] = {"code","entry_points",NULL};
 
-    if(!PyArg_ParseTupleAndKeywords(args,kwds,"O&O",kwlist,
-        PyUnicode_FSConverter,
-        &filename_o,
+    if(!PyArg_ParseTupleAndKeywords(args,kwds,"y*O",kwlist,
+        &code,
         &entry_points)) return NULL;
 
-    filename_s = PyBytes_AS_STRING(filename_o);
+    if(code.len < 1) {
+        PyErr_SetString(PyExc_ValueError,"code cannot be empty");
+        PyBuffer_Release(&code);
+        return NULL;
+    }
     
     self = (CompiledCode*)type->tp_alloc(type,0);
     if(self) {
         self->entry = NULL;
+        self->children = NULL;
 
         self->entry_points = PyObject_CallFunctionObjArgs(
             (PyObject*)&PyTuple_Type,
@@ -417,59 +1042,32 @@ static PyObject *CompiledCode_new(PyTypeObject *type,PyObject *args,PyObject *kw
         }
         
 #ifdef USE_MMAP
-        /* use mmap to create an executable region of memory (merely using
-           mprotect is not enough because some security-conscious systems don't
-           allow marking allocated memory executable unless it was already
-           executable) */
-
-        if((self->fd = open(filename_s,O_RDONLY)) == -1) goto io_error;
-        
-        /* get the file length */
-        if((slen = lseek(self->fd,0,SEEK_END)) == -1 || lseek(self->fd,0,SEEK_SET) == -1) {
-            close(self->fd);
-            goto io_error;
-        }
-        self->len = (size_t)slen;
-        
-        if((mem = mmap(0,self->len,PROT_READ|PROT_EXEC,MAP_PRIVATE,self->fd,0)) == MAP_FAILED) {
-            close(self->fd);
-            PyErr_SetFromErrno(PyExc_OSError);
-            goto error;
-        }
-        self->entry = (entry_type)mem;
-
+        self->len = (size_t)code.len;
+        self->arena = NULL;
+        if(arena_enabled)
+            self->entry = (entry_type)arena_alloc(code.buf,self->len,&self->arena);
+        else
+            self->entry = (entry_type)alloc_executable(code.buf,self->len);
+        if(!self->entry) goto error;
 #else
-        /* just load the file contents into memory */
+        /* just copy the code into memory */
 
-        if((f = fopen(filename_s,"rb")) == NULL) goto io_error;
-        
-        /* get the file length */
-        if(fseek(f,0,SEEK_END) || (len = ftell(f)) == -1 || fseek(f,0,SEEK_SET)) {
-            fclose(f);
-            goto io_error;
-        }
-        
-        if((self->entry = (entry_type)PyMem_Malloc(len)) == NULL) {
-            fclose(f);
+        if((self->entry = (entry_type)PyMem_Malloc(code.len)) == NULL) {
+            PyErr_NoMemory();
             goto error;
         }
         
-        read = fread(self->entry,1,len,f);
-        fclose(f);
-        if(read < (size_t)len) goto io_error;
-
+        memcpy(self->entry,code.buf,code.len);
 #endif
         goto end; /* skip over the error handling code */
         
-    io_error:
-        PyErr_SetFromErrnoWithFilename(PyExc_IOError,filename_s);
     error:
         Py_DECREF(self);
         self = NULL;
     }
 end:
     
-    Py_DECREF(filename_o);
+    PyBuffer_Release(&code);
     
     return (PyObject*)self;
 }
@@ -557,6 +1155,58 @@ call_function(PyObject **pp_stack, int oparg)
     return x;
 }
 
+/* Direct calls between functions of the same compiled image:
+
+   When the compiler can tell which function a call will probably reach, it
+   calls _direct_frame with the code object of that function. If the function
+   object on the stack really has that code and no argument processing is
+   needed, a new frame is returned and the compiled code calls the function's
+   machine code directly, then calls _direct_finish with the frame. Otherwise
+   NULL is returned (with no exception set) and the call goes through
+   call_function as usual. NULL with an exception set means the frame could
+   not be created. */
+static PyFrameObject *
+_direct_frame(PyObject **pp_stack, int na, PyObject *code)
+{
+    PyObject *func = pp_stack[na];
+    PyFrameObject *f;
+    PyObject **fastlocals;
+    int i;
+
+    if (!PyFunction_Check(func) || PyFunction_GET_CODE(func) != code ||
+            PyFunction_GET_DEFAULTS(func) != NULL)
+        return NULL;
+
+    f = PyFrame_New(PyThreadState_GET(), (PyCodeObject*)code,
+                    PyFunction_GET_GLOBALS(func), NULL);
+    if (f == NULL)
+        return NULL;
+
+    fastlocals = f->f_localsplus;
+    for (i = 0; i < na; i++) {
+        Py_INCREF(pp_stack[na - 1 - i]);
+        fastlocals[i] = pp_stack[na - 1 - i];
+    }
+
+    return f;
+}
+
+static void
+_direct_finish(PyFrameObject *f, PyObject **pp_stack, int na)
+{
+    PyThreadState *tstate = PyThreadState_GET();
+    int i;
+
+    ++tstate->recursion_depth;
+    Py_DECREF(f);
+    --tstate->recursion_depth;
+
+    /* the arguments and the function object */
+    for (i = 0; i <= na; i++) {
+        Py_DECREF(pp_stack[i]);
+    }
+}
+
 static PyObject *
 fast_function(PyObject *func, PyObject ***pp_stack, int n, int na, int nk)
 {
@@ -590,7 +1240,7 @@ fast_function(PyObject *func, PyObject ***pp_stack, int n, int na, int nk)
             fastlocals[i] = *stack--;
         }
 
-        retval = HAS_CCODE(co) ? GET_CCODE_FUNC(co)(f) : PyEval_EvalFrameEx(f,0);
+        retval = eval_frame((PyObject*)co,f);
 
         ++tstate->recursion_depth;
         Py_DECREF(f);
@@ -951,7 +1601,7 @@ _cc_EvalCodeEx(PyObject *_co, PyObject *globals, PyObject *locals,
         return PyGen_New(f);
     }
 
-    retval = HAS_CCODE(co) ? GET_CCODE_FUNC(co)(f) : PyEval_EvalFrameEx(f,0);
+    retval = eval_frame((PyObject*)co,f);
 
 fail:
 
@@ -1353,6 +2003,18 @@ static PyMethodDef functions[] = {
     {"cep_get_offset",cep_get_offset,METH_O,NULL},
     {"cep_set_offset",cep_set_offset,METH_VARARGS,NULL},
     {"cep_exec",cep_exec,METH_VARARGS,NULL},
+    {"set_lazy_compiler",set_lazy_compiler,METH_O,NULL},
+    {"set_tier_threshold",set_tier_threshold,METH_O,NULL},
+    {"cep_get_counters",cep_get_counters,METH_O,NULL},
+    {"cep_set_tier0",cep_set_tier0,METH_VARARGS,NULL},
+    {"cep_get_source",cep_get_source,METH_O,NULL},
+    {"tier0_enter",tier0_enter,METH_NOARGS,NULL},
+    {"tier0_backedge",tier0_backedge,METH_NOARGS,NULL},
+#ifdef USE_MMAP
+    {"arena_enable",(PyCFunction)arena_enable,METH_VARARGS|METH_KEYWORDS,NULL},
+    {"arena_disable",arena_disable,METH_NOARGS,NULL},
+    {"arena_stats",arena_stats,METH_NOARGS,NULL},
+#endif
     {NULL}
 };
 
@@ -1399,15 +2061,25 @@ PyInit_pyinternals(void) {
     ADD_INT_OFFSET("TYPE_FLAGS_OFFSET",PyTypeObject,tp_flags);
     ADD_INT_OFFSET("LIST_ITEM_OFFSET",PyListObject,ob_item);
     ADD_INT_OFFSET("TUPLE_ITEM_OFFSET",PyTupleObject,ob_item);
+    ADD_INT_OFFSET("LONG_DIGIT_OFFSET",PyLongObject,ob_digit);
+    ADD_INT_OFFSET("FLOAT_VAL_OFFSET",PyFloatObject,ob_fval);
     ADD_INT_OFFSET("FRAME_BACK_OFFSET",PyFrameObject,f_back);
     ADD_INT_OFFSET("FRAME_BUILTINS_OFFSET",PyFrameObject,f_builtins);
     ADD_INT_OFFSET("FRAME_GLOBALS_OFFSET",PyFrameObject,f_globals);
     ADD_INT_OFFSET("FRAME_LOCALS_OFFSET",PyFrameObject,f_locals);
     ADD_INT_OFFSET("FRAME_LOCALSPLUS_OFFSET",PyFrameObject,f_localsplus);
     ADD_INT_OFFSET("THREADSTATE_FRAME_OFFSET",PyThreadState,frame);
+    if(PyModule_AddIntConstant(m,"LONG_SHIFT",PyLong_SHIFT) == -1) return NULL;
     if(PyModule_AddStringConstant(m,"ARCHITECTURE",ARCHITECTURE) == -1) return NULL;
     if(PyModule_AddObject(m,"REF_DEBUG",PyBool_FromLong(REF_DEBUG_VAL)) == -1) return NULL;
     if(PyModule_AddObject(m,"COUNT_ALLOCS",PyBool_FromLong(COUNT_ALLOCS_VAL)) == -1) return NULL;
+    if(PyModule_AddObject(m,"OFFSET_LAZY",PyLong_FromUnsignedLong(OFFSET_LAZY)) == -1) return NULL;
+    if(PyModule_AddObject(m,"OFFSET_NONE",PyLong_FromUnsignedLong(OFFSET_NONE)) == -1) return NULL;
+    if(PyModule_AddObject(m,"OFFSET_TIERED",PyLong_FromUnsignedLong(OFFSET_TIERED)) == -1) return NULL;
+
+    if(!(tier0_continue = PyObject_CallObject((PyObject*)&PyBaseObject_Type,NULL))) return NULL;
+    Py_INCREF(tier0_continue);
+    if(PyModule_AddObject(m,"TIER0_CONTINUE",tier0_continue) == -1) return NULL;
 
     
     addrs = PyDict_New();
@@ -1460,6 +2132,8 @@ PyInit_pyinternals(void) {
     ADD_ADDR(PyNumber_InPlaceXor)
     ADD_ADDR(PyNumber_InPlaceOr)
     ADD_ADDR(PyLong_AsLong)
+    ADD_ADDR(PyLong_FromSsize_t)
+    ADD_ADDR(PyFloat_FromDouble)
     ADD_ADDR(PyList_New)
     ADD_ADDR(PyTuple_New)
     ADD_ADDR(PyTuple_Pack)
@@ -1467,6 +2141,8 @@ PyInit_pyinternals(void) {
     ADD_ADDR(_EnterRecursiveCall)
     ADD_ADDR(_LeaveRecursiveCall)
     ADD_ADDR(call_function)
+    ADD_ADDR(_direct_frame)
+    ADD_ADDR(_direct_finish)
     ADD_ADDR(format_exc_check_arg)
     ADD_ADDR(_make_function)
     ADD_ADDR(_unpack_iterable)
@@ -1480,6 +2156,8 @@ PyInit_pyinternals(void) {
     ADD_ADDR_NAME(&PyDict_Type,"PyDict_Type")
     ADD_ADDR_NAME(&PyList_Type,"PyList_Type")
     ADD_ADDR_NAME(&PyTuple_Type,"PyTuple_Type")
+    ADD_ADDR_NAME(&PyLong_Type,"PyLong_Type")
+    ADD_ADDR_NAME(&PyFloat_Type,"PyFloat_Type")
     ADD_ADDR(PyExc_KeyError)
     ADD_ADDR(PyExc_NameError)
     ADD_ADDR(PyExc_StopIteration)
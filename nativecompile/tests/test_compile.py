@@ -136,6 +136,633 @@ thing = Thingy()
 print(thing)
 ''')
 
+    def test_long_jumps(self):
+        # the bodies are long enough that the jumps around them need the
+        # full-size encodings
+        self.compare_exec('''
+t = 0
+for i in range(20):
+    if i & 1:
+        ''' + ''.join('t = t + i * {}\n        '.format(n) for n in range(40)) + '''
+    else:
+        t = t - 1
+print(t)
+''')
+
+    def test_extended_arg(self):
+        # the constants past index 0xffff, the size of the list and the target
+        # of the jump around it all need an EXTENDED_ARG prefix
+        self.compare_exec('''
+def f(c):
+    if c:
+        return [''' + ','.join(map(str,range(70000))) + ''']
+    return None
+
+x = f(True)
+print(len(x),x[0xffff],x[0x10000],x[-1],f(False))
+''')
+
+    def test_unreachable(self):
+        self.compare_exec('''
+def sign(x):
+    if x < 0:
+        return -1
+    else:
+        return 1
+
+t = 0
+for i in range(10):
+    if i & 1:
+        if i & 2:
+            t = t + sign(i)
+    else:
+        t = t - sign(-i)
+print(t)
+''')
+
+    def test_deep_stack(self):
+        # more items are on the stack at once than there are registers to keep
+        # them in
+        self.compare_exec('''
+def f(a,b,c):
+    return a - (b - (c - (a - (b * (c + (a is b))))))
+
+print(f(7,3,2),[f(1,2,3),f(3,2,1)] == [f(1,2,3)] + [f(3,2,1)])
+''')
+
+    def test_peephole(self):
+        # consecutive loads and stores of the same variables
+        self.compare_exec('''
+def f(a,b):
+    c = a
+    a = b
+    b = c
+    c = a + b + a + c
+    return a,b,c,a is b,c
+
+print(f(3,4),f('x','y'))
+''')
+
+    def test_borrowed_refs(self):
+        # the reference counts must come out the same whether or not the
+        # references on the stack were borrowed
+        self.compare_exec('''
+import sys
+x = object()
+y = [x]
+def f(a,b):
+    c = a
+    for i in range(3):
+        c = b if a is b else y
+        a = c
+    return c is x,b is y
+
+before = sys.getrefcount(x),sys.getrefcount(y)
+for i in range(100):
+    f(x,x)
+    f(x,y)
+print(f(x,x),sys.getrefcount(x) - before[0],sys.getrefcount(y) - before[1])
+''')
+
+    def test_small_ints(self):
+        # the inline versions have to give the same results as the generic
+        # functions, including for the operands they leave to them
+        self.compare_exec('''
+class I(int):
+    def __add__(self,b):
+        return 'I'
+
+def f(a,b):
+    r = [a + b,a - b,a * b,a & b,a | b,a ^ b]
+    if 0 <= b < 100:
+        r += [a << b,a >> b]
+    a += b
+    a <<= 1
+    return r + [a]
+
+vals = [0,1,-1,5,-7,2**30-1,-(2**30-1),2**30,2**40,-2**62,2**64]
+for a in vals:
+    for b in vals:
+        print(f(a,b))
+print(f(3,31),f(3,32),f(-3,64),f(True,2),I(1) + 2,1.5 * 2)
+''')
+
+    def test_unboxed_floats(self):
+        # the expressions give the same results (and exceptions) whether or
+        # not the variables are floats
+        self.compare_exec('''
+class F(float):
+    def __mul__(self,b):
+        return 'F'
+
+def f(x,y,z):
+    t = 0.0
+    t += x * y + z * 2.5
+    try:
+        return t,(x * y - z) / (x - 1),-2 * x / 4 + y
+    except ZeroDivisionError:
+        return t,'zero',x / 3.0 * y
+
+def g(x):
+    if x:
+        y = 2.0
+    return x * 1.5 + y * y
+
+print(f(3.5,-1.25,0.1),f(1.0,2.0,3.0),f(-0.0,float('inf'),2.0))
+print(f(3,4,5),f(1,2,3),f(2.5,3,1))
+print(f(1.5,2.5,float('nan')))
+try:
+    f(F(2.0),3.0,1.0)
+except TypeError as e:
+    print(type(e).__name__)
+print(g(2.0))
+try:
+    g(0.0)
+except UnboundLocalError as e:
+    print(type(e).__name__)
+''')
+
+    def test_float_loop(self):
+        # the condition of the loop is a float expression, so every iteration
+        # has to start at its fast version, and in some of the loops a
+        # variable starts out as an int and only later becomes a float
+        self.compare_exec('''
+def escape(cr,ci):
+    x = y = 0.0
+    n = 0
+    while x*x + y*y < 4.0:
+        x,y = x*x - y*y + cr,2.0*x*y + ci
+        n += 1
+        if n == 50:
+            break
+    return n
+
+def grow(x,y):
+    while x*x + y*y < 4.0:
+        x = x + 1 if x > 0.5 else x + 0.25
+    return x,y
+
+print([escape(cr / 4,ci / 4) for cr in range(-8,3) for ci in range(-4,5)])
+print(grow(0.0,0.5),grow(0,1),grow(0.0,3))
+''')
+
+    def test_compare_jumps(self):
+        # the comparisons that are done together with the jumps after them
+        # have to give the same results as the generic functions, including
+        # for the operands they leave to them
+        self.compare_exec('''
+class I(int):
+    def __lt__(self,b):
+        return 'I'
+
+def f(a,b):
+    r = []
+    if a < b: r.append('<')
+    if a <= b: r.append('<=')
+    if a == b: r.append('==')
+    if a != b: r.append('!=')
+    if a > b: r.append('>')
+    if a >= b: r.append('>=')
+    if a is b: r.append('is')
+    if a is not b: r.append('is not')
+    return r
+
+def none(a):
+    if a is None:
+        return 'None'
+    return a is not None
+
+def count(n):
+    i = 0
+    t = 0
+    while i < n:
+        if i % 3 == 0:
+            t += i
+        i += 1
+    return t
+
+def kind(s):
+    if s == 'abc':
+        return 1
+    if 'xyz' != s:
+        return 2
+    return s == 'xyz'
+
+vals = [0,1,-1,5,-7,2**30-1,-(2**30-1),2**30,2**40,-2**62,2**64,True,1.5,I(1)]
+for a in vals:
+    for b in vals:
+        print(f(a,b))
+print(none(None),none(0),count(100),count(0),count(-5))
+print(kind('abc'),kind(''.join(['a','b','c'])),kind('xyz'),kind(''.join(['x','y'])+'z'),kind(None))
+''')
+
+    def test_release(self):
+        # compiled code lives in anonymous memory that is unmapped when the
+        # CompiledCode object goes away
+        self.compare_exec('''
+import nativecompile
+for i in range(100):
+    c = nativecompile.compile(compile('x = 5','<string>','exec'))
+    c()
+    del c
+print(x)
+''')
+
+    def test_lazy(self):
+        self.compare_exec('''
+import nativecompile
+src = \'\'\'
+def a(x):
+    def b(y):
+        return y * 3
+    return b(x) + 1
+
+def unused():
+    return undefined_name
+
+print(a(4))
+print(a(5))
+\'\'\'
+nativecompile.compile(compile(src,'<string>','exec'),lazy=True)()
+''')
+
+    def test_tiered(self):
+        self.compare_exec('''
+import nativecompile
+from nativecompile import pyinternals
+src = \'\'\'
+def f(x):
+    t = 0
+    for i in range(x):
+        t += i
+    return t
+
+total = 0
+for n in range(20):
+    total += f(n)
+print(total)
+\'\'\'
+nativecompile.set_tier_threshold(5)
+try:
+    c = nativecompile.compile(compile(src,'<string>','exec'),tiered=True)
+    c()
+    print(pyinternals.cep_get_offset(c.entry_points[1]) != pyinternals.OFFSET_TIERED)
+finally:
+    nativecompile.set_tier_threshold(1000)
+''')
+
+    def test_tiered_loops(self):
+        # a single call that loops long enough makes the code hot
+        self.compare_exec('''
+import nativecompile
+from nativecompile import pyinternals
+src = \'\'\'
+def f(x):
+    t = 0
+    while x:
+        t += x
+        x -= 1
+    return t
+
+print(f(100))
+\'\'\'
+nativecompile.set_tier_threshold(5)
+try:
+    c = nativecompile.compile(compile(src,'<string>','exec'),tiered=True)
+    c()
+    print(pyinternals.cep_get_offset(c.entry_points[1]) != pyinternals.OFFSET_TIERED)
+finally:
+    nativecompile.set_tier_threshold(1000)
+''')
+
+    def test_tiered_interpreted_callers(self):
+        # map calls g through the interpreter. The machine code doesn't set
+        # f_lasti, so its line number is that of the "def" line.
+        self.compare_exec('''
+import nativecompile
+src = \'\'\'
+import sys
+
+def g(x):
+    return sys._getframe().f_lineno - g.__code__.co_firstlineno
+
+print(list(map(g,range(8))))
+\'\'\'
+nativecompile.set_tier_threshold(5)
+try:
+    nativecompile.compile(compile(src,'<string>','exec'),tiered=True)()
+finally:
+    nativecompile.set_tier_threshold(1000)
+''')
+
+    def test_tiered_keeps_tracer(self):
+        self.compare_exec('''
+import sys
+import nativecompile
+src = \'\'\'
+import sys
+
+def tracer(frame,event,arg):
+    return None
+
+def f():
+    for i in range(3): pass
+    sys.settrace(tracer)
+
+f()
+print(sys.gettrace() is tracer)
+sys.settrace(None)
+\'\'\'
+nativecompile.compile(compile(src,'<string>','exec'),tiered=True)()
+''')
+
+    def test_parallel(self):
+        self.compare_exec('''
+import nativecompile
+src = \'\'\'
+def a(x):
+    return b(x) * 2
+
+def b(x):
+    return [x,x+1]
+
+class C:
+    def f(self):
+        return a(3)
+
+print(C().f())
+\'\'\'
+nativecompile.compile(compile(src,'<string>','exec'),workers=3)()
+''')
+
+    def test_parallel_with_threads(self):
+        self.compare_exec('''
+import threading
+import nativecompile
+from nativecompile import compile_raw
+src = \'\'\'
+def a(x):
+    return x * 2
+
+def b(x):
+    return a(x) + 1
+
+print(b(4))
+\'\'\'
+def no_fork(*args,**kwds):
+    raise AssertionError('forked while another thread was running')
+
+done = threading.Event()
+t = threading.Thread(target=done.wait)
+t.start()
+old = compile_raw.compile_parallel
+compile_raw.compile_parallel = no_fork
+try:
+    nativecompile.compile(compile(src,'<string>','exec'),workers=3)()
+finally:
+    compile_raw.compile_parallel = old
+    done.set()
+    t.join()
+''')
+
+    def test_native_functions(self):
+        self.compare_exec('''
+import nativecompile
+from nativecompile.importer import native_functions
+src = \'\'\'
+def a(x):
+    return x + 1
+
+class C:
+    def f(self):
+        return a(2)
+
+    @staticmethod
+    def g():
+        return 5
+\'\'\'
+code = compile(src,'<string>','exec')
+ns = {'__name__' : 'mod'}
+exec(code,ns)
+ccode = nativecompile.compile(code)
+print(native_functions(ns,ccode))
+print(ns['C']().f(),ns['C'].g())
+''')
+
+    def test_cache(self):
+        # a cache entry is only used if the source file and the flags it was
+        # compiled with are the same, and a damaged one is ignored
+        self.compare_exec('''
+import os, sys, marshal, tempfile
+from nativecompile import importer
+from nativecompile.compile_raw import SizeTuning
+with tempfile.TemporaryDirectory() as d:
+    src = os.path.join(d,'ncmod.py')
+    cache = importer.native_cache_path(src)
+    with open(src,'w') as f:
+        f.write('x = 6 * 7\\n')
+
+    importer.cache_stats.reset()
+    importer.install_importer()
+    sys.path.insert(0,d)
+    try:
+        import ncmod
+        del sys.modules['ncmod']
+        import ncmod
+        print(ncmod.x,importer.cache_stats)
+
+        with open(src,'w') as f:
+            f.write('x = 6 * 7 + 1\\n')
+        st = os.stat(src)
+        os.utime(src,(st.st_atime,st.st_mtime + 10))
+        del sys.modules['ncmod']
+        import ncmod
+        print(ncmod.x,importer.cache_stats)
+    finally:
+        sys.path.remove(d)
+        sys.modules.pop('ncmod',None)
+        importer.uninstall_importer()
+
+    key = importer.native_cache_key(src)
+    print(importer.load_cached(cache,key) is not None)
+    for other in [
+            importer.native_cache_key(src,lazy=True),
+            importer.native_cache_key(src,tiered=True),
+            importer.native_cache_key(src,tuning=SizeTuning())]:
+        print(importer.load_cached(cache,other))
+
+    for data in [b'',b'not marshal data',marshal.dumps((key,marshal.dumps((0,'x'))))]:
+        with open(cache,'wb') as f:
+            f.write(data)
+        print(importer.load_cached(cache,key))
+''')
+
+    def test_background(self):
+        # the module runs as bytecode first and its functions are switched to
+        # the machine code once the background compiler is done with it
+        self.compare_exec('''
+import os, sys, tempfile
+from nativecompile import importer
+with tempfile.TemporaryDirectory() as d:
+    with open(os.path.join(d,'bgmod.py'),'w') as f:
+        f.write('def f(x):\\n    return x + 1\\n'
+                'class C:\\n    def g(self):\\n        return f(2)\\n')
+
+    importer.install_importer(background=True)
+    sys.path.insert(0,d)
+    try:
+        import bgmod
+        importer.background_compiler.wait()
+        eps = bgmod.__nativecompile_compiled_code__.entry_points
+        for func in [bgmod.f,bgmod.C.g]:
+            print(any(ep is func.__code__ for ep in eps))
+        print(bgmod.f(1),bgmod.C().g())
+    finally:
+        sys.path.remove(d)
+        sys.modules.pop('bgmod',None)
+        importer.uninstall_importer()
+''')
+
+    def test_profile(self):
+        self.compare_exec('''
+import nativecompile
+from nativecompile import profiling
+events = []
+profiling.add_compile_hook(events.append)
+try:
+    p = profiling.CompileProfile()
+    nativecompile.compile(compile('def f(x):\\n    return x + 1\\nprint(f(1))','<string>','exec'),profile=p)()
+finally:
+    profiling.remove_compile_hook(events.append)
+print(sorted(e.name for e in events))
+print(all(e.native_size > 0 for e in events))
+print(sorted(p.phases))
+print(p.handlers['BINARY_ADD'].count)
+print(p.jumps['short'] > 0,p.jumps['bytes'] < p.jumps['full_size_bytes'])
+''')
+
+    def test_optimize_size(self):
+        self.compare_exec('''
+import nativecompile
+src = \'\'\'
+def f(x):
+    y = [x,x]
+    y = len(y)
+    return y + x
+
+z = f(1)
+del z
+print(f(2))
+\'\'\'
+nativecompile.compile(compile(src,'<string>','exec'),optimize_size=True)()
+''')
+
+        # the name errors are raised by a shared stub
+        self.compare_exec('''
+import nativecompile
+from nativecompile import pyinternals
+src = \'\'\'
+def g():
+    return undefined_global
+
+def h():
+    x = 1
+    del x
+    return x
+
+errors = []
+for func in (g,h):
+    try:
+        func()
+    except NameError as e:
+        errors.append((type(e).__name__,str(e)))
+\'\'\'
+interpreted = {}
+exec(compile(src,'<string>','exec'),interpreted)
+native = {}
+c = nativecompile.compile(compile(src,'<string>','exec'),optimize_size=True)
+pyinternals.cep_exec(c.entry_points[0],native)
+print(native['errors'])
+print(native['errors'] == interpreted['errors'])
+''')
+
+    def test_benchmarks(self):
+        # the workloads must be supported by the compiler and give the same
+        # answers when compiled (which run_all checks)
+        self.compare_exec('''
+from nativecompile.benchmarks import runtime
+r = runtime.run_all(repeat=1,warmup=0,scale=0.01)
+print(sorted(r['benchmarks']))
+''')
+
+    def test_compile_time(self):
+        self.compare_exec('''
+from nativecompile.benchmarks import compile_time
+r = compile_time.compile_benchmark(3,2,repeat=1,warmup=0)
+print(r['bytecode_size'] > 0,r['native_size'] > 0)
+print(r['native_size_optimized'] < r['native_size'])
+''')
+
+    def test_arena(self):
+        self.compare_exec('''
+import nativecompile
+nativecompile.use_code_arena()
+codes = []
+for i in range(50):
+    codes.append(nativecompile.compile(compile('x = {}'.format(i),'<string>','exec')))
+print(nativecompile.code_arena_stats()['units'])
+for c in codes:
+    c()
+print(x)
+del codes
+c = None
+print(nativecompile.code_arena_stats()['units'])
+nativecompile.use_code_arena(False)
+''')
+
+    def test_image(self):
+        self.compare_exec('''
+from nativecompile import image
+img = image.compile_image(compile('print(sum([1,2,3]))','<string>','exec'))
+image.Image.loads(img.dumps()).load()()
+
+# an image made for a build with different struct offsets is refused
+real_key = image.build_key
+image.build_key = lambda: real_key()[:-1] + ((('TYPE_OFFSET',-1),),)
+try:
+    data = img.dumps()
+finally:
+    image.build_key = real_key
+try:
+    image.Image.loads(data)
+except ValueError as e:
+    print(e)
+''')
+
+    def test_package(self):
+        self.compare_exec('''
+import os, sys, tempfile
+from nativecompile import package
+with tempfile.TemporaryDirectory() as d:
+    pdir = os.path.join(d,'ncpkg')
+    os.mkdir(pdir)
+    with open(os.path.join(pdir,'__init__.py'),'w') as f:
+        f.write('from .a import double\\ndef quad(x):\\n    return double(double(x))\\n')
+    with open(os.path.join(pdir,'a.py'),'w') as f:
+        f.write('def double(x):\\n    return x * 2\\n')
+    img = package.PackageImage.loads(package.compile_package(pdir).dumps())
+    importer = img.install()
+    try:
+        import ncpkg
+        print(ncpkg.quad(3))
+
+        # the direct call must notice that the function was replaced
+        ncpkg.double = lambda x: x + 1
+        print(ncpkg.quad(3))
+    finally:
+        importer.uninstall()
+''')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,124 @@
+
+import unittest
+
+from .. import x86_64_ops as ops
+from ..x86_64_abi import SystemVAbi
+from ..x86_ops import Displacement
+from .. import peephole
+
+
+def mov(a,b):
+    return ('mov',(a,b))
+
+def stack(offset):
+    return ops.Address(offset,ops.rsp)
+
+def optimize(instrs,**kwds):
+    return peephole.optimize(instrs,SystemVAbi,**kwds)
+
+
+class TestPeephole(unittest.TestCase):
+    def test_redundant_mov(self):
+        instrs = [mov(ops.rax,ops.rbx),mov(ops.rax,ops.rbx),mov(ops.rbx,ops.rax)]
+        self.assertEqual(optimize(instrs),[instrs[0],None,None])
+
+        # the value of rax changes in between
+        instrs = [mov(ops.rax,ops.rbx),('add',(1,ops.rax)),mov(ops.rax,ops.rbx)]
+        self.assertEqual(optimize(instrs),instrs)
+
+    def test_store_forwarding(self):
+        instrs = [
+            mov(ops.rax,stack(8)),
+            mov(stack(8),ops.rcx),
+            mov(stack(8),ops.rax)]
+        self.assertEqual(
+            optimize(instrs),
+            [instrs[0],mov(ops.rax,ops.rcx),None])
+
+    def test_repeated_test(self):
+        instrs = [
+            ('test',(ops.rax,ops.rax)),
+            ('test',(ops.rax,ops.rax)),
+            ('test',(ops.rcx,ops.rcx)),
+            ('test',(ops.rax,ops.rax))]
+        self.assertEqual(optimize(instrs),[instrs[0],None,instrs[2],instrs[3]])
+
+    def test_aliasing_stores(self):
+        # [rsp+12] overlaps [rsp+8], so rax no longer matches [rsp+8]
+        instrs = [
+            mov(ops.rax,stack(8)),
+            mov(ops.rcx,stack(12)),
+            mov(ops.rax,stack(8))]
+        self.assertEqual(optimize(instrs),instrs)
+
+        instrs[1] = mov(ops.rcx,stack(16))
+        self.assertEqual(optimize(instrs),instrs[:2] + [None])
+
+        # memory that isn't on the native stack could be anything except the
+        # native stack
+        instrs[1] = mov(ops.rcx,ops.Address(0,ops.rdx))
+        self.assertEqual(optimize(instrs),instrs[:2] + [None])
+
+        instrs = [
+            mov(ops.rax,ops.Address(8,ops.rbx)),
+            mov(ops.rcx,ops.Address(0,ops.rdx)),
+            mov(ops.rax,ops.Address(8,ops.rbx))]
+        self.assertEqual(optimize(instrs),instrs)
+
+        # with the frame size known, [rbp-16] is [rsp], which doesn't overlap
+        # [rsp+8]
+        instrs = [
+            mov(ops.rax,stack(8)),
+            mov(ops.rcx,ops.Address(-16,ops.rbp)),
+            mov(ops.rax,stack(8))]
+        self.assertEqual(optimize(instrs),instrs)
+        self.assertEqual(optimize(instrs,frame_size=16),instrs[:2] + [None])
+
+        # the frame size isn't known after the stack pointer changes
+        instrs = [
+            ('push',(ops.rax,)),
+            mov(ops.rax,stack(8)),
+            mov(ops.rcx,ops.Address(-16,ops.rbp)),
+            mov(ops.rax,stack(8))]
+        self.assertEqual(
+            peephole.optimize_run(instrs,SystemVAbi,16),
+            (instrs,None))
+        self.assertEqual(
+            peephole.optimize_run(instrs[1:],SystemVAbi,16),
+            (instrs[1:3] + [None],16))
+
+        p = peephole._Pass(SystemVAbi,16)
+        self.assertTrue(p.may_alias(stack(8),ops.Address(-8,ops.rbp)))
+        self.assertFalse(p.may_alias(stack(8),ops.Address(-16,ops.rbp)))
+
+    def test_skip_merge(self):
+        # the last instruction is redundant when reached from the one before
+        # it, but the jump skips the instruction that makes it so
+        instrs = [
+            ('jz',(Displacement(3),)),
+            mov(ops.rax,ops.rbx),
+            mov(ops.rax,ops.rbx)]
+        self.assertEqual(optimize(instrs),instrs[:2] + [None])
+        self.assertEqual(optimize(instrs,joins={2:[0]}),instrs)
+
+        # nothing is known about a jump from outside
+        self.assertEqual(optimize(instrs,joins={2:[None]}),instrs)
+
+        # both paths agree
+        instrs.insert(0,mov(ops.rax,ops.rbx))
+        self.assertEqual(optimize(instrs,joins={3:[1]}),instrs[:2] + [None,None])
+
+    def test_fixed(self):
+        instrs = [
+            mov(ops.rax,stack(8)),
+            mov(stack(8),ops.rcx),
+            mov(ops.rax,stack(8)),
+            ('test',(ops.rax,ops.rax)),
+            ('test',(ops.rax,ops.rax))]
+        self.assertEqual(
+            optimize(instrs,fixed=range(len(instrs))),
+            instrs)
+        self.assertEqual(
+            optimize(instrs,fixed=[1,4]),
+            [instrs[0],instrs[1],None,instrs[3],instrs[4]])
+
@@ -2,6 +2,8 @@
 import unittest
 
 from .. import x86_ops as ops
+from .. import x86_64_ops as ops64
+from ..multimethod import multimethod
 
 
 
@@ -48,3 +50,82 @@ class TestAddress(unittest.TestCase):
         )
 
 
+class TestEncoding(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(ops.add(ops.eax,ops.ecx),b'\x01\xc1')
+        self.assertEqual(ops.add(ops.Address(8,ops.ebx),ops.edx),b'\x03\x53\x08')
+        self.assertEqual(ops.add(5,ops.ecx),b'\x83\xc1\x05')
+        self.assertEqual(ops.add(5,ops.cl),b'\x80\xc1\x05')
+        self.assertEqual(ops.xor(ops.ecx,ops.Address(base=ops.eax)),b'\x31\x08')
+        self.assertEqual(ops.test(5,ops.ecx),b'\xf7\xc1\x05\x00\x00\x00')
+        self.assertEqual(ops.testl(5,ops.Address(base=ops.eax)),b'\xf7\x00\x05\x00\x00\x00')
+        self.assertEqual(ops.mov(ops.Address(0x100),ops.eax),b'\xa1\x00\x01\x00\x00')
+        self.assertEqual(ops.shl(3,ops.edx),b'\xc1\xe2\x03')
+        self.assertEqual(ops.decl(ops.Address(base=ops.esi)),b'\xff\x0e')
+        self.assertEqual(getattr(ops,'and')(ops.eax,ops.ecx),b'\x21\xc1')
+        self.assertEqual(getattr(ops,'or')(5,ops.ecx),b'\x83\xc9\x05')
+        self.assertEqual(ops.sar(ops.cl,ops.edx),b'\xd3\xfa')
+        self.assertEqual(ops.imul(ops.ecx,ops.eax),b'\x0f\xaf\xc1')
+
+        self.assertEqual(ops64.add(ops64.r8,ops64.rax),b'\x4c\x01\xc0')
+        self.assertEqual(ops64.addl(1,ops64.Address(base=ops64.rax)),b'\x48\x83\x00\x01')
+        self.assertEqual(ops64.mov(ops64.Address(0x100),ops64.rax),b'\x48\x8b\x04\x25\x00\x01\x00\x00')
+        self.assertEqual(ops64.push(0x12345678),b'\x68\x78\x56\x34\x12')
+        self.assertEqual(ops64.inc(ops64.r9d),b'\x41\xff\xc1')
+        self.assertEqual(ops64.imul(ops64.r10,ops64.rax),b'\x49\x0f\xaf\xc2')
+        self.assertEqual(ops64.imul(ops64.Address(8,ops64.rbx),ops64.r11),b'\x4c\x0f\xaf\x5b\x08')
+        self.assertEqual(ops64.movsd(ops64.Address(16,ops64.r11),ops64.xmm0),b'\xf2\x41\x0f\x10\x43\x10')
+        self.assertEqual(ops64.movsd(ops64.xmm1,ops64.Address(8,ops64.rax)),b'\xf2\x0f\x11\x48\x08')
+        self.assertEqual(ops64.divsd(ops64.xmm9,ops64.xmm2),b'\xf2\x41\x0f\x5e\xd1')
+        self.assertEqual(ops64.ucomisd(ops64.xmm1,ops64.xmm0),b'\x66\x0f\x2e\xc1')
+        self.assertEqual(ops64.cvtsi2sd(ops64.r11,ops64.xmm3),b'\xf2\x49\x0f\x2a\xdb')
+
+
+class TestOperands(unittest.TestCase):
+    def runTest(self):
+        a = ops.Address(8,ops.ebx)
+        self.assertIs(a,ops.Address(8,ops.ebx))
+        self.assertEqual(hash(a),hash(ops.Address(8,ops.ebx)))
+        self.assertNotEqual(a,ops.Address(8,ops.ecx))
+        self.assertRaises(AttributeError,setattr,a,'offset',4)
+        self.assertEqual(a.replace(offset=4),ops.Address(4,ops.ebx))
+        self.assertEqual(a.offset,8)
+
+        r = ops64.Address(16,ops64.rip)
+        self.assertNotEqual(r,ops64.Address(16))
+        self.assertTrue(r.replace(offset=0).rip)
+
+        self.assertEqual(ops.Displacement(5),ops.Displacement(5))
+        self.assertNotEqual(ops.Displacement(5),ops.Displacement(5,True))
+
+        # a remembered encoding is the same as a new one
+        self.assertIs(ops.mov(a,ops.eax),ops.mov(a,ops.eax))
+        self.assertEqual(ops.mov(a,ops.eax),ops.mov.resolve((ops.Address,ops.Register))(a,ops.eax))
+
+
+class A: pass
+class B(A): pass
+
+@multimethod
+def _mm_test(x : A,y : A): return 'AA'
+
+@multimethod
+def _mm_test(x : B,y : A): return 'BA'
+
+@multimethod
+def _mm_test(x : A): return 'A'
+
+class TestMultiMethod(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(_mm_test(A(),A()),'AA')
+        self.assertEqual(_mm_test(B(),B()),'BA')
+        self.assertEqual(_mm_test(A(),B()),'AA')
+        self.assertEqual(_mm_test(B()),'A')
+        self.assertRaises(TypeError,_mm_test,1)
+        self.assertRaises(TypeError,_mm_test,A(),A(),A())
+
+        # derived classes match the overloads of their bases
+        self.assertEqual(ops.mov(True,ops.eax),ops.mov(1,ops.eax))
+        self.assertEqual(
+            ops.add(ops64.Register(ops.SIZE_D,0),ops64.Register(ops.SIZE_D,1)),
+            ops.add(ops.eax,ops.ecx))
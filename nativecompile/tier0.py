@@ -0,0 +1,171 @@
+"""The counting byte code that tiered entry points run until they are compiled.
+
+A tiered entry point (see compile_raw's tiered argument) is run by the
+interpreter until it becomes hot. To see how hot it is no matter who calls it,
+its byte code is replaced with a copy that has two kinds of counters added:
+
+- At the start, a call to pyinternals.tier0_enter, which counts the call and
+  compiles the code once it is hot. After that, it runs the machine code in the
+  frame that the interpreter set up and the byte code returns the result, so
+  calls made by the interpreter switch to the machine code too.
+
+- Before every instruction that something jumps backward to (the start of
+  every loop iteration), a call to pyinternals.tier0_backedge, which counts the
+  iteration. This way, a function that is called once and loops for a long time
+  is compiled as well. The call that made it hot finishes in the interpreter.
+
+The original byte code is kept as the entry point's source (see
+pyinternals.cep_get_source), which is what gets compiled. Generators and code
+that would need EXTENDED_ARG keep their byte code, and only the calls made by
+compiled code are counted for them.
+
+"""
+
+import dis
+
+from . import pyinternals
+from .flowgraph import decode
+
+
+LOAD_CONST = dis.opmap['LOAD_CONST']
+CALL_FUNCTION = dis.opmap['CALL_FUNCTION']
+POP_TOP = dis.opmap['POP_TOP']
+DUP_TOP = dis.opmap['DUP_TOP']
+COMPARE_OP = dis.opmap['COMPARE_OP']
+POP_JUMP_IF_TRUE = dis.opmap['POP_JUMP_IF_TRUE']
+RETURN_VALUE = dis.opmap['RETURN_VALUE']
+
+CO_GENERATOR = 0x0020
+
+# the largest argument an instruction can have without EXTENDED_ARG
+MAX_ARG = 0xffff
+
+
+def _ins(op,arg=None):
+    return bytes([op]) if arg is None else bytes([op,arg & 0xff,arg >> 8])
+
+def _prologue(enter,cont):
+    # tier0_enter returns the constant at index cont when the byte code should
+    # keep running
+    return b''.join([
+        _ins(LOAD_CONST,enter),
+        _ins(CALL_FUNCTION,0),
+        _ins(DUP_TOP),
+        _ins(LOAD_CONST,cont),
+        _ins(COMPARE_OP,dis.cmp_op.index('is')),
+        _ins(POP_JUMP_IF_TRUE,17),
+        _ins(RETURN_VALUE),
+        _ins(POP_TOP)])
+
+def _counter(backedge):
+    return _ins(LOAD_CONST,backedge) + _ins(CALL_FUNCTION,0) + _ins(POP_TOP)
+
+
+def line_starts(code):
+    """Get the (offset,line) pairs of code.co_lnotab, one for every offset
+    where the line number changes"""
+    lnotab = code.co_lnotab
+    r = []
+    addr = 0
+    line = code.co_firstlineno
+    last = None
+    for i in range(0,len(lnotab),2):
+        if lnotab[i]:
+            if line != last:
+                r.append((addr,line))
+                last = line
+            addr += lnotab[i]
+        line += lnotab[i+1]
+    if line != last:
+        r.append((addr,line))
+    return r
+
+def encode_lnotab(starts,firstlineno):
+    """The reverse of line_starts"""
+    r = bytearray()
+    addr = 0
+    line = firstlineno
+    for a,l in starts:
+        da = a - addr
+        dl = l - line
+        while da > 255:
+            r += bytes([255,0])
+            da -= 255
+        while dl > 255:
+            r += bytes([da,255])
+            da = 0
+            dl -= 255
+        if da or dl:
+            r += bytes([da,dl])
+        addr = a
+        line = l
+    return bytes(r)
+
+
+def counting_code(code):
+    """Get the co_code, co_consts, co_lnotab and co_stacksize of the counting
+    version of code, or None if code has to keep its byte code"""
+    if code.co_flags & CO_GENERATOR: return None
+
+    instructions = list(decode(code.co_code))
+
+    # an instruction with EXTENDED_ARG is longer than 3 bytes
+    if any(ins.next - ins.offset > 3 for ins in instructions): return None
+
+    # the constants used by the counters go after the code's own, so that no
+    # other instruction changes
+    enter = len(code.co_consts)
+    cont = enter + 1
+    backedge = enter + 2
+    if backedge > MAX_ARG: return None
+
+    prologue = _prologue(enter,cont)
+    counter = _counter(backedge)
+
+    loop_starts = set(ins.target for ins in instructions
+        if ins.target is not None and ins.target <= ins.offset)
+
+    # Where each instruction ends up and where the jumps to it go. A jump to
+    # the start of a loop goes to its counter and nothing jumps to the
+    # prologue.
+    moved = {}
+    targets = {}
+    pos = len(prologue)
+    for ins in instructions:
+        targets[ins.offset] = pos
+        if ins.offset in loop_starts: pos += len(counter)
+        moved[ins.offset] = pos
+        pos += ins.next - ins.offset
+    targets[len(code.co_code)] = pos
+    if pos > MAX_ARG: return None
+
+    r = bytearray(prologue)
+    for ins in instructions:
+        if ins.offset in loop_starts: r += counter
+
+        arg = ins.arg
+        if ins.target is not None:
+            arg = targets[ins.target]
+            if ins.op in dis.hasjrel: arg -= moved[ins.offset] + 3
+        r += _ins(ins.op,arg)
+
+    starts = line_starts(code)
+    if any(a not in targets for a,l in starts): return None
+
+    return (
+        bytes(r),
+        code.co_consts + (
+            pyinternals.tier0_enter,
+            pyinternals.TIER0_CONTINUE,
+            pyinternals.tier0_backedge),
+        encode_lnotab([(targets[a],l) for a,l in starts],code.co_firstlineno),
+        max(code.co_stacksize + 1,2))
+
+
+def make_tiered(ep):
+    """Give entry point ep the offset OFFSET_TIERED and, if possible, the
+    counting version of its byte code"""
+    pyinternals.cep_set_offset(ep,pyinternals.OFFSET_TIERED)
+    counting = counting_code(ep)
+    if counting is not None:
+        pyinternals.cep_set_tier0(ep,*counting)
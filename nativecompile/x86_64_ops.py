@@ -2,16 +2,22 @@
 from . multimethod import multimethod
 from . import x86_ops
 from .x86_ops import (
-    Displacement,Test,AsmSequence,al,cl,dl,bl,eax,ecx,edx,ebx,esp,ebp,esi,edi,
+    Displacement,Test,AsmSequence,XMMRegister,al,cl,dl,bl,eax,ecx,edx,ebx,esp,
+    ebp,esi,edi,xmm0,xmm1,xmm2,xmm3,xmm4,xmm5,xmm6,xmm7,
     test_O,test_NO,test_B,test_NB,test_E,test_Z,test_NE,test_NZ,test_BE,test_A,
     test_S,test_NS,test_P,test_NP,test_L,test_GE,test_LE,test_G,add,addb,addl,
-    cmp,cmpb,cmpl,decb,decl,incb,incl,jcc,JCC_MIN_LEN,JCC_MAX_LEN,jo,jno,jb,jnb,
-    je,jz,jne,jnz,jbe,ja,js,jns,jp,jnp,jl,jge,jle,jg,jmp,lea,leave,loop,loopz,
-    loope,loopnz,loopne,mov,movb,movl,nop,pop,ret,shl,shlb,shll,shr,shrb,shrl,
-    sub,subb,subl,test,testb,testl,xor,xorb,xorl,CALL_DISP_LEN,JCC_MIN_LEN,
+    addsd,cmp,cmpb,cmpl,cvtsi2sd,decb,decl,divsd,imul,incb,incl,jcc,JCC_MIN_LEN,
+    JCC_MAX_LEN,jo,jno,jb,jnb,je,jz,jne,jnz,jbe,ja,js,jns,jp,jnp,jl,jge,jle,jg,
+    jmp,lea,leave,loop,loopz,loope,loopnz,loopne,mov,movb,movl,movsd,mulsd,nop,
+    pop,ret,sar,sarb,sarl,shl,shlb,shll,shr,shrb,shrl,sub,subb,subl,subsd,test,
+    testb,testl,ucomisd,xor,xorb,xorl,xorpd,CALL_DISP_LEN,JCC_MIN_LEN,
     JCC_MAX_LEN,JMP_DISP_MIN_LEN,JMP_DISP_MAX_LEN,LOOP_LEN,SIZE_B,SIZE_D,SIZE_Q
 )
 
+# these are keywords, so they can't be imported by name
+for _name in ('and','andb','andl','or','orb','orl'):
+    globals()[_name] = getattr(x86_ops,_name)
+
 
 
 def immediate_data(w,data):
@@ -69,6 +75,15 @@ r13 = Register(SIZE_Q,0b1101)
 r14 = Register(SIZE_Q,0b1110)
 r15 = Register(SIZE_Q,0b1111)
 
+xmm8 = XMMRegister(8)
+xmm9 = XMMRegister(9)
+xmm10 = XMMRegister(10)
+xmm11 = XMMRegister(11)
+xmm12 = XMMRegister(12)
+xmm13 = XMMRegister(13)
+xmm14 = XMMRegister(14)
+xmm15 = XMMRegister(15)
+
 class _Rip:
     size = SIZE_Q
 
@@ -77,14 +92,19 @@ rip = _Rip()
 
 class Address(x86_ops.Address):
     def __init__(self,offset=0,base=None,index=None,scale=1):
-        self.rip = False
+        if '_hash' in self.__dict__: return
+
+        self.__dict__['rip'] = False
         if base is rip:
             assert index is None
-            self.rip = True
+            self.__dict__['rip'] = True
             base = None
 
         super().__init__(offset,base,index,scale)
 
+    def _fields(self):
+        return (self.offset,rip if self.rip else self.base,self.index,self.scale)
+
     def _mod_rm_sib_disp(self):
         if self.rip or self.base or self.index:
             return super()._mod_rm_sib_disp()
@@ -133,10 +153,21 @@ def inc(x : Register):
 @multimethod
 def mov(a : int,b : Register):
     if b.size == SIZE_Q:
-        return x86_ops.rex(None,b) + bytes([0b10111000 | b.reg]) + immediate_data(True,a)
+        return x86_ops._REX[0b1000 | b.ext] + bytes([0b10111000 | b.reg]) + immediate_data(True,a)
 
     return x86_ops.mov(a,b)
 
+# the short forms that x86_ops.mov uses for absolute addresses take a 64-bit
+# address in 64-bit mode, so they are not used here
+
+@multimethod
+def mov(a : Address,b : x86_ops.Register):
+    return x86_ops._op_addr_reg(0b10001010,a,b)
+
+@multimethod
+def mov(a : x86_ops.Register,b : Address):
+    return x86_ops._op_reg_addr(0b10001000,a,b)
+
 mov.inherit(x86_ops.mov)
 
 
@@ -152,8 +183,8 @@ def push(x : Address):
 
 @multimethod
 def push(x : int):
-    # note that this is code is different from x86_ops.push because
-    # immediate_data is redefined
+    # the immediate value is at most 32 bits, sign-extended to 64
+    return x86_ops.push(x)
+
 
-    byte = x86_ops.fits_in_sbyte(x)
-    return bytes([0b01101000 | (byte << 1)]) + immediate_data(not byte,x)
+x86_ops.memoize_instructions(globals())
@@ -7,7 +7,7 @@
 import binascii
 from functools import partial
 
-from .multimethod import multimethod
+from .multimethod import multimethod, MultiMethod
 
 
 SIZE_B = 0
@@ -28,23 +28,39 @@ def immediate_data(w,data):
     return data.to_bytes(4 if w else 1,byteorder='little',signed=data<0)
 
 
+# single bytes, so that bytes([x]) doesn't have to be called at run time
+_BYTES = [bytes([i]) for i in range(256)]
+
+# scale -> index -> base -> SIB byte
+_SIB = dict((scale,[[_BYTES[(ss << 6) | (index << 3) | base] for base in range(8)] for index in range(8)])
+    for ss,scale in enumerate((1,2,4,8)))
+
+# REX prefixes indexed by the W, R, X and B bits (an empty string when none of
+# them are set)
+_REX = [b''] + [bytes([0b01000000 | i]) for i in range(1,16)]
+
+
 
 class Register:
+    """A register. Registers are immutable."""
     def __init__(self,size,code):
-        self.size = size
-        self.code = code
+        self.__dict__.update(
+            size=size,
+            code=code,
 
-    @property
-    def ext(self):
-        return bool(self.code & 0b1000)
+            # these are used by every encoding so they are computed once
+            # instead of being properties
+            ext=bool(code & 0b1000),
+            reg=code & 0b111,
+            w=bool(size),
 
-    @property
-    def reg(self):
-        return self.code & 0b111
+            # the position of this register in the precomputed tables
+            index=(size << 4) | code,
 
-    @property
-    def w(self):
-        return bool(self.size)
+            _hash=hash((size,code)))
+
+    def __setattr__(self,name,value):
+        raise AttributeError('Register objects are immutable')
     
     def __eq__(self,b):
         if isinstance(b,Register):
@@ -58,6 +74,9 @@ class Register:
         
         return NotImplemented
 
+    def __hash__(self):
+        return self._hash
+
     def __str__(self):
         assert (not self.ext) and self.size < SIZE_Q
         return '%' + [
@@ -65,11 +84,65 @@ class Register:
             ['eax','ecx','edx','ebx','esp','ebp','esi','edi']
         ][self.size][self.reg]
 
-Register.__mmtype__ = Register
+
+class XMMRegister:
+    """An SSE register. Like Register, these are immutable."""
+    def __init__(self,code):
+        self.__dict__.update(
+            code=code,
+            ext=bool(code & 0b1000),
+            reg=code & 0b111,
+            _hash=hash(('xmm',code)))
+
+    def __setattr__(self,name,value):
+        raise AttributeError('XMMRegister objects are immutable')
+
+    def __eq__(self,b):
+        if isinstance(b,XMMRegister):
+            return self.code == b.code
+        return NotImplemented
+
+    def __ne__(self,b):
+        if isinstance(b,XMMRegister):
+            return self.code != b.code
+        return NotImplemented
+
+    def __hash__(self):
+        return self._hash
+
+    def __str__(self):
+        return '%xmm{}'.format(self.code)
 
 
 class Address:
+    """A memory operand.
+
+    Addresses are immutable and interned: creating an address equal to one that
+    already exists (with a plain int as the offset) returns the existing
+    object. Use replace to get a modified copy.
+
+    """
+    # the maximum number of interned addresses; the table is emptied when it
+    # is full
+    INTERN_LIMIT = 10000
+    _interned = {}
+
+    def __new__(cls,offset=0,base=None,index=None,scale=1):
+        # a RelocAddress is equal to its placeholder value but is not
+        # interchangeable with other instances
+        if type(offset) is not int:
+            return object.__new__(cls)
+
+        key = (cls,offset,base,index,scale)
+        r = cls._interned.get(key)
+        if r is None:
+            if len(cls._interned) >= cls.INTERN_LIMIT: cls._interned.clear()
+            r = cls._interned[key] = object.__new__(cls)
+        return r
+
     def __init__(self,offset=0,base=None,index=None,scale=1):
+        if '_hash' in self.__dict__: return
+
         assert scale in (1,2,4,8)
         assert (base is None or base.w) and (index is None or index.w)
         assert base is None or index is None or base.size == index.size
@@ -77,10 +150,39 @@ class Address:
         # %esp cannot be used as the index
         assert index is None or index.reg != 0b100
         
-        self.offset = offset
-        self.base = base
-        self.index = index
-        self.scale = scale
+        self.__dict__.update(offset=offset,base=base,index=index,scale=scale)
+
+        # computed once since addresses don't change
+        self.__dict__.update(
+            _encoding=self._mod_rm_sib_disp(),
+            _xb=(bool(index and index.ext) << 1) | bool(base and base.ext),
+            _hash=hash(self._fields()))
+
+    def __setattr__(self,name,value):
+        raise AttributeError('Address objects are immutable')
+
+    def _fields(self):
+        return (self.offset,self.base,self.index,self.scale)
+
+    def replace(self,**changes):
+        """Get a copy of this address with some of offset, base, index and
+        scale changed"""
+        fields = dict(zip(('offset','base','index','scale'),self._fields()))
+        fields.update(changes)
+        return self.__class__(**fields)
+
+    def __eq__(self,b):
+        if type(self) is type(b):
+            return self._fields() == b._fields()
+        return NotImplemented
+
+    def __ne__(self,b):
+        if type(self) is type(b):
+            return self._fields() != b._fields()
+        return NotImplemented
+
+    def __hash__(self):
+        return self._hash
 
     @property
     def size(self):
@@ -89,42 +191,41 @@ class Address:
         return None
     
     def _sib(self):
-        return bytes([
-            ({1:0,2:1,4:2,8:3}[self.scale] << 6) | 
-            ((self.index.reg if self.index else 0b100) << 3) | 
-            (self.base.reg if self.base else 0b101)])
+        return _SIB[self.scale][self.index.reg if self.index else 0b100][self.base.reg if self.base else 0b101]
     
     def _mod_rm_sib_disp(self):
-        if self.index or (self.base and self.base.reg == 0b100):
+        base = self.base
+        offset = self.offset
+        if self.index or (base and base.reg == 0b100):
             # The opcode format is a little different when the base is 0b101 and 
             # mod is 0b00 so to use %ebp, we'll have to go with the next mod value.
-            if self.offset == 0 and not (self.base and self.base.reg == 0b101):
+            if offset == 0 and not (base and base.reg == 0b101):
                 return 0b00, 0b100, self._sib()
                 
-            if fits_in_sbyte(self.offset):
-                return 0b01, 0b100, self._sib() + int_to_8(self.offset)
+            if -128 <= offset <= 127:
+                return 0b01, 0b100, self._sib() + int_to_8(offset)
                 
-            return 0b10, 0b100, self._sib() + int_to_32(self.offset)
+            return 0b10, 0b100, self._sib() + int_to_32(offset)
 
 
-        if self.base is None:
-            return 0b00, 0b101, int_to_32(self.offset)
+        if base is None:
+            return 0b00, 0b101, int_to_32(offset)
         
         # The opcode format is a little different when the base is 0b101 and 
         # mod is 0b00 so to use %ebp, we'll have to go with the next mod value.
-        if self.offset == 0 and not (self.base and self.base.reg == 0b101):
-            return 0b00, self.base.reg, b''
+        if offset == 0 and base.reg != 0b101:
+            return 0b00, base.reg, b''
         
-        if fits_in_sbyte(self.offset):
-            return 0b01, self.base.reg, int_to_8(self.offset)
+        if -128 <= offset <= 127:
+            return 0b01, base.reg, int_to_8(offset)
         
-        return 0b10, self.base.reg, int_to_32(self.offset)
+        return 0b10, base.reg, int_to_32(offset)
     
     def mod_rm_sib_disp(self,mid):
         """Get the mod field, the r/m field and the SIB and displacement bytes"""
     
-        mod,rm,extra = self._mod_rm_sib_disp()
-        return bytes([(mod << 6) | (mid << 3) | rm]) + extra
+        mod,rm,extra = self._encoding
+        return _BYTES[(mod << 6) | (mid << 3) | rm] + extra
     
     def __str__(self):
         if self.scale != 1:
@@ -138,8 +239,6 @@ class Address:
     def offset_only(self):
         return self.base is None and self.index is None and self.scale == 1
 
-Address.__mmtype__ = Address
-
 
 class Displacement:
     """A displacement relative to the next instruction.
@@ -149,8 +248,22 @@ class Displacement:
     
     """
     def __init__(self,value,force_full_size=False):
-        self.val = value
-        self.force_full_size = force_full_size
+        self.__dict__.update(val=value,force_full_size=force_full_size)
+
+    def __setattr__(self,name,value):
+        raise AttributeError('Displacement objects are immutable')
+
+    def __eq__(self,b):
+        if isinstance(b,Displacement):
+            return self.val == b.val and self.force_full_size == b.force_full_size
+        return NotImplemented
+
+    def __ne__(self,b):
+        r = self.__eq__(b)
+        return r if r is NotImplemented else not r
+
+    def __hash__(self):
+        return hash((self.val,self.force_full_size))
 
 
 def fits_in_sbyte(x):
@@ -315,6 +428,15 @@ ebp = Register(SIZE_D,0b101)
 esi = Register(SIZE_D,0b110)
 edi = Register(SIZE_D,0b111)
 
+xmm0 = XMMRegister(0)
+xmm1 = XMMRegister(1)
+xmm2 = XMMRegister(2)
+xmm3 = XMMRegister(3)
+xmm4 = XMMRegister(4)
+xmm5 = XMMRegister(5)
+xmm6 = XMMRegister(6)
+xmm7 = XMMRegister(7)
+
 
 
 test_O = Test(0b0000)
@@ -345,162 +467,278 @@ test_G = Test(0b1111)
 
 
 
-def _op_reg_reg(byte1,a,b):
-    assert a.size == b.size
-    return rex(a,b) + bytes([
-        byte1 | a.w,
-        0b11000000 | (a.reg << 3) | b.reg])
-
-def _op_addr_reg(byte1,a,b,reverse):
-    return rex(b,a) + bytes([byte1 | (reverse << 1) | b.w]) + a.mod_rm_sib_disp(b.reg)
-
-def _op_imm_reg(byte1,mid,byte_alt,a,b):
-    if b.code == 0:
-        r = bytes([byte_alt | b.w]) + immediate_data(b.w,a)
-        if b.size == SIZE_Q: r = bytes([0b01001000]) + r
-        return r
-
-    fits = fits_in_sbyte(a)
-    return rex(None,b) + bytes([
-        byte1 | (fits << 1) | b.w,
-        0b11000000 | (mid << 3) | b.reg]) + immediate_data(not fits,a)
+# Most instructions are encoded by the following functions, using the opcodes
+# and opcode extensions from the tables further down.
 
-def _op_imm_addr(byte1,mid,a,b,w):
-    fits = fits_in_sbyte(a)
-    return rex(None,b) + bytes([byte1 | (fits << 1) | w]) + b.mod_rm_sib_disp(mid) + immediate_data(not fits,a)
+def _reg_reg_table(opcode):
+    """Precompute the encodings of opcode with every pair of same-sized
+    registers.
 
+    The result is indexed by a.index * 48 + b.index, where a goes in the reg
+    field of ModRM and b in the r/m field. Pairs of different sizes are None.
 
+    """
+    table = [None] * (48 * 48)
+    for size in (SIZE_B,SIZE_D,SIZE_Q):
+        for a in range(16):
+            for b in range(16):
+                table[((size << 4) | a) * 48 + ((size << 4) | b)] = (
+                    _REX[((size == SIZE_Q) << 3) | ((a >> 3) << 2) | (b >> 3)] +
+                    bytes([opcode | bool(size),0b11000000 | ((a & 0b111) << 3) | (b & 0b111)]))
+    return table
+
+def _op_reg_reg(table,a,b):
+    r = table[a.index * 48 + b.index]
+    assert r is not None
+    return r
+
+def _op_addr(opcode,mid,a,q,r=False):
+    """Encode opcode followed by the ModRM, SIB and displacement bytes of
+    address a, with mid as the reg field of ModRM.
+
+    q and r are the W and R bits of the REX prefix.
 
-# Some functions are decorated with @multimethod even though they only have one
-# version. This is to have consistent type-checking.
-
-
-@multimethod
-def add(a : Register,b : Register):
-    return _op_reg_reg(0,a,b)
-
-@multimethod
-def add(a : Address,b : Register):
-    return _op_addr_reg(0,a,b,True)
+    """
+    mod,rm,extra = a._encoding
+    return (_REX[(q << 3) | (r << 2) | a._xb] +
+        _BYTES[opcode] +
+        _BYTES[(mod << 6) | (mid << 3) | rm] +
+        extra)
 
-@multimethod
-def add(a : Register,b : Address):
-    return _op_addr_reg(0,b,a,False)
+def _op_addr_reg(opcode,a,b):
+    return _op_addr(opcode | b.w,b.reg,a,b.size == SIZE_Q,b.ext)
 
-@multimethod
-def add(a : int,b : Register):
-    return _op_imm_reg(0b10000000,0,0b00000100,a,b)
+def _op_reg_addr(opcode,a,b):
+    return _op_addr(opcode | a.w,a.reg,b,a.size == SIZE_Q,a.ext)
 
-def add_imm_addr(a,b,w):
-    return _op_imm_addr(0b10000000,0b010 if b.size == SIZE_Q else 0,a,b,w)
+def _op_imm_reg(opcode,mid,acc_opcode,sign_extend,a,b):
+    if b.code == 0:
+        r = _BYTES[acc_opcode | b.w] + immediate_data(b.w,a)
+        if b.size == SIZE_Q: r = _REX[0b1000] + r
+        return r
 
-@multimethod
-def addb(a : int,b : Address):
-    return add_imm_addr(a,b,False)
+    byte = sign_extend and b.w and fits_in_sbyte(a)
+    return (_REX[((b.size == SIZE_Q) << 3) | b.ext] +
+        _BYTES[opcode | (byte << 1) | b.w] +
+        _BYTES[0b11000000 | (mid << 3) | b.reg] +
+        immediate_data(b.w and not byte,a))
+
+def _op_imm_addr(opcode,mid,sign_extend,w,a,b):
+    byte = sign_extend and w and fits_in_sbyte(a)
+    return _op_addr(opcode | (byte << 1) | w,mid,b,b.size == SIZE_Q) + immediate_data(w and not byte,a)
+
+def _op_shift_reg(mid,amount,x):
+    r = _REX[((x.size == SIZE_Q) << 3) | x.ext]
+    modrm = _BYTES[0b11000000 | (mid << 3) | x.reg]
+    if isinstance(amount,Register):
+        assert amount == cl
+        return r + _BYTES[0b11010010 | x.w] + modrm
+    if amount == 1:
+        return r + _BYTES[0b11010000 | x.w] + modrm
+    return r + _BYTES[0b11000000 | x.w] + modrm + immediate_data(False,amount)
+
+def _op_shift_addr(mid,w,amount,x):
+    q = x.size == SIZE_Q
+    if isinstance(amount,Register):
+        assert amount == cl
+        return _op_addr(0b11010010 | w,mid,x,q)
+    if amount == 1:
+        return _op_addr(0b11010000 | w,mid,x,q)
+    return _op_addr(0b11000000 | w,mid,x,q) + immediate_data(False,amount)
 
-@multimethod
-def addl(a : int,b : Address):
-    return add_imm_addr(a,b,True)
+def _op_inc_dec_reg(mid,x):
+    # REX omitted; inc and dec are redefined in x86_64_ops
+    if x.w:
+        return _BYTES[0b01000000 | (mid << 3) | x.reg]
+    return _BYTES[0b11111110] + _BYTES[0b11000000 | (mid << 3) | x.reg]
+
+def _op_inc_dec_addr(mid,w,x):
+    return _op_addr(0b11111110 | w,mid,x,x.size == SIZE_Q)
+
+
+def _instruction(name,forms):
+    op = MultiMethod(name)
+    for types,func in forms: op.register(types,func)
+    return op
+
+def _binary_ops(name,opcode,reversible,imm_opcode,imm_mid,acc_opcode,sign_extend):
+    rr = _reg_reg_table(opcode)
+    return {
+        name : _instruction(name,[
+            ((Register,Register),partial(_op_reg_reg,rr)),
+            ((Register,Address),partial(_op_reg_addr,opcode)),
+            ((Address,Register),partial(_op_addr_reg,opcode | (reversible << 1))),
+            ((int,Register),partial(_op_imm_reg,imm_opcode,imm_mid,acc_opcode,sign_extend))]),
+        name+'b' : _instruction(name+'b',[((int,Address),partial(_op_imm_addr,imm_opcode,imm_mid,sign_extend,False))]),
+        name+'l' : _instruction(name+'l',[((int,Address),partial(_op_imm_addr,imm_opcode,imm_mid,sign_extend,True))])}
+
+def _shift_ops(name,mid):
+    return {
+        name : _instruction(name,[
+            ((int,Register),partial(_op_shift_reg,mid)),
+            ((Register,Register),partial(_op_shift_reg,mid))]),
+        name+'b' : _instruction(name+'b',[
+            ((int,Address),partial(_op_shift_addr,mid,False)),
+            ((Register,Address),partial(_op_shift_addr,mid,False))]),
+        name+'l' : _instruction(name+'l',[
+            ((int,Address),partial(_op_shift_addr,mid,True)),
+            ((Register,Address),partial(_op_shift_addr,mid,True))])}
+
+def _op_sse(prefix,opcode,a,b,w=False):
+    """Encode an SSE instruction with mandatory prefix 'prefix' and opcode
+    0x0F 'opcode', with b (an XMM register) in the reg field of ModRM and a
+    (an XMM register, general purpose register or address) in the r/m field.
+
+    w is the W bit of the REX prefix.
 
+    """
+    if isinstance(a,Address):
+        mod,rm,extra = a._encoding
+        return (_BYTES[prefix] + _REX[(w << 3) | (b.ext << 2) | a._xb] +
+            _BYTES[0b00001111] + _BYTES[opcode] +
+            _BYTES[(mod << 6) | (b.reg << 3) | rm] +
+            extra)
+
+    return (_BYTES[prefix] + _REX[(w << 3) | (b.ext << 2) | a.ext] +
+        _BYTES[0b00001111] + _BYTES[opcode] +
+        _BYTES[0b11000000 | (b.reg << 3) | a.reg])
+
+def _sse_ops(name,prefix,opcode):
+    return {
+        name : _instruction(name,[
+            ((XMMRegister,XMMRegister),partial(_op_sse,prefix,opcode)),
+            ((Address,XMMRegister),partial(_op_sse,prefix,opcode))])}
+
+def _inc_dec_ops(name,mid):
+    return {
+        name : _instruction(name,[((Register,),partial(_op_inc_dec_reg,mid))]),
+        name+'b' : _instruction(name+'b',[((Address,),partial(_op_inc_dec_addr,mid,False))]),
+        name+'l' : _instruction(name+'l',[((Address,),partial(_op_inc_dec_addr,mid,True))])}
+
+
+# Instructions that take two operands, using the common encodings. Each entry
+# is name: (
+#   the opcode of the forms with two registers or with a register and an
+#     address,
+#   whether the opcode + 0b10 is the form with the operands the other way
+#     around (address to register),
+#   the opcode of the forms with an immediate value,
+#   the opcode extension (the reg field of ModRM) of the immediate forms,
+#   the opcode of the short form with an immediate value and the accumulator
+#     register,
+#   whether the opcode + 0b10 is the form with a sign-extended byte immediate
+#     value)
+#
+# The opcodes are for byte operands. 1 is added to them for 32 and 64 bit
+# operands. Besides "name", "nameb" and "namel" are defined, which take an
+# immediate value and an address with byte and 32 (or 64) bit operands.
+#
+# "and" and "or" are Python keywords, so those instructions have to be gotten
+# with getattr.
+BINARY_OPS = {
+    'add' : (0b00000000,True,0b10000000,0b000,0b00000100,True),
+    'and' : (0b00100000,True,0b10000000,0b100,0b00100100,True),
+    'cmp' : (0b00111000,True,0b10000000,0b111,0b00111100,True),
+    'or' : (0b00001000,True,0b10000000,0b001,0b00001100,True),
+    'sub' : (0b00101000,True,0b10000000,0b101,0b00101100,True),
+    'test' : (0b10000100,False,0b11110110,0b000,0b10101000,False),
+    'xor' : (0b00110000,True,0b10000000,0b110,0b00110100,True)}
+
+# Shift instructions. Each entry is name: opcode extension. The opcodes are
+# the same for all of them. "nameb" and "namel" are also defined.
+SHIFT_OPS = {
+    'sar' : 0b111,
+    'shl' : 0b100,
+    'shr' : 0b101}
+
+# Instructions that take one operand and use opcode 0b11111110 (+1 for 32 and
+# 64 bit operands). Each entry is name: opcode extension. "nameb" and "namel"
+# are also defined.
+INC_DEC_OPS = {
+    'inc' : 0b000,
+    'dec' : 0b001}
+
+# SSE2 instructions that take an XMM register or an address and an XMM
+# register, which is the destination. Each entry is name: (
+#   the mandatory prefix,
+#   the opcode after 0x0F)
+SSE_OPS = {
+    'addsd' : (0b11110010,0b01011000),
+    'divsd' : (0b11110010,0b01011110),
+    'mulsd' : (0b11110010,0b01011001),
+    'subsd' : (0b11110010,0b01011100),
+    'ucomisd' : (0b01100110,0b00101110),
+    'xorpd' : (0b01100110,0b01010111)}
+
+for _name,_args in BINARY_OPS.items():
+    globals().update(_binary_ops(_name,*_args))
+
+for _name,_mid in SHIFT_OPS.items():
+    globals().update(_shift_ops(_name,_mid))
+
+for _name,_mid in INC_DEC_OPS.items():
+    globals().update(_inc_dec_ops(_name,_mid))
+
+for _name,_args in SSE_OPS.items():
+    globals().update(_sse_ops(_name,*_args))
+
+
+
+# Instructions that don't fit the tables are defined below. Some functions are
+# decorated with @multimethod even though they only have one version. This is
+# to have consistent type-checking.
 
 
 @multimethod
 def call(proc : Displacement):
-    return bytes([0b11101000]) + int_to_32(proc.val)
+    return _BYTES[0b11101000] + int_to_32(proc.val)
 
 CALL_DISP_LEN = 5
 
 @multimethod
 def call(proc : Register):
     assert proc.w
-    return rex(None,proc,False) + bytes([
-        0b11111111,
-        0b11010000 | proc.reg])
+    return _REX[proc.ext] + _BYTES[0b11111111] + _BYTES[0b11010000 | proc.reg]
 
 @multimethod
 def call(proc : Address):
-    return rex(None,proc,False) + bytes([0b11111111]) + proc.mod_rm_sib_disp(0b010)
-
-
-@multimethod
-def cmp(a : Register,b : Register):
-    return _op_reg_reg(0b00111000,a,b)
-
-@multimethod
-def cmp(a : Address,b : Register):
-    return _op_addr_reg(0b00111000,a,b,True)
-
-@multimethod
-def cmp(a : Register,b : Address):
-    return _op_addr_reg(0b00111000,b,a,False)
-
-@multimethod
-def cmp(a : int,b : Register):
-    return _op_imm_reg(0b10000000,0b111,0b00111100,a,b)
-
-@multimethod
-def cmpb(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b111,a,b,False)
-
-@multimethod
-def cmpl(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b111,a,b,True)
+    return _op_addr(0b11111111,0b010,proc,False)
 
 
 
 @multimethod
-def dec(x : Register):
-    # REX omitted; dec is redefined in x86_64_ops
-    if x.w:
-        return bytes([0b01001000 | x.reg])
-    else:
-        return bytes([
-            0b11111110,
-            0b11001000 | x.reg])
+def cvtsi2sd(a : Register,b : XMMRegister):
+    assert a.w
+    return _op_sse(0b11110010,0b00101010,a,b,a.size == SIZE_Q)
 
-def dec_addr(x,w):
-    return rex(None,x) + bytes([0b11111110 | w]) + x.mod_rm_sib_disp(0b001)
-
-@multimethod
-def decb(x : Address):
-    return dec_addr(x,False)
-
-@multimethod
-def decl(x : Address):
-    return dec_addr(x,True)
 
 
+# only the two-operand forms of imul, which multiply a register by another
+# register or memory
 
 @multimethod
-def inc(x : Register):
-    # REX omitted; inc is redefined in x86_64_ops
-    if x.w:
-        return bytes([0b01000000 | x.reg])
-    else:
-        return bytes([
-            0b11111110,
-            0b11000000 | x.reg])
-
-def inc_addr(x,w):
-    return rex(None,x) + bytes([0b11111110 | w]) + x.mod_rm_sib_disp(0)
+def imul(a : Register,b : Register):
+    assert a.w and a.size == b.size
+    return (_REX[((b.size == SIZE_Q) << 3) | (b.ext << 2) | a.ext] +
+        _BYTES[0b00001111] + _BYTES[0b10101111] +
+        _BYTES[0b11000000 | (b.reg << 3) | a.reg])
 
 @multimethod
-def incb(x : Address):
-    return inc_addr(x,False)
-
-@multimethod
-def incl(x : Address):
-    return inc_addr(x,True)
+def imul(a : Address,b : Register):
+    assert b.w
+    mod,rm,extra = a._encoding
+    return (_REX[((b.size == SIZE_Q) << 3) | (b.ext << 2) | a._xb] +
+        _BYTES[0b00001111] + _BYTES[0b10101111] +
+        _BYTES[(mod << 6) | (b.reg << 3) | rm] +
+        extra)
 
 
 
 def jcc(test : Test,x : Displacement):
     if fits_in_sbyte(x):
-        return bytes([0b01110000 | test.val]) + int_to_8(x.val)
+        return _BYTES[0b01110000 | test.val] + int_to_8(x.val)
     
-    return bytes([
-        0b00001111,
-        0b10000000 | test.val]) + int_to_32(x.val)
+    return _BYTES[0b00001111] + _BYTES[0b10000000 | test.val] + int_to_32(x.val)
 
 JCC_MIN_LEN = 2
 JCC_MAX_LEN = 6
@@ -528,8 +766,9 @@ def jg(x): return jcc(test_G,x)
 
 @multimethod
 def jmp(x : Displacement):
-    fits = fits_in_sbyte(x)
-    return bytes([0b11101001 | (fits << 1)]) + ([int_to_32,int_to_8][fits])(x.val)
+    if fits_in_sbyte(x):
+        return _BYTES[0b11101011] + int_to_8(x.val)
+    return _BYTES[0b11101001] + int_to_32(x.val)
 
 JMP_DISP_MIN_LEN = 2
 JMP_DISP_MAX_LEN = 5
@@ -537,41 +776,39 @@ JMP_DISP_MAX_LEN = 5
 @multimethod
 def jmp(x : Register):
     assert x.w
-    return rex(None,x) + bytes([
-        0b11111111,
-        0b11100000 | x.reg])
+    return _REX[((x.size == SIZE_Q) << 3) | x.ext] + _BYTES[0b11111111] + _BYTES[0b11100000 | x.reg]
 
 @multimethod
 def jmp(x : Address):
-    return rex(None,x) + bytes([0b11111111]) + x.mod_rm_sib_disp(0b100)
+    return _op_addr(0b11111111,0b100,x,x.size == SIZE_Q)
 
 
 
 @multimethod
 def lea(a : Address,b : Register):
     assert b.w
-    return rex(b,a) + bytes([0b10001101]) + a.mod_rm_sib_disp(b.reg)
+    return _op_addr(0b10001101,b.reg,a,b.size == SIZE_Q,b.ext)
 
 
 
 def leave():
-    return bytes([0b11001001])
+    return _BYTES[0b11001001]
 
 
 
 @multimethod
 def loop(x : Displacement):
-    return bytes([0b11100010]) + int_to_8(x.val)
+    return _BYTES[0b11100010] + int_to_8(x.val)
 
 @multimethod
 def loopz(x : Displacement):
-    return bytes([0b11100001]) + int_to_8(x.val)
+    return _BYTES[0b11100001] + int_to_8(x.val)
 
 loope = loopz
     
 @multimethod
 def loopnz(x : Displacement):
-    return bytes([0b11100000]) + int_to_8(x.val)
+    return _BYTES[0b11100000] + int_to_8(x.val)
 
 loopne = loopnz
 
@@ -579,239 +816,97 @@ LOOP_LEN = 2
 
 
 
-@multimethod
-def mov(a : Register,b : Register):
-    return _op_reg_reg(0b10001000,a,b)
+def _mov_imm_reg(a,b):
+    return _REX[((b.size == SIZE_Q) << 3) | b.ext] + _BYTES[0b10110000 | (b.w << 3) | b.reg] + immediate_data(b.w,a)
 
-def mov_addr_reg(a,b,forward):
-    if b.reg == 0b000 and a.offset_only():
-        r = bytes([0b10100000 | (forward << 1) | b.w]) + int_to_32(a.offset)
-        if b.size == SIZE_Q: r = bytes([0b01001000]) + r
-        return r
+# the accumulator has shorter forms for absolute addresses
 
-    return _op_addr_reg(0b10001000,a,b,forward)
+def _mov_addr_reg(a,b):
+    if b.code == 0 and a.offset_only():
+        return _BYTES[0b10100000 | b.w] + int_to_32(a.offset)
+    return _op_addr_reg(0b10001010,a,b)
 
-@multimethod
-def mov(a : Address,b : Register):
-    return mov_addr_reg(a,b,True)
+def _mov_reg_addr(a,b):
+    if a.code == 0 and b.offset_only():
+        return _BYTES[0b10100010 | a.w] + int_to_32(b.offset)
+    return _op_reg_addr(0b10001000,a,b)
+
+mov = _instruction('mov',[
+    ((Register,Register),partial(_op_reg_reg,_reg_reg_table(0b10001000))),
+    ((Address,Register),_mov_addr_reg),
+    ((Register,Address),_mov_reg_addr),
+    ((int,Register),_mov_imm_reg)])
+movb = _instruction('movb',[((int,Address),partial(_op_imm_addr,0b11000110,0b000,False,False))])
+movl = _instruction('movl',[((int,Address),partial(_op_imm_addr,0b11000110,0b000,False,True))])
 
-@multimethod
-def mov(a : Register,b : Address):
-    return mov_addr_reg(b,a,False)
 
-@multimethod
-def mov(a : int,b : Register):
-    return rex(None,b) + bytes([0b10110000 | (b.w << 3) | b.reg]) + immediate_data(b.w,a)
 
-def mov_imm_addr(a,b,w):
-    return rex(None,b) + bytes([0b11000110 | w]) + b.mod_rm_sib_disp(0) + immediate_data(w,a)
+# movsd is only the SSE2 instruction that moves a double, not the string
+# instruction
+
+@multimethod
+def movsd(a : XMMRegister,b : XMMRegister):
+    return _op_sse(0b11110010,0b00010000,a,b)
 
 @multimethod
-def movb(a : int,b : Address):
-    return mov_imm_addr(a,b,False)
+def movsd(a : Address,b : XMMRegister):
+    return _op_sse(0b11110010,0b00010000,a,b)
 
 @multimethod
-def movl(a : int,b : Address):
-    return mov_imm_addr(a,b,True)
+def movsd(a : XMMRegister,b : Address):
+    return _op_sse(0b11110010,0b00010001,b,a)
 
 
 
 def nop():
-    return bytes([0b10010000])
+    return _BYTES[0b10010000]
 
 
 
 @multimethod
 def pop(x : Register):
-    return rex(None,x,False) + bytes([0b01011000 | x.reg])
+    return _REX[x.ext] + _BYTES[0b01011000 | x.reg]
 
 @multimethod
 def pop(x : Address):
-    return rex(None,x,False) + bytes([0b10001111]) + x.mod_rm_sib_disp(0)
+    return _op_addr(0b10001111,0,x,False)
 
 
 
 @multimethod
 def push(x : Register):
-    return rex(None,x,False) + bytes([0b01010000 | x.reg])
+    return _REX[x.ext] + _BYTES[0b01010000 | x.reg]
 
 @multimethod
 def push(x : Address):
-    return rex(None,x,False) + bytes([0b11111111]) + x.mod_rm_sib_disp(0b110)
+    return _op_addr(0b11111111,0b110,x,False)
 
 @multimethod
 def push(x : int):
-    byte = fits_in_sbyte(x)
-    return bytes([0b01101000 | (byte << 1)]) + immediate_data(not byte,x)
+    if fits_in_sbyte(x):
+        return _BYTES[0b01101010] + int_to_8(x)
+    return _BYTES[0b01101000] + immediate_data(True,x)
 
 
 
 @multimethod
 def ret():
-    return bytes([0b11000011])
+    return _BYTES[0b11000011]
 
 @multimethod
 def ret(pop : int):
-    return bytes([0b11000010]) + int_to_16(pop)
-
-
-
-def shx_imm_reg(amount,x,shiftright):
-    r = rex(None,x)
-
-    if amount == 1:
-        return r + bytes([
-            0b11010000 | x.w,
-            0b11100000 | (shiftright << 3) | x.reg])
-    
-    return r + bytes([
-        0b11000000 | x.w,
-        0b11100000 | (shiftright << 3) | x.reg]) + immediate_data(False,amount)
-
-def shx_reg_reg(amount,x,shiftright):
-    assert amount == cl
-    
-    return rex(None,x) + bytes([
-        0b11010010 | x.w,
-        0b11100000 | (shiftright << 3) | x.reg])
-
-def shx_imm_addr(amount,x,w,shiftright):
-    r = rex(None,x)
-    rmsd = x.mod_rm_sib_disp(0b100 | shiftright)
-    if amount == 1:
-        return r + bytes([0b11010000 | w]) + rmsd
-    
-    return r + bytes([0b11000000 | w]) + rmsd + immediate_data(False,amount)
-
-def shx_reg_addr(amount,x,w,shiftright):
-    assert amount == cl
-    
-    return rex(None,x) + bytes([0b11010010 | w]) + x.mod_rm_sib_disp(0b100 | shiftright)
-
-
-@multimethod
-def shl(amount : int,x : Register):
-    return shx_imm_reg(amount,x,False)
-
-@multimethod
-def shl(amount : Register,x : Register):
-    return shx_reg_reg(amount,x,False)
-
-@multimethod
-def shlb(amount : int,x : Address):
-    return shx_imm_addr(amount,x,False,False)
-
-@multimethod
-def shll(amount : int,x : Address):
-    return shx_imm_addr(amount,x,True,False)
-
-@multimethod
-def shlb(amount : Register,x : Address):
-    return shx_reg_addr(amount,x,False,False)
-
-@multimethod
-def shll(amount : Register,x : Address):
-    return shx_reg_addr(amount,x,True,False)
-
-
-
-@multimethod
-def shr(amount : int,x : Register):
-    return shx_imm_reg(amount,x,True)
-
-@multimethod
-def shr(amount : Register,x : Register):
-    return shx_reg_reg(amount,x,True)
-
-@multimethod
-def shrb(amount : int,x : Address):
-    return shx_imm_addr(amount,x,False,True)
-
-@multimethod
-def shrl(amount : int,x : Address):
-    return shx_imm_addr(amount,x,True,True)
-
-@multimethod
-def shrb(amount : Register,x : Address):
-    return shx_reg_addr(amount,x,False,True)
-
-@multimethod
-def shrl(amount : Register,x : Address):
-    return shx_reg_addr(amount,x,True,True)
-
-
-
-@multimethod
-def sub(a : Register,b : Register):
-    return _op_reg_reg(0b00101000,a,b)
-
-@multimethod
-def sub(a : Address,b : Register):
-    return _op_addr_reg(0b00101000,a,b,True)
-
-@multimethod
-def sub(a : Register,b : Address):
-    return _op_addr_reg(0b00101000,b,a,False)
-
-@multimethod
-def sub(a : int,b : Register):
-    return _op_imm_reg(0b10000000,0b101,0b00101100,a,b)
-
-@multimethod
-def subb(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b101,a,b,False)
-
-@multimethod
-def subl(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b101,a,b,True)
+    return _BYTES[0b11000010] + int_to_16(pop)
 
 
 
-@multimethod
-def test(a : Register,b : Register):
-    return _op_reg_reg(0b10000100,a,b)
-
-@multimethod
-def test(a : Address,b : Register):
-    return _op_addr_reg(0b10000100,a,b,True)
-
-@multimethod
-def test(a : int,b : Register):
-    return _op_imm_reg(0b11110110,0,0b10101000,a,b)
-
-def test_imm_addr(a,b,w):
-    return rex(None,b) + bytes([0b11110110 | w]) + b.mod_rm_sib_disp(0) + immedate_data(w,a)
-
-@multimethod
-def testb(a : int,b : Address):
-    return test_imm_addr(a,b,False)
-
-@multimethod
-def testl(a : int,b : Address):
-    return test_imm_addr(a,b,True)
-
+# The same instructions are encoded over and over while compiling. Since all
+# operands are immutable, the encodings can be remembered.
+ENCODING_CACHE_SIZE = 1024
 
+def memoize_instructions(namespace,size=ENCODING_CACHE_SIZE):
+    """Remember the encodings of up to size calls of each instruction in
+    namespace (a module's globals)"""
+    for x in namespace.values():
+        if isinstance(x,MultiMethod): x.memoize(size)
 
-@multimethod
-def xor(a : Register,b : Register):
-    return _op_reg_reg(0b00110000,a,b)
-
-@multimethod
-def xor(a : Register,b : Address):
-    return _op_addr_reg(0b00110000,b,a,True)
-
-@multimethod
-def xor(a : Address,b : Register):
-    return _op_addr_reg(0b00110000,a,b,False)
-
-@multimethod
-def xor(a : int,b : Register):
-    return _op_imm_reg(0b10000000,0b110,0b00110100,a,b)
-
-@multimethod
-def xorb(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b110,a,b,False)
-
-@multimethod
-def xorl(a : int,b : Address):
-    return _op_imm_addr(0b10000000,0b110,a,b,True)
+memoize_instructions(globals())
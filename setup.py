@@ -5,7 +5,7 @@ setup(
     version='0.1.0',
     description='Transform Python bytecode into runnable machine code',
     author='Rouslan Korneychuk',
-    packages=['nativecompile','nativecompile.tests'],
+    packages=['nativecompile','nativecompile.tests','nativecompile.benchmarks'],
     ext_modules=[Extension(
         'nativecompile.pyinternals',
         ['nativecompile/pyinternals.c'])])